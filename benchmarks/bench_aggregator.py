@@ -0,0 +1,139 @@
+#!/usr/bin/python3
+
+# fleet aggregator benchmark
+#
+# thousands of nodes publish their state once per simulated second through an
+# in-process stand-in broker. the messages are delivered to the aggregator
+# as fast as possible, the summary is created after each simulated second.
+# some nodes report stalled fans and some stop publishing. the results are
+# written as JSON to stdout or to the file passed with --output
+#
+#   python3 benchmarks/bench_aggregator.py --nodes=5000 --seconds=60
+
+import os
+import sys
+import time
+import json
+import random
+import argparse
+import platform
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rpi_fanspeed import VERSION
+from rpi_fanspeed.aggregator import Aggregator
+from rpi_fanspeed.sim import StandInBroker, StandInClient
+
+# JSON state of a node as published by MQTT.client_publish
+def get_payload(temp, duty_cycle, rpm, ts, stalled=False):
+    data = {
+        'temperature': ('%.2f' % temp),
+        'duty_cycle': ('%.2f' % duty_cycle),
+        'rpm': ('%u' % rpm),
+        'ts': ts,
+        'interval': '1.0',
+    }
+    if stalled:
+        data['stalled'] = '1'
+    return json.dumps(data, indent=0).encode()
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def bench_aggregator(nodes, seconds, stalled, silent):
+    broker = StandInBroker()
+    client = StandInClient(broker=broker)
+    now = [0.0]
+    aggregator = Aggregator(client, 'home/{device_name}/{entity}', 'home/fleet/RPi.fanspeed/summary', stale_timeout=10, expire=3600, monotonic=lambda: now[0])
+    client.on_connect = aggregator.on_connect
+    client.on_message = aggregator.on_message
+    client.connect()
+    summaries = []
+    client_summary = StandInClient(broker=broker)
+    client_summary.on_message = lambda client, userdata, msg: summaries.append(msg.payload)
+    client_summary.subscribe(aggregator.summary_topic)
+
+    rnd = random.Random(1)
+    topics = ['home/node%05u/RPi.fanspeed/json' % i for i in range(nodes)]
+    # a few payloads per node are created in advance
+    payloads = []
+    for i in range(nodes):
+        base = rnd.uniform(35.0, 70.0)
+        payloads.append([get_payload(base + rnd.uniform(-2, 2), min(100, max(0, (base - 40) * 3)), 2000 + int(base * 20), 1792430000 + n, i<stalled) for n in range(4)])
+    # the last nodes stop publishing after half of the time
+    silent_after = seconds // 2
+
+    wall = 0.0
+    cpu = 0.0
+    messages = 0
+    summary_wall = []
+    for second in range(seconds):
+        now[0] = float(second)
+        batch = [(topics[i], payloads[i][second % 4]) for i in range(nodes) if second<silent_after or i<nodes - silent]
+        c = time.process_time()
+        t = time.perf_counter()
+        for topic, payload in batch:
+            broker.publish(topic, payload)
+        wall += time.perf_counter() - t
+        cpu += time.process_time() - c
+        messages += len(batch)
+        t = time.perf_counter()
+        aggregator.publish_summary()
+        summary_wall.append(time.perf_counter() - t)
+
+    summary = json.loads(summaries[-1])
+    return {
+        'nodes': nodes,
+        'seconds': seconds,
+        'messages': messages,
+        'wall_us_per_message': wall / messages * 1e6,
+        'cpu_us_per_message': cpu / messages * 1e6,
+        # nodes publishing once per second that one cpu core can aggregate
+        'max_nodes_at_1hz': int(messages / max(cpu, 1e-9)),
+        'summary_ms': {
+            'p50': percentile(summary_wall, 50) * 1e3,
+            'max': max(summary_wall) * 1e3,
+        },
+        'summary_bytes': len(summaries[-1]),
+        'summary': {
+            'nodes': summary['nodes'],
+            'stale': summary['stale'],
+            'stalled': summary['stalled'],
+            'temperature': summary['temperature'],
+        },
+        'expected': {
+            'nodes': nodes - silent,
+            'stale': silent,
+            'stalled': stalled,
+        },
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='raspi_fanspeed aggregator benchmark')
+    parser.add_argument('-n', '--nodes', type=int, help='number of nodes', default=5000)
+    parser.add_argument('-s', '--seconds', type=int, help='simulated seconds', default=60)
+    parser.add_argument('--stalled', type=int, help='nodes with a stalled fan', default=5)
+    parser.add_argument('--silent', type=int, help='nodes that stop publishing', default=20)
+    parser.add_argument('-o', '--output', type=str, help='write results to this file', default=None)
+    args = parser.parse_args()
+
+    results = {
+        'version': VERSION,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'ts': int(time.time()),
+        'benchmarks': {
+            'aggregator': bench_aggregator(args.nodes, args.seconds, args.stalled, args.silent),
+        }
+    }
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+#!/usr/bin/python3
+
+# benchmarks for the hot paths of the daemon
+#
+# runs against the simulated backend and a stand-in MQTT client, no GPIO,
+# pigpiod or broker required. the results are written as JSON to stdout or
+# to the file passed with --output
+#
+#   python3 benchmarks/bench_daemon.py --output=bench-0.0.1.json
+
+import os
+import sys
+import time
+import json
+import argparse
+import platform
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rpi_fanspeed import VERSION, cli, daemon
+from rpi_fanspeed.sim import StandInClient
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+# returns wall and cpu time statistics in microseconds
+def measure(func, iterations):
+    wall = []
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    for i in range(iterations):
+        t = time.perf_counter()
+        func()
+        wall.append(time.perf_counter() - t)
+    total_wall = time.perf_counter() - wall_start
+    total_cpu = time.process_time() - cpu_start
+    return {
+        'iterations': iterations,
+        'wall_us': {
+            'mean': total_wall / iterations * 1e6,
+            'p50': percentile(wall, 50) * 1e6,
+            'p95': percentile(wall, 95) * 1e6,
+            'max': max(wall) * 1e6,
+        },
+        'cpu_us': total_cpu / iterations * 1e6,
+    }
+
+def setup(argv):
+    args = cli.create_parser('bench').parse_args(argv + ['--simulate', '--sim-load=0.5'])
+    backend = daemon.create_backend(args)
+    daemon.init(args, backend)
+    daemon.init_sensors(backend)
+    return args, backend
+
+def bench_loop_iteration(iterations, interval):
+    args, backend = setup(['--interval=%u' % interval])
+    daemon.rpm_monitor.start()
+    # let the fan and temperature settle before measuring
+    for i in range(10):
+        daemon.loop_iteration()
+        backend.clock.sleep(interval)
+    wall = []
+    cpu = 0
+    for i in range(iterations):
+        t = time.perf_counter()
+        c = time.process_time()
+        daemon.loop_iteration()
+        cpu += time.process_time() - c
+        wall.append(time.perf_counter() - t)
+        # the simulation is not part of the measurement
+        backend.clock.sleep(interval)
+    daemon.rpm_monitor.stop()
+    return {
+        'iterations': iterations,
+        'interval': interval,
+        'wall_us': {
+            'mean': sum(wall) / iterations * 1e6,
+            'p50': percentile(wall, 50) * 1e6,
+            'p95': percentile(wall, 95) * 1e6,
+            'max': max(wall) * 1e6,
+        },
+        'cpu_us': cpu / iterations * 1e6,
+    }
+
+def bench_rpm_callback(iterations, rpm):
+    args, backend = setup([])
+    monitor = daemon.rpm_monitor
+    # 2 edges per revolution
+    edges_per_second = rpm / 60.0 * 2.0
+    period = int(1000000 / edges_per_second)
+    ticks = [(0xffff0000 + i * period) & 0xffffffff for i in range(iterations)]
+    cbf = monitor.cbf
+    gpio = args.rpm_pin
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    for tick in ticks:
+        cbf(gpio, 0, tick)
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    return {
+        'iterations': iterations,
+        'rpm': rpm,
+        'edges_per_second': edges_per_second,
+        'wall_ns_per_edge': wall / iterations * 1e9,
+        'cpu_ns_per_edge': cpu / iterations * 1e9,
+        # share of one cpu core used by the callback at this rpm
+        'cpu_load_percent': cpu / iterations * edges_per_second * 100.0,
+        'estimated_rpm': monitor.update(),
+    }
+
+# edges read in bulk from the notification pipe of the simulated backend
+def bench_rpm_notify(iterations, rpm):
+    args, backend = setup([])
+    monitor = daemon.rpm_monitor
+    monitor.start()
+    edges_per_second = rpm / 60.0 * 2.0
+    period = 1.0 / edges_per_second
+    # the reports of the rising and falling edges are queued before measuring
+    monitor._pipe.add_edges(iterations, backend.clock.now + iterations * period, period)
+    backend.clock.sleep(iterations * period)
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    edges = monitor.poll()
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    result = {
+        'iterations': iterations,
+        'rpm': rpm,
+        'edges_per_second': edges_per_second,
+        'edges': edges,
+        'wall_ns_per_edge': wall / iterations * 1e9,
+        'cpu_ns_per_edge': cpu / iterations * 1e9,
+        'cpu_load_percent': cpu / iterations * edges_per_second * 100.0,
+        'estimated_rpm': monitor.update(),
+    }
+    monitor.stop()
+    return result
+
+def bench_temp_to_speed(iterations):
+    setup([])
+    fsc = daemon.fsc
+    temps = [40.0 + (i % 3500) / 100.0 for i in range(iterations)]
+    def run():
+        for temp in temps:
+            fsc.temp_to_speed(temp)
+    result = measure(run, 1)
+    result['ns_per_call'] = result['cpu_us'] * 1000.0 / iterations
+    return result
+
+def bench_get_json(iterations):
+    setup([])
+    fsc = daemon.fsc
+    return measure(lambda: fsc.get_json(indent=0, ts=True), iterations)
+
+def bench_update_log(iterations):
+    fd, filename = tempfile.mkstemp(prefix='bench_fanspeed', suffix='.json')
+    os.close(fd)
+    try:
+        args, backend = setup(['--log=%s' % filename])
+        return measure(lambda: daemon.update_log(args), iterations)
+    finally:
+        os.unlink(filename)
+
+def bench_mqtt_publish(iterations):
+    args, backend = setup(['--mqtthost=localhost'])
+    client = StandInClient()
+    mqtt = daemon.MQTT(args.mqttuser, args.mqttpass, args.mqtthost, args.mqttport, 'bench', args.mqtttopic, client, update_rate=0, hass_autoconfig_prefix=args.mqtthass)
+    mqtt.connected = True
+    daemon.mqtt = mqtt
+    fsc = daemon.fsc
+    result = measure(lambda: mqtt.client_publish(fsc.get_temp(), fsc.get_speed()), iterations)
+    result['messages_per_call'] = client.messages / float(iterations)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description='raspi_fanspeed benchmarks')
+    parser.add_argument('-n', '--iterations', type=int, help='iterations per benchmark', default=2000)
+    parser.add_argument('-o', '--output', type=str, help='write results to this file', default=None)
+    args = parser.parse_args()
+
+    n = args.iterations
+    results = {
+        'version': VERSION,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'ts': int(time.time()),
+        'benchmarks': {
+            'loop_iteration': bench_loop_iteration(n, 1),
+            'rpm_callback_10000rpm': bench_rpm_callback(n * 20, 10000),
+            'rpm_notify_10000rpm': bench_rpm_notify(n * 20, 10000),
+            'temp_to_speed': bench_temp_to_speed(n * 20),
+            'get_json': bench_get_json(n),
+            'update_log': bench_update_log(n),
+            'mqtt_client_publish': bench_mqtt_publish(n),
+        }
+    }
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/python3
+
+# startup time of the command line
+#
+# each command is started as new process and the wall time until it exits is
+# measured. the informational commands must not import the daemon, pigpio or
+# paho-mqtt. the results are written as JSON to stdout or to the file passed
+# with --output
+#
+#   python3 benchmarks/bench_startup.py --output=startup-0.0.1.json
+
+import os
+import sys
+import time
+import json
+import argparse
+import platform
+import subprocess
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT_DIR, 'raspi_fanspeed.py')
+
+sys.path.insert(0, ROOT_DIR)
+
+from rpi_fanspeed import VERSION
+
+COMMANDS = {
+    'python': [sys.executable, '-c', 'pass'],
+    'version': [sys.executable, SCRIPT, '--version'],
+    'print_speed': [sys.executable, SCRIPT, '--print-speed'],
+    'list_sensors': [sys.executable, SCRIPT, '--list-sensors'],
+    'import_daemon': [sys.executable, '-c', 'import rpi_fanspeed.daemon'],
+}
+
+# modules that must not be loaded by the informational commands
+HEAVY_MODULES = ('rpi_fanspeed.daemon', 'asyncio', 'pigpio', 'paho.mqtt.client')
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def measure(cmd, iterations):
+    wall = []
+    for i in range(iterations):
+        t = time.perf_counter()
+        subprocess.run(cmd, cwd=ROOT_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        wall.append(time.perf_counter() - t)
+    return {
+        'iterations': iterations,
+        'wall_ms': {
+            'mean': sum(wall) / iterations * 1e3,
+            'p50': percentile(wall, 50) * 1e3,
+            'max': max(wall) * 1e3,
+        },
+    }
+
+# modules from HEAVY_MODULES loaded by the command line with argv
+def get_loaded_modules(argv):
+    code = 'import sys, runpy; sys.argv = %r\n' % ([SCRIPT] + argv)
+    code += 'try:\n    runpy.run_path(%r, run_name="__main__")\nexcept SystemExit:\n    pass\n' % SCRIPT
+    code += 'print("modules:" + ",".join(name for name in %r if name in sys.modules))\n' % (HEAVY_MODULES,)
+    result = subprocess.run([sys.executable, '-c', code], cwd=ROOT_DIR, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    for line in result.stdout.decode().splitlines():
+        if line.startswith('modules:'):
+            return [name for name in line[8:].split(',') if name]
+    return None
+
+def main():
+    parser = argparse.ArgumentParser(description='raspi_fanspeed startup benchmark')
+    parser.add_argument('-n', '--iterations', type=int, help='iterations per command', default=20)
+    parser.add_argument('-o', '--output', type=str, help='write results to this file', default=None)
+    args = parser.parse_args()
+
+    results = {
+        'version': VERSION,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'ts': int(time.time()),
+        'benchmarks': dict((name, measure(cmd, args.iterations)) for name, cmd in COMMANDS.items()),
+        'loaded_modules': {
+            'version': get_loaded_modules(['--version']),
+            'print_speed': get_loaded_modules(['--print-speed']),
+        }
+    }
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
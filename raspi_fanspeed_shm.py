@@ -0,0 +1,53 @@
+#!/usr/bin/python3
+
+# reads the status record of raspi_fanspeed --shm. the file is mapped once,
+# each read copies the values from the mapping without syscalls
+#
+#   raspi_fanspeed_shm /dev/shm/raspi_fanspeed
+#   raspi_fanspeed_shm /dev/shm/raspi_fanspeed --watch=0.5
+#
+# as module:
+#
+#   from raspi_fanspeed_shm import StatusReader
+#   reader = StatusReader('/dev/shm/raspi_fanspeed')
+#   status = reader.read()
+#   print(status['temperature'], status['duty_cycle'], status['rpm'])
+
+import sys
+import time
+import json
+import argparse
+
+sys.path.append('/usr/lib/raspi_fanspeed')
+
+from rpi_fanspeed.shm import StatusReader
+
+def main():
+    parser = argparse.ArgumentParser(description='read the status record of raspi_fanspeed --shm')
+    parser.add_argument('filename', nargs='?', help='status record', default='/dev/shm/raspi_fanspeed')
+    parser.add_argument('-w', '--watch', type=float, help='print the status every n seconds', default=0)
+    args = parser.parse_args()
+
+    try:
+        reader = StatusReader(args.filename)
+    except (OSError, ValueError) as e:
+        print('cannot open status record: %s' % e)
+        sys.exit(1)
+    last_seq = None
+    while True:
+        if not reader.get_pid():
+            print('raspi_fanspeed is not running')
+            sys.exit(1)
+        seq = reader.get_seq()
+        if seq!=last_seq:
+            last_seq = seq
+            print(json.dumps(reader.read()))
+        if args.watch<=0:
+            break
+        try:
+            time.sleep(args.watch)
+        except KeyboardInterrupt:
+            break
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,12 @@
+# adjustable fanspeed with temperature monitoring for the Raspberry Pi
+#
+# the package is split to keep the startup time of the command line short.
+# pigpio, paho-mqtt and the daemon are only imported if they are required
+
+VERSION = '0.0.1'
+MODEL = "RPi.fanspeed"
+MANUFACTURER = "KFCLabs"
+
+def main(argv=None):
+    from .cli import main
+    main(argv)
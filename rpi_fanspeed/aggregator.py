@@ -0,0 +1,290 @@
+# fleet aggregator. subscribes to the JSON state of all nodes and publishes a
+# small summary with the hottest nodes, stalled fans, stale nodes and
+# temperature percentiles
+#
+#   raspi_fanspeed aggregate -H mqtt.local --interval=10
+#
+# the state of each node is stored in arrays indexed by the node. the current
+# temperatures of the nodes are counted in a histogram with 0.1°C bins that is
+# updated with each message, the percentiles are read from the histogram. the
+# summary is created every --interval seconds from the arrays
+
+import sys
+import time
+import json
+import heapq
+import array
+import signal
+import socket
+import argparse
+import threading
+
+from . import VERSION
+
+TEMP_MIN = -40.0
+TEMP_RESOLUTION = 0.1
+TEMP_BINS = 2000
+
+def get_temp_bin(temp):
+    return min(TEMP_BINS - 1, max(0, int((temp - TEMP_MIN) / TEMP_RESOLUTION + 0.5)))
+
+# state of the nodes. a removed node is replaced by the last node
+class NodeTable(object):
+
+    def __init__(self):
+        self.index = {}
+        self.names = []
+        self.temperature = array.array('f')
+        self.duty_cycle = array.array('f')
+        self.rpm = array.array('I')
+        # monotonic time of the last message
+        self.last_seen = array.array('d')
+        # bin of the temperature in the histogram, -1 if the node is stale
+        self.bins = array.array('i')
+        self.histogram = array.array('I', [0]) * TEMP_BINS
+        # nodes in the histogram
+        self.count = 0
+        # names of the stalled fans of each node. nodes without stalled fans
+        # are not stored
+        self.stalled = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, name):
+        i = len(self.names)
+        self.index[name] = i
+        self.names.append(name)
+        self.temperature.append(0.0)
+        self.duty_cycle.append(0.0)
+        self.rpm.append(0)
+        self.last_seen.append(0.0)
+        self.bins.append(-1)
+        return i
+
+    def update(self, name, temp, duty_cycle, rpm, stalled, now):
+        i = self.index.get(name)
+        if i==None:
+            i = self.add(name)
+        self.temperature[i] = temp
+        self.duty_cycle[i] = duty_cycle
+        self.rpm[i] = rpm
+        self.last_seen[i] = now
+        if stalled:
+            self.stalled[name] = stalled
+        elif name in self.stalled:
+            del self.stalled[name]
+        index = get_temp_bin(temp)
+        old = self.bins[i]
+        if old!=index:
+            if old>=0:
+                self.histogram[old] -= 1
+            else:
+                self.count += 1
+            self.histogram[index] += 1
+            self.bins[i] = index
+
+    # remove the temperature of a stale node from the histogram
+    def set_stale(self, i):
+        if self.bins[i]>=0:
+            self.histogram[self.bins[i]] -= 1
+            self.count -= 1
+            self.bins[i] = -1
+
+    def remove(self, name):
+        i = self.index.pop(name, None)
+        if i==None:
+            return
+        self.set_stale(i)
+        self.stalled.pop(name, None)
+        last = len(self.names) - 1
+        if i!=last:
+            self.names[i] = self.names[last]
+            self.index[self.names[i]] = i
+            for values in (self.temperature, self.duty_cycle, self.rpm, self.last_seen, self.bins):
+                values[i] = values[last]
+        for values in (self.names, self.temperature, self.duty_cycle, self.rpm, self.last_seen, self.bins):
+            values.pop()
+
+    # temperatures of the nodes in the histogram for a sorted list of
+    # percentiles
+    def get_percentiles(self, percentiles):
+        results = []
+        if not self.count:
+            return [None] * len(percentiles)
+        targets = [max(1, int(self.count * p / 100.0 + 0.999999)) for p in percentiles]
+        total = 0
+        pos = 0
+        for index, count in enumerate(self.histogram):
+            if not count:
+                continue
+            total += count
+            while pos<len(targets) and total>=targets[pos]:
+                results.append(round(TEMP_MIN + index * TEMP_RESOLUTION, 1))
+                pos += 1
+            if pos==len(targets):
+                break
+        return results
+
+class Aggregator(object):
+
+    def __init__(self, client, topic, summary_topic, qos=0, stale_timeout=180, expire=86400, top=10, percentiles=(50, 90, 99), monotonic=time.monotonic):
+        self.client = client
+        # the device name is read from the topic between prefix and suffix
+        self.prefix, self.suffix = topic.format(device_name='\0', entity='RPi.fanspeed/json').split('\0')
+        self.subscription = self.prefix + '+' + self.suffix
+        self.summary_topic = summary_topic
+        self.qos = qos
+        self.stale_timeout = stale_timeout
+        self.expire = expire
+        self.top = top
+        self.percentiles = sorted(percentiles)
+        self.monotonic = monotonic
+        self.nodes = NodeTable()
+        self.lock = threading.Lock()
+        self.messages = 0
+        self.errors = 0
+        self._last_summary = None
+
+    def on_connect(self, client, userdata, flags, rc):
+        if rc==0:
+            client.subscribe(self.subscription, qos=self.qos)
+
+    def on_message(self, client, userdata, msg):
+        topic = msg.topic
+        if not topic.startswith(self.prefix) or not topic.endswith(self.suffix):
+            return
+        name = topic[len(self.prefix):len(topic) - len(self.suffix)]
+        # an empty retained message removes the node
+        if not msg.payload:
+            with self.lock:
+                self.nodes.remove(name)
+            return
+        try:
+            data = json.loads(msg.payload)
+            temp = float(data['temperature'])
+            duty_cycle = float(data['duty_cycle'])
+            rpm = int(data['rpm'])
+            if 'fans' in data:
+                stalled = tuple('%s/%s' % (name, fan) for fan, values in data['fans'].items() if values.get('stalled'))
+            else:
+                stalled = data.get('stalled') and (name,) or ()
+        except (ValueError, KeyError, TypeError, AttributeError):
+            self.errors += 1
+            return
+        now = self.monotonic()
+        with self.lock:
+            self.messages += 1
+            self.nodes.update(name, temp, duty_cycle, rpm, stalled, now)
+
+    def get_summary(self):
+        now = self.monotonic()
+        with self.lock:
+            nodes = self.nodes
+            stale = []
+            expired = []
+            live = []
+            total = 0.0
+            for i, last_seen in enumerate(nodes.last_seen):
+                age = now - last_seen
+                if age>=self.stale_timeout:
+                    nodes.set_stale(i)
+                    if age>=self.expire:
+                        expired.append(nodes.names[i])
+                    else:
+                        stale.append((age, nodes.names[i]))
+                else:
+                    live.append(i)
+                    total += nodes.temperature[i]
+            temperature = nodes.temperature
+            hottest = heapq.nlargest(self.top, live, key=temperature.__getitem__)
+            max_temp = hottest and round(temperature[hottest[0]], 2) or None
+            hottest = [[nodes.names[i], round(temperature[i], 2), round(nodes.duty_cycle[i], 2), nodes.rpm[i]] for i in hottest]
+            # removing a node moves the last node to its index
+            for name in expired:
+                nodes.remove(name)
+            stalled = sorted(name for fans in nodes.stalled.values() for name in fans)
+            percentiles = nodes.get_percentiles(self.percentiles)
+            messages = self.messages
+            summary = {
+                'ts': int(time.time()),
+                'nodes': len(live),
+                'stale': len(stale),
+                'stalled': len(stalled),
+                'temperature': {
+                    'mean': live and round(total / len(live), 2) or None,
+                    'max': max_temp,
+                },
+                'hottest': hottest,
+                'stalled_fans': stalled[0:self.top],
+                'stale_nodes': [name for age, name in sorted(stale)[0:self.top]],
+                'errors': self.errors,
+            }
+        for p, value in zip(self.percentiles, percentiles):
+            summary['temperature']['p%g' % p] = value
+        # messages per second since the last summary
+        rate = None
+        if self._last_summary!=None and now>self._last_summary[0]:
+            rate = round((messages - self._last_summary[1]) / (now - self._last_summary[0]), 1)
+        summary['messages'] = rate
+        self._last_summary = (now, messages)
+        return summary
+
+    def publish_summary(self):
+        summary = self.get_summary()
+        payload = json.dumps(summary, separators=(',', ':'))
+        self.client.publish(self.summary_topic, payload, retain=True, qos=self.qos)
+        return summary
+
+def create_parser():
+    parser = argparse.ArgumentParser(prog='raspi_fanspeed aggregate', description='subscribe to the state of all nodes and publish a fleet summary')
+    parser.add_argument('-H', '--mqtthost', type=str, help='mqtt server', required=True)
+    parser.add_argument('-P', '--mqttport', type=int, default=1883)
+    parser.add_argument('--mqttuser', type=str, default=None)
+    parser.add_argument('--mqttpass', type=str, default='')
+    parser.add_argument('--mqtttopic', type=str, default='home/{device_name}/{entity}', help='topic of the nodes. the device name is replaced with a wildcard')
+    parser.add_argument('--name', type=str, default='fleet', help='device name of the summary topic')
+    parser.add_argument('--qos', type=int, choices=(0, 1, 2), default=0, help='qos of the subscription and the summary')
+    parser.add_argument('-i', '--interval', type=float, default=10.0, help='summary interval in seconds')
+    parser.add_argument('--stale', type=float, default=180.0, help='nodes without a message for n seconds are stale')
+    parser.add_argument('--expire', type=float, default=86400.0, help='remove nodes without a message for n seconds')
+    parser.add_argument('--top', type=int, default=10, help='number of hottest, stalled and stale nodes in the summary')
+    parser.add_argument('--percentiles', type=str, default='50,90,99', help='comma separated temperature percentiles')
+    parser.add_argument('-v', '--verbose', action='store_true', default=False)
+    return parser
+
+def main(argv=None):
+    args = create_parser().parse_args(argv)
+    try:
+        percentiles = [float(value) for value in args.percentiles.split(',')]
+    except ValueError:
+        print('invalid --percentiles %s' % args.percentiles)
+        sys.exit(1)
+
+    try:
+        import paho.mqtt.client
+    except ImportError:
+        print('aggregate requires paho-mqtt')
+        sys.exit(1)
+    client = paho.mqtt.client.Client(client_id='raspi_fanspeed_aggregate_%s' % socket.gethostname(), clean_session=True)
+    summary_topic = args.mqtttopic.format(device_name=args.name, entity='RPi.fanspeed/summary')
+    aggregator = Aggregator(client, args.mqtttopic, summary_topic, qos=args.qos, stale_timeout=args.stale, expire=args.expire, top=args.top, percentiles=percentiles)
+    if args.mqttuser:
+        client.username_pw_set(args.mqttuser, password=args.mqttpass)
+    client.on_connect = aggregator.on_connect
+    client.on_message = aggregator.on_message
+    client.reconnect_delay_set(min_delay=5, max_delay=60)
+    client.connect(args.mqtthost, port=args.mqttport, keepalive=15)
+    client.loop_start()
+
+    exit_event = threading.Event()
+    signal.signal(signal.SIGINT, lambda sig, frame: exit_event.set())
+    signal.signal(signal.SIGTERM, lambda sig, frame: exit_event.set())
+    if args.verbose:
+        print('RPi.fanspeed %s aggregator, subscribed to %s, summary %s' % (VERSION, aggregator.subscription, summary_topic))
+    while not exit_event.wait(args.interval):
+        summary = aggregator.publish_summary()
+        if args.verbose:
+            print(json.dumps(summary))
+    client.disconnect()
+    client.loop_stop()
@@ -0,0 +1,111 @@
+# duty cycle to rpm model of a fan, created by --calibrate and stored in a
+# state file
+
+import os
+import os.path
+import json
+import time
+
+# least squares fit of a polynomial. returns the coefficients, lowest degree
+# first. numpy is imported here, the daemon imports this module on each start
+def fit_polynomial(points, degree=2):
+    degree = min(degree, len(points) - 1)
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+    if numpy!=None:
+        x = numpy.array([float(x) for x, y in points])
+        y = numpy.array([float(y) for x, y in points])
+        return [float(value) for value in numpy.polyfit(x, y, degree)[::-1]]
+    # normal equations solved with gaussian elimination
+    n = degree + 1
+    matrix = [[0.0] * (n + 1) for i in range(n)]
+    for x, y in points:
+        powers = [pow(float(x), i) for i in range(2 * n - 1)]
+        for i in range(n):
+            for j in range(n):
+                matrix[i][j] += powers[i + j]
+            matrix[i][n] += powers[i] * y
+    for i in range(n):
+        pivot = max(range(i, n), key=lambda row: abs(matrix[row][i]))
+        matrix[i], matrix[pivot] = matrix[pivot], matrix[i]
+        if matrix[i][i]==0:
+            raise ValueError('cannot fit %u points with degree %u' % (len(points), degree))
+        for row in range(n):
+            if row!=i:
+                factor = matrix[row][i] / matrix[i][i]
+                for col in range(i, n + 1):
+                    matrix[row][col] -= factor * matrix[i][col]
+    return [matrix[i][n] / matrix[i][i] for i in range(n)]
+
+class FanCalibration(object):
+
+    def __init__(self, start_duty, stop_duty, coefficients, points=None, ts=None):
+        # min. duty cycle to start a stopped fan
+        self.start_duty = start_duty
+        # the fan stops below this duty cycle
+        self.stop_duty = stop_duty
+        self.coefficients = coefficients
+        self.points = points or []
+        self.ts = ts
+
+    @staticmethod
+    def from_points(points, start_duty, stop_duty, degree=2):
+        running = [(duty, rpm) for duty, rpm in points if rpm>0]
+        points = sorted((duty, round(rpm, 1)) for duty, rpm in points)
+        return FanCalibration(start_duty, stop_duty, fit_polynomial(running, degree), points, int(time.time()))
+
+    @staticmethod
+    def from_dict(data):
+        return FanCalibration(data['start_duty'], data['stop_duty'], data['coefficients'], data.get('points'), data.get('ts'))
+
+    def to_dict(self):
+        return {
+            'start_duty': self.start_duty,
+            'stop_duty': self.stop_duty,
+            'coefficients': self.coefficients,
+            'points': self.points,
+            'ts': self.ts,
+        }
+
+    def expected_rpm(self, duty):
+        if duty<self.stop_duty:
+            return 0.0
+        rpm = 0.0
+        for i, value in enumerate(self.coefficients):
+            rpm += value * pow(duty, i)
+        return max(0.0, rpm)
+
+    # clamp a duty cycle above 0 to the usable range. a stopped fan gets at
+    # least start_duty
+    def clamp(self, duty, running):
+        if duty<=0:
+            return 0
+        if not running:
+            return max(duty, self.start_duty)
+        return max(duty, self.stop_duty)
+
+# state file with the calibration of each fan
+def load_calibration(filename, key):
+    if not filename or not os.path.exists(filename):
+        return None
+    with open(filename, 'r') as f:
+        data = json.loads(f.read())
+    if key not in data:
+        return None
+    return FanCalibration.from_dict(data[key])
+
+def save_calibration(filename, key, calibration):
+    data = {}
+    if os.path.exists(filename):
+        with open(filename, 'r') as f:
+            data = json.loads(f.read())
+    data[key] = calibration.to_dict()
+    dirname = os.path.dirname(filename)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    tmp_file = filename + '.tmp'
+    with open(tmp_file, 'w') as f:
+        f.write(json.dumps(data, indent=2))
+    os.replace(tmp_file, filename)
@@ -0,0 +1,232 @@
+# command line interface. --version, --print-speed and --list-sensors are
+# handled here without importing the daemon, connecting to pigpiod or the
+# MQTT server
+
+import sys
+import re
+import argparse
+import json
+import socket
+
+from . import VERSION, MODEL
+from .curve import parse_curve, create_curve
+
+FAN_NAME = re.compile(r'^[A-Za-z0-9_]+$')
+
+# options of an additional fan channel
+FAN_OPTIONS = {
+    'pin': int,
+    'rpm_pin': int,
+    'curve': parse_curve,
+    'min': float,
+    'max': float,
+    'lin': float,
+    'min_fan': float,
+    'sensors': str,
+    'sensor_mode': str,
+    'stall_timeout': float,
+    'mode': str,
+    'pid_target': float,
+}
+
+# parse fan channel "name;pin=13;rpm_pin=6;curve=40:30,70:100;..."
+def parse_fan(value):
+    parts = value.split(';')
+    fan = {'name': parts[0].strip()}
+    if not FAN_NAME.match(fan['name']):
+        raise argparse.ArgumentTypeError('invalid fan name %s, expected name;pin=n;rpm_pin=n;...' % fan['name'])
+    for part in parts[1:]:
+        if '=' not in part:
+            raise argparse.ArgumentTypeError('invalid fan option %s, expected key=value' % part)
+        key, item = part.split('=', 1)
+        key = key.strip().replace('-', '_')
+        if key not in FAN_OPTIONS:
+            raise argparse.ArgumentTypeError('invalid fan option %s. valid options: %s' % (key, ', '.join(FAN_OPTIONS)))
+        try:
+            fan[key] = FAN_OPTIONS[key](item.strip())
+        except ValueError:
+            raise argparse.ArgumentTypeError('invalid value for fan option %s: %s' % (key, item))
+    for key in ('pin', 'rpm_pin'):
+        if key not in fan:
+            raise argparse.ArgumentTypeError('fan %s requires %s' % (fan['name'], key))
+    if fan.get('mode', 'curve') not in ('curve', 'pid'):
+        raise argparse.ArgumentTypeError('invalid mode %s' % fan['mode'])
+    if fan.get('sensor_mode', 'max') not in ('max', 'mean', 'curve'):
+        raise argparse.ArgumentTypeError('invalid sensor mode %s' % fan['sensor_mode'])
+    return fan
+
+# hours of history. the 1 second level needs at least one bucket
+def parse_history(value):
+    try:
+        hours = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid history %s' % value)
+    if hours!=0 and hours * 3600<1:
+        raise argparse.ArgumentTypeError('history requires 0 or at least 1 second (%.6f hours)' % (1 / 3600.0))
+    return hours
+
+def get_hostname():
+    hostname = socket.gethostname()
+    if hostname.startswith('localhost'):
+        hostname = '%s.%s' % (MODEL, hostname)
+    return hostname
+
+def create_parser(hostname):
+    parser = argparse.ArgumentParser(description='adjustable fanspeed with temperature monitoring', epilog='"raspi_fanspeed tune -h" and "raspi_fanspeed aggregate -h" show the options of the offline curve tuner and the fleet aggregator')
+    parser.add_argument('-i', '--interval', help='fan speed update interval in seconds', type=int, default=10)
+    parser.add_argument('--adaptive', action='store_true', help='adjust the update interval to the temperature slope between --min-interval and --max-interval', default=False)
+    parser.add_argument('--min-interval', type=float, help='minimum interval for --adaptive in seconds', default=1.0)
+    parser.add_argument('--max-interval', type=float, help='maximum interval for --adaptive if the fan is off in seconds', default=60.0)
+    parser.add_argument('--set', type=float, help='set speed in %%', default=None)
+    parser.add_argument('--measure', type=float, help='measure rpm for n seconds and exit', default=None)
+    parser.add_argument('--calibrate', action='store_true', help='measure the rpm of each fan at different duty cycles, store the model in --calibration-file and exit', default=False)
+    parser.add_argument('--calibration-file', type=str, help='state file with the calibration of the fans. the duty cycle is clamped to the range where the fan is spinning', default='/var/lib/raspi_fanspeed/calibration.json')
+    parser.add_argument('--calibrate-step', type=float, help='duty cycle step of the calibration in %%', default=5.0)
+    parser.add_argument('--calibrate-settle', type=float, help='seconds to wait for the fan speed to settle after changing the duty cycle', default=5.0)
+    parser.add_argument('--min', type=float, help='minimum temperature to turn on fan in \u00b0C', default=45)
+    parser.add_argument('--max', type=float, help='maximum fan speed if temperature exceeds this value', default=70)
+    parser.add_argument('--lin', type=float, help='temperature/duty cycle factor. 1.0 = linear', default=1.0)
+    parser.add_argument('--min-fan', type=float, help='minimum fan speed in %%', default=40)
+    parser.add_argument('--curve', type=parse_curve, help='piecewise linear fan curve, overrides --min, --max, --lin and --min-fan i.e. --curve=45:30,60:50,70:100', default=None)
+    parser.add_argument('--mode', choices=['curve', 'pid'], help='duty cycle from the fan curve or a PID controller with cpu load feed-forward', default='curve')
+    parser.add_argument('--pid-target', type=float, help='target temperature for --mode=pid in \u00b0C', default=55.0)
+    parser.add_argument('--pid-kp', type=float, help='proportional gain in %% per \u00b0C', default=5.0)
+    parser.add_argument('--pid-ki', type=float, help='integral gain in %% per \u00b0C and second', default=0.05)
+    parser.add_argument('--pid-kd', type=float, help='derivative gain in %% per \u00b0C/s', default=0.0)
+    parser.add_argument('--feed-forward', type=float, help='duty cycle added at 100%% cpu load for --mode=pid', default=30.0)
+    parser.add_argument('--loadavg', action='store_true', help='use the 1 minute load average for the feed-forward if it is higher than the cpu utilisation', default=False)
+    parser.add_argument('--sensors', type=str, help='comma separated list of temperature sensors or sysfs files, "all" for all sensors. see --list-sensors', default='thermal_zone0')
+    parser.add_argument('--sensor-mode', choices=['max', 'mean', 'curve'], help='combine sensors by highest temperature, weighted mean or highest duty cycle of the sensor curves', default='max')
+    parser.add_argument('--sensor-weight', type=str, help='weights for --sensor-mode=mean i.e. thermal_zone0=2,nvme_temp1=1', default=None)
+    parser.add_argument('--sensor-curve', type=str, action='append', help='fan curve for a sensor with --sensor-mode=curve i.e. nvme_temp1=40:30,70:100. sensors without curve use the default curve', default=None)
+    parser.add_argument('--list-sensors', action='store_true', help='print available temperature sensors and exit', default=False)
+    parser.add_argument('--deadband', type=float, help='minimum change of the duty cycle in %% before the PWM is updated', default=1.0)
+    parser.add_argument('--hysteresis', type=float, help='temperature drop in \u00b0C required to lower the fan speed', default=1.0)
+    parser.add_argument('-p', '--pin', type=int, choices=[12, 13, 18, 19], help='fan PWM pin. must be capable of hardware PWM', default=19)
+    parser.add_argument('--rpm-pin', type=int, help='read RPM signal from pin', default=16)
+    parser.add_argument('--fan-name', type=str, help='name of the fan on --pin if more than one fan is used', default='fan0')
+    parser.add_argument('--fan', type=parse_fan, action='append', help='additional fan with its own pins, curve and sensors i.e. "exhaust;pin=13;rpm_pin=6;curve=40:30,70:100;sensors=nvme_temp1;stall_timeout=10". options: %s' % ', '.join(FAN_OPTIONS), default=None)
+    parser.add_argument('--stall-timeout', type=float, help='seconds without rpm signal after starting a fan until it is considered stalled. 0 disables stall detection', default=7.5)
+    parser.add_argument('--tach-timeout', type=float, help='edge periods without tach signal until the watchdog detects a stall of a running fan. the period is calculated from the expected or last measured rpm. 0 disables the watchdog', default=10.0)
+    parser.add_argument('--tach-min-timeout', type=float, help='minimum timeout of the tach watchdog in seconds', default=0.5)
+    parser.add_argument('--tach-holdoff', type=float, help='seconds the tach edges of a running fan are left in the notification pipe before they are read. a stall is detected within the watchdog timeout and the hold-off', default=1.0)
+    parser.add_argument('--failover-speed', type=float, help='speed in %% of a stalled fan', default=100.0)
+    parser.add_argument('--restart-pulses', type=int, help='number of attempts to restart a stalled fan by turning it off for a second', default=3)
+    parser.add_argument('--restart-interval', type=float, help='seconds between the restart attempts', default=10.0)
+    parser.add_argument('--rpm-estimator', choices=['period', 'count'], help='calculate rpm from the period of the last edges or count edges in a fixed window', default='period')
+    parser.add_argument('--edge-source', choices=['auto', 'callback'], help='read the tach edges in bulk from the pigpiod notification pipe if pigpiod runs on the local host, or use a callback for each edge', default='auto')
+    parser.add_argument('-f', '--frequency', type=int, help='PWM frequency', default=32000)
+    parser.add_argument('-S', '--print-speed', action='store_true', help='Print fan speed table and exit', default=False)
+    parser.add_argument('-E', '--onexit-speed', type=float, help='turn fan to 30-100%% when exiting. -1 disable fan on exit', default=75)
+    parser.add_argument('--mqttuser', type=str, default=None, help="use phyton mqtt client to connect to MQTT")
+    parser.add_argument('--mqttpass', type=str, default='')
+    parser.add_argument('--mqttdevicename', type=str, default=hostname, help='mqtt device name')
+    parser.add_argument('--mqtttopic', type=str, default='home/{device_name}/{entity}')
+    parser.add_argument('--mqtthass', type=str, default='homeassistant')
+    parser.add_argument('--mqtthasscache', type=str, default=None, help='store the homeassistant auto discovery in this file. it is only published again if the configuration changes or homeassistant comes online')
+    parser.add_argument('--mqttupdateinterval', type=int, default=60, help="mqtt update interval (30-900 seconds). the state is published earlier if a value changes more than the deadband")
+    parser.add_argument('--mqttqos', type=int, choices=(0, 1, 2), default=0, help='qos of the state topic')
+    parser.add_argument('--mqttstatusqos', type=int, choices=(0, 1, 2), default=1, help='qos of the status topic and last will')
+    parser.add_argument('--mqtthassqos', type=int, choices=(0, 1, 2), default=1, help='qos of the homeassistant auto discovery')
+    parser.add_argument('--mqttdeadband', type=float, default=1.0, help='publish the state if the temperature changes by n°C')
+    parser.add_argument('--mqttspeeddeadband', type=float, default=2.0, help='publish the state if the duty cycle changes by n%%')
+    parser.add_argument('--mqttrpmdeadband', type=float, default=250, help='publish the state if the rpm changes by n')
+    parser.add_argument('--mqttqueue', type=int, default=32, help='max. number of messages queued while disconnected')
+    parser.add_argument('-H', '--mqtthost', type=str, default=None)
+    parser.add_argument('-P', '--mqttport', type=int, default=1883)
+    parser.add_argument('-L', '--log', type=str, help='write temperature and speed to this file i.e. --log=/var/log/tempmon.json', default=None)
+    parser.add_argument('--series', type=str, help='append temperature, speed and rpm to this NDJSON file i.e. --series=/var/log/raspi_fanspeed.ndjson', default=None)
+    parser.add_argument('--series-flush', type=int, help='write buffered samples every n seconds', default=300)
+    parser.add_argument('--series-batch', type=int, help='write buffered samples after n samples', default=100)
+    parser.add_argument('--series-max-size', type=float, help='rotate the series file after n MB', default=16)
+    parser.add_argument('--series-rotate', type=float, help='rotate the series file after n hours', default=24)
+    parser.add_argument('--series-keep', type=int, help='number of rotated series files to keep', default=7)
+    parser.add_argument('--series-compress', action='store_true', help='compress rotated series files with gzip', default=False)
+    parser.add_argument('--history', type=parse_history, help='keep n hours of samples with 1 second resolution in memory. 0 disables the history', default=24)
+    parser.add_argument('--profile', type=str, help='write cProfile and tracemalloc snapshots to this directory on SIGUSR1 and at exit', default=None, metavar='DIR')
+    parser.add_argument('--status-socket', type=str, help='serve the status with HTTP on this unix socket', default=None)
+    parser.add_argument('--status-port', type=int, help='serve the status with HTTP on this TCP port. 0 disables it', default=0)
+    parser.add_argument('--status-bind', type=str, help='address for --status-port', default='127.0.0.1')
+    parser.add_argument('--shm', type=str, help='keep the current values in a memory mapped status record i.e. --shm=/dev/shm/raspi_fanspeed', default=None)
+    parser.add_argument('--log-interval', type=int, help='log update interval in seconds. default is --interval', default=None)
+    parser.add_argument('-V', '--version', action='store_true', default=False)
+    parser.add_argument('-v', '--verbose', action='store_true', default=False)
+    parser.add_argument('--pid', type=str, default=None)
+    parser.add_argument('--simulate', action='store_true', help='use the simulated fan and temperature instead of GPIO and sysfs', default=False)
+    parser.add_argument('--sim-duration', type=float, help='stop simulation after n seconds of simulated time', default=0)
+    parser.add_argument('--sim-ambient', type=float, help='simulated ambient temperature in \u00b0C', default=25.0)
+    parser.add_argument('--sim-load', type=str, help='simulated cpu load 0.0-1.0 or "daily" for a varying load profile', default='daily')
+    parser.add_argument('--sim-stall', type=float, help='simulate a stalled fan after n seconds', default=None)
+    return parser
+
+def print_speed_table(args):
+    curve = create_curve(args)
+    i = 30
+    j = -1
+    json_output = {}
+    while i<=90:
+        n = curve.get_speed(i)
+        # i += incr
+        key = '%03.1f%%' % float(n)
+        if key not in json_output:
+            json_output[key] = '%.1f\u00b0C' % i
+        i += 1
+
+
+    if args.print_speed:
+        indent = 2
+        separators = (', ', ': ')
+    else:
+        indent = None
+        separators = (',', ':')
+
+    # if args.json:
+    print(json.dumps(json_output, indent=indent, separators=separators, ensure_ascii=not sys.getdefaultencoding().startswith('utf') and '<stdin>' in sys.stdin.name))
+    # else:
+    #     for key, val in json_output.items():
+    #         print('%s: %s' % (key, val))
+
+def list_sensors(args):
+    if args.simulate:
+        from .daemon import create_backend
+        sensors = create_backend(args).discover_sensors()
+    else:
+        from .sensors import discover_sensors
+        sensors = discover_sensors()
+    for sensor in sensors:
+        try:
+            print('%s: %.2f\u00b0C %s' % (sensor.name, sensor.read(), sensor.path))
+        except Exception as e:
+            print('%s: %s %s' % (sensor.name, e, sensor.path))
+        sensor.close()
+
+def main(argv=None):
+    if argv==None:
+        argv = sys.argv[1:]
+    # subcommands with their own arguments
+    if argv and argv[0]=='tune':
+        from . import tune
+        tune.main(argv[1:])
+        sys.exit(0)
+    if argv and argv[0]=='aggregate':
+        from . import aggregator
+        aggregator.main(argv[1:])
+        sys.exit(0)
+
+    hostname = get_hostname()
+    args = create_parser(hostname).parse_args(argv)
+
+    if args.version:
+        print("RPi.fanspeed version %s" % VERSION)
+        sys.exit(0)
+
+    if args.print_speed:
+        print_speed_table(args)
+        sys.exit(0)
+
+    if args.list_sensors:
+        list_sensors(args)
+        sys.exit(0)
+
+    from . import daemon
+    daemon.main(args, hostname)
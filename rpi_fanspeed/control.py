@@ -0,0 +1,90 @@
+# PID control with cpu load feed-forward
+
+import os
+
+# PID controller around a target temperature. the output is the duty cycle in
+# percent. feed_forward is added at 100% cpu load, which starts the fan before
+# the temperature rises
+class PIDController(object):
+
+    def __init__(self, target, kp, ki, kd, feed_forward, min_fan, max_output=100.0):
+        self.target = target
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.feed_forward = feed_forward
+        self.min_fan = min_fan
+        self.max_output = max_output
+        self.integral = 0.0
+        self.output = 0.0
+        self.raw_output = 0.0
+        self._last = None
+
+    def reset(self):
+        self.integral = 0.0
+        self._last = None
+
+    def update(self, temp, load, now):
+        error = temp - self.target
+        derivative = 0.0
+        dt = 0.0
+        if self._last!=None:
+            dt = now - self._last[1]
+            if dt>0:
+                # derivative of the measurement to avoid a kick if the target changes
+                derivative = (temp - self._last[0]) / dt
+        self._last = (temp, now)
+
+        output = self.kp * error + self.integral + self.kd * derivative + self.feed_forward * load
+        # anti-windup: stop integrating while the output is saturated in the
+        # direction of the error
+        saturated = (output>=self.max_output and error>0) or (output<=0 and error<0)
+        if dt>0 and not saturated:
+            self.integral += self.ki * error * dt
+            self.integral = min(self.max_output, max(-self.max_output, self.integral))
+            output = self.kp * error + self.integral + self.kd * derivative + self.feed_forward * load
+        self.raw_output = output
+
+        # the fan is turned on with min_fan if the output reaches half of
+        # min_fan and turned off if the output drops to 0
+        if output<=0 or (self.output==0 and output<self.min_fan / 2.0):
+            self.output = 0.0
+        else:
+            self.output = min(self.max_output, max(self.min_fan, output))
+        return self.output
+
+# cpu utilisation from /proc/stat since the last reading. with loadavg the
+# 1 minute load average per cpu is used if it is higher. readings within
+# min_interval seconds return the previous value, which allows to share the
+# source between fans
+class CpuLoad(object):
+
+    def __init__(self, loadavg=False, stat='/proc/stat', loadavg_file='/proc/loadavg', min_interval=1.0):
+        self.loadavg = loadavg
+        self.stat = stat
+        self.loadavg_file = loadavg_file
+        self.cpus = os.cpu_count() or 1
+        self.min_interval = min_interval
+        self.load = 0.0
+        self._last = None
+        self._last_read = None
+
+    def read_stat(self):
+        with open(self.stat, 'r') as f:
+            values = [int(value) for value in f.readline().split()[1:]]
+        # idle and iowait
+        idle = values[3] + (len(values)>4 and values[4] or 0)
+        return sum(values), idle
+
+    def read(self, now):
+        if self._last_read!=None and now - self._last_read<self.min_interval:
+            return self.load
+        self._last_read = now
+        total, idle = self.read_stat()
+        if self._last!=None and total>self._last[0]:
+            self.load = 1.0 - (idle - self._last[1]) / float(total - self._last[0])
+        self._last = (total, idle)
+        if self.loadavg:
+            with open(self.loadavg_file, 'r') as f:
+                self.load = max(self.load, min(1.0, float(f.readline().split()[0]) / self.cpus))
+        return min(1.0, max(0.0, self.load))
@@ -0,0 +1,126 @@
+# fan curves and the adaptive polling interval
+
+import math
+import argparse
+import array
+
+# temperature to duty cycle table with 0.01°C resolution. the duty cycle
+# is stored in 0.01% steps
+class FanCurve(object):
+
+    STEPS = 100
+    # the table ends at the temperature limit of the SoC
+    MAX_TEMP = 125.0
+
+    def __init__(self, func, min_temp, max_temp, breakpoints=None):
+        self.min_temp = min_temp
+        self.max_temp = max_temp
+        # temperatures where the slope of the curve changes
+        self.breakpoints = breakpoints or [min_temp, max_temp]
+        # the last step is at or above max_temp
+        size = int(math.ceil((max_temp - min_temp) * self.STEPS - 1e-6)) + 1
+        table = array.array('H', [0] * size)
+        for i in range(size):
+            speed = func(min_temp + i / float(self.STEPS))
+            table[i] = int(round(min(100.0, max(0.0, speed)) * 100))
+        self.table = table
+        self.size = size
+
+    # the fan is turned on with min_fan at min_temp and the duty cycle
+    # increases to 100% at max_temp. lin = 1.0 is linear
+    @staticmethod
+    def from_linear(min_temp, max_temp, lin, min_fan):
+        if max_temp<=min_temp:
+            return FanCurve(lambda temp: 100.0, min_temp, min_temp)
+        def func(temp):
+            speed = pow(temp - min_temp, lin) / (max_temp - min_temp) * 100
+            return (speed * (1.0 - min_fan / 100.0)) + min_fan
+        # the duty cycle of the curve might reach 100% before or after max_temp
+        end = min_temp + pow(max_temp - min_temp, 1.0 / lin)
+        return FanCurve(func, min_temp, max(min_temp, min(end, FanCurve.MAX_TEMP)))
+
+    # piecewise linear curve from a list of (temperature, duty cycle) points
+    @staticmethod
+    def from_points(points):
+        points = sorted(points)
+        def func(temp):
+            for i in range(1, len(points)):
+                t1, s1 = points[i]
+                if temp<=t1:
+                    t0, s0 = points[i - 1]
+                    if t1==t0:
+                        return s1
+                    return s0 + (s1 - s0) * (temp - t0) / (t1 - t0)
+            return points[-1][1]
+        return FanCurve(func, points[0][0], points[-1][0], [temp for temp, speed in points])
+
+    def get_speed(self, temp):
+        if temp<self.min_temp:
+            return 0.0
+        i = int((temp - self.min_temp) * self.STEPS + 0.5)
+        if i>=self.size:
+            i = self.size - 1
+        return self.table[i] / 100.0
+
+# polling interval that depends on the temperature slope. the interval is
+# short if the temperature changes quickly or is close to a curve breakpoint
+# and increases up to max_interval if the temperature is stable and the fan
+# is off
+class AdaptiveInterval(object):
+
+    def __init__(self, interval, min_interval, max_interval, step=0.5):
+        # max. interval while the fan is on
+        self.fan_interval = interval
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        # temperature change that is expected until the next reading
+        self.step = step
+        # the slope is calculated from readings that are at least slope_time
+        # seconds or step apart to filter sensor noise
+        self.slope_time = 10.0
+        self.slope = 0.0
+        self.smoothing = 0.5
+        self._ref = None
+
+    def update(self, temp, now, speed, breakpoints):
+        if self._ref==None:
+            self._ref = (temp, now)
+        else:
+            diff = temp - self._ref[0]
+            dt = now - self._ref[1]
+            if dt>0 and (dt>=self.slope_time or abs(diff)>=self.step):
+                self.slope += (diff / dt - self.slope) * self.smoothing
+                self._ref = (temp, now)
+
+        upper = speed>0 and max(self.min_interval, min(self.fan_interval, self.max_interval)) or self.max_interval
+        slope = max(abs(self.slope), 1e-6)
+        # time until the temperature moved by step or reached the next breakpoint
+        interval = self.step / slope
+        for breakpoint in breakpoints:
+            distance = breakpoint - temp
+            if distance * self.slope>0:
+                interval = min(interval, abs(distance) / slope)
+        self.interval = max(self.min_interval, min(upper, interval))
+        return self.interval
+
+# parse curve points "temp:duty,temp:duty,..."
+def parse_curve(value):
+    points = []
+    try:
+        for point in value.split(','):
+            temp, speed = point.split(':')
+            points.append((float(temp), min(100.0, max(0.0, float(speed)))))
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid curve %s, expected temp:duty,temp:duty,...' % value)
+    if len(points)<2:
+        raise argparse.ArgumentTypeError('curve requires at least 2 points')
+    return points
+
+# fan curve for the command line arguments. --curve overrides --min, --max,
+# --lin and --min-fan
+def create_curve(args):
+    if args.curve:
+        return FanCurve.from_points(args.curve)
+    min_temp = max(0, args.min)
+    return FanCurve.from_linear(min_temp, max(min_temp, args.max), args.lin, min(100, max(0, args.min_fan)))
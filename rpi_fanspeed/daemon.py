@@ -0,0 +1,2202 @@
+# fan control daemon. imported by cli.main() for all commands that require
+# pigpiod or MQTT
+
+import signal
+import time
+import sys
+import os
+import os.path
+import argparse
+import json
+try:
+    import syslog
+except:
+    syslog = None
+import re
+import hashlib
+import glob
+import array
+import bisect
+import asyncio
+import gzip
+import shutil
+import threading
+import collections
+import fcntl
+from urllib.parse import parse_qsl
+
+from . import VERSION, MODEL, MANUFACTURER
+from .curve import FanCurve, AdaptiveInterval, parse_curve, create_curve
+from .sensors import Sensor, discover_sensors, SensorGroup
+from .history import History
+from .control import PIDController, CpuLoad
+from .calibration import FanCalibration, load_calibration, save_calibration
+from .shm import StatusWriter, FLAG_STALLED
+from .cli import print_speed_table
+
+# pigpio constants
+INPUT = 0
+PUD_OFF = 0
+FALLING_EDGE = 1
+TIMEOUT = 2
+
+# pigpio notification report: sequence number and flags (16 bit), tick and
+# level (32 bit)
+NOTIFY_REPORT_SIZE = 12
+# flag of a watchdog timeout report, the lower 5 bits are the gpio
+NOTIFY_FLAGS_WDOG = 1 << 5
+# pigpio ticks are converted to monotonic time with a reference pair of both
+# clocks that is read again after this many seconds
+TICK_REFERENCE_INTERVAL = 60.0
+# fcntl.F_SETPIPE_SZ requires python 3.10
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+
+# --log values that disable the log file
+NULL_DEVICE = re.compile(r'^(NUL{1,2}|nul{1,2}|/dev/nul{1,2})$')
+
+# time source for the control loop. replaced by a virtual clock if the
+# simulated backend is used
+clock = time
+
+class RPiFanSpeedControl(object):
+
+    def __init__(self, pigpio):
+        self.pidfile = '/var/run/raspi_fanspeed.pid'
+        self.speed = 50.0
+        self.temp = 25.0
+        self.args = None
+        self.curve = None
+        self.target = None
+        self.target_temp = None
+        self.rpm = 0
+        self.pigpio = pigpio
+        self.pwm_level = None
+        self.pwm_changed = clock.monotonic()
+        # time without rpm signal after starting the fan or the last edge
+        self.stall_timeout = 7.5
+        self.stalled = False
+        self.exit_code = 0
+        self.interval = None
+        self.adaptive = None
+        self.pid = None
+        # duty cycle to rpm model from --calibrate
+        self.calibration = None
+
+    def set_args(self, args):
+        # normalize values
+        args.min_fan = min(100, max(0, args.min_fan))
+        args.min = max(0, args.min)
+        args.max = max(args.min, args.max)
+        args.deadband = max(0.0, args.deadband)
+        args.hysteresis = max(0.0, args.hysteresis)
+        args.onexit_speed = args.onexit_speed != -1 and min(100.0, max(args.onexit_speed, float(args.min_fan))) or 0
+        if args.pid!=None and args.pid:
+            self.pidfile = args.pid
+        if args.log and NULL_DEVICE.match(args.log):
+            args.log = None
+        self.args = args
+        self.curve = create_curve(args)
+        self.stall_timeout = args.stall_timeout
+        if args.mode=='pid':
+            self.pid = PIDController(args.pid_target, args.pid_kp, args.pid_ki, args.pid_kd, args.feed_forward, args.min_fan)
+        self.interval = args.interval
+        if args.adaptive:
+            self.adaptive = AdaptiveInterval(args.interval, args.min_interval, args.max_interval)
+
+    # update the polling interval for the current temperature
+    def update_interval(self):
+        if self.adaptive==None:
+            return self.interval
+        breakpoints = self.curve.breakpoints
+        if self.target and self.target_temp!=None and self.adaptive.slope<0:
+            # with falling temperature the fan speed changes after the hysteresis only
+            breakpoints = [self.target_temp - self.args.hysteresis]
+        self.interval = self.adaptive.update(self.get_temp(), clock.monotonic(), self.target or 0, breakpoints)
+        return self.interval
+
+    def create_pid(self):
+        try:
+            with open(self.pidfile, 'w') as f:
+                f.write('%u\n' % os.getpid())
+        except:
+            pass
+
+    def remove_pid(self):
+        if os.path.exists(self.pidfile):
+            try:
+                os.unlink(self.pidfile)
+            except:
+                pass
+
+    def get_temp(self):
+        return float(self.temp)
+
+    def set_temp(self, temp):
+        self.temp = temp
+
+    def get_speed(self):
+        return float(self.speed)
+
+    def get_rpm(self):
+        return int(self.rpm)
+
+    def set_speed(self, speed):
+        self.speed = speed
+
+    # rpm expected for the duty cycle from the calibration of the fan
+    def get_expected_rpm(self, speed=None):
+        if self.calibration==None:
+            return None
+        if speed==None:
+            speed = self.get_speed()
+        return self.calibration.expected_rpm(speed)
+
+    def temp_to_speed(self, temp):
+        return self.curve.get_speed(temp)
+
+    # duty cycle from the curve with deadband and hysteresis applied. the
+    # duty cycle is increased by at least args.deadband and decreased only
+    # if the temperature dropped by args.hysteresis since the last change
+    def temp_to_target_speed(self, temp, speed=None):
+        if speed==None:
+            speed = self.temp_to_speed(temp)
+        target = self.target
+        if target!=None and speed!=target:
+            if speed>target:
+                if speed - target<self.args.deadband and target>0 and speed<100:
+                    return target
+            else:
+                if temp>self.target_temp - self.args.hysteresis:
+                    return target
+                if target - speed<self.args.deadband and speed>0:
+                    return target
+        if speed!=target:
+            self.target = speed
+            self.target_temp = temp
+        return speed
+
+    # duty cycle from the PID controller. the target is updated if the output
+    # changed by at least args.deadband or the fan is turned on or off
+    def pid_to_target_speed(self, temp, load):
+        speed = self.pid.update(temp, load, clock.monotonic())
+        target = self.target
+        if target!=None and speed!=target:
+            if abs(speed - target)<self.args.deadband and speed>0 and target>0 and speed<100:
+                return target
+        if speed!=target:
+            self.target = speed
+            self.target_temp = temp
+        return speed
+
+    def get_json(self, indent=None, force=False, ts=None):
+        if ts==None or ts==True:
+            ts = clock.time()
+        data = self.get_status()
+        return json.dumps(data, indent=indent)
+
+    def get_status(self):
+        data = {
+            'temperature': ('%.2f' % self.get_temp()),
+            'duty_cycle': ('%.2f' % self.get_speed()),
+            'rpm': ('%u' % self.get_rpm()),
+            'ts': int(clock.time()),
+            'interval': ('%.1f' % self.interval),
+            # 'localtime': time.strftime('%FT%T %Z', time.localtime(ts))
+        }
+        if self.calibration:
+            data['expected_rpm'] = ('%u' % self.get_expected_rpm())
+        if self.stalled:
+            data['stalled'] = '1'
+        if sensors!=None and len(sensors.sensors)>1:
+            data['sensors'] = dict((name, temp!=None and ('%.2f' % temp) or None) for name, temp in sensors.get_temps().items())
+        if len(channels)>1:
+            data['fans'] = dict((channel.name, channel.get_status()) for channel in channels)
+        return data
+
+
+
+# period based rpm estimator. the ticks of the last edges are stored in a ring
+# buffer and the rpm is calculated from the median period, ignoring outliers
+class TicksDiff(object):
+
+    def __init__(self, size=32, timeout=1.0):
+        self.size = size
+        self.ticks = array.array('I', [0] * size)
+        self.pos = 0
+        self.count = 0
+        self.min_edges = 5
+        # periods that differ more than this from the median are ignored
+        self.max_deviation = 0.25
+        self.timeout_duration = timeout
+        self.timeout = 0
+        self.edges = 0
+
+    def is_timeout(self):
+        return clock.monotonic() >= self.timeout
+
+    # seconds since the last edge
+    def get_idle_time(self):
+        return clock.monotonic() - (self.timeout - self.timeout_duration)
+
+    def clear(self):
+        self.pos = 0
+        self.count = 0
+
+    def set_ticks(self, ticks):
+        old_is_timeout = self.is_timeout()
+        self.timeout = clock.monotonic() + self.timeout_duration
+        if old_is_timeout:
+            self.clear()
+        self.ticks[self.pos] = ticks
+        self.pos = (self.pos + 1) % self.size
+        if self.count<self.size:
+            self.count += 1
+        self.edges += 1
+
+    # edges read in bulk, oldest first. edge_time is the monotonic time of the
+    # last edge. only the last size ticks are stored
+    def add_ticks(self, ticks, edge_time):
+        size = self.size
+        if self.count and ((ticks[0] - self.ticks[(self.pos - 1) % size]) & 0xffffffff)>=self.timeout_duration * 1000000:
+            self.clear()
+        # ticks is an array, the last ticks are copied with 2 slices
+        last = ticks[-size:]
+        n = len(last)
+        pos = self.pos
+        head = min(n, size - pos)
+        self.ticks[pos:pos + head] = last[:head]
+        self.ticks[0:n - head] = last[head:]
+        self.pos = (pos + n) % size
+        self.count = min(size, self.count + len(ticks))
+        self.edges += len(ticks)
+        self.timeout = edge_time + self.timeout_duration
+
+    # time between edges in microseconds, oldest first
+    def get_diffs(self):
+        count = self.count
+        pos = self.pos
+        ticks = self.ticks
+        size = self.size
+        start = pos - count
+        diffs = []
+        prev = ticks[start % size]
+        for i in range(start + 1, pos):
+            tick = ticks[i % size]
+            # pigpio ticks are 32 bit and wrap around every ~72 minutes
+            diffs.append((tick - prev) & 0xffffffff)
+            prev = tick
+        return diffs
+
+    def get_diff(self):
+        if self.count<2:
+            return None
+        return self.get_diffs()[-1]
+
+    # period of one revolution in microseconds (2 edges)
+    def get_period(self):
+        if self.count<self.min_edges or self.is_timeout():
+            return None
+        diffs = sorted(self.get_diffs())
+        n = len(diffs)
+        median = diffs[n // 2]
+        if n % 2==0:
+            median = (median + diffs[n // 2 - 1]) / 2.0
+        if median==0:
+            return None
+        max_diff = median * self.max_deviation
+        inliers = [diff for diff in diffs if abs(diff - median)<=max_diff]
+        if not inliers:
+            return None
+        return sum(inliers) * 2.0 / len(inliers)
+
+    def get_hz(self):
+        p = self.get_period()
+        if p==None:
+            return None
+        return 1000000 / p
+
+    def get_rpm(self):
+        p = self.get_hz()
+        if p==None:
+            return None
+        return p * 60
+
+
+# notification pipe of pigpiod for a gpio. the pipe is only available if
+# pigpiod runs on the local host
+class NotifyPipe(object):
+
+    def __init__(self, pi, gpio):
+        self.pi = pi
+        self.handle = pi.notify_open()
+        if self.handle<0:
+            raise OSError('notify_open failed: %d' % self.handle)
+        try:
+            self.fd = os.open('/dev/pigpio%u' % self.handle, os.O_RDONLY | os.O_NONBLOCK)
+        except:
+            pi.notify_close(self.handle)
+            raise
+        try:
+            # room for a few minutes of edges if the pipe is not read
+            fcntl.fcntl(self.fd, F_SETPIPE_SZ, 1 << 20)
+        except OSError:
+            pass
+        pi.notify_begin(self.handle, 1 << gpio)
+
+    def readinto(self, buf):
+        try:
+            return os.readv(self.fd, [buf])
+        except BlockingIOError:
+            return 0
+
+    def close(self):
+        self.pi.notify_close(self.handle)
+        os.close(self.fd)
+
+
+class RPMMonitor(object):
+
+    def __init__(self, pigpio, gpio, estimator='period', notify=None, buffer_size=4096):
+        self.pigpio = pigpio
+        self.gpio = gpio
+        self.estimator = estimator
+        self.ticks_diff = TicksDiff()
+        self.window = 1.0
+        self.count = 0
+        self.rpm = 0
+        self.last_active = None
+        self._cb = None
+        self._sample_time = None
+        self._sample_count = 0
+        # function that opens a notification pipe for the gpio. the edges are
+        # read in bulk instead of calling cbf() for each edge
+        self.notify = notify
+        self._pipe = None
+        self._buffer = bytearray(buffer_size * NOTIFY_REPORT_SIZE)
+        self._pending = 0
+        # byte of the level field with the gpio, and a table that translates
+        # it to 0 or 1
+        self._level_offset = 8 + gpio // 8
+        self._levels = bytes((value >> (gpio % 8)) & 1 for value in range(256))
+        # levels of reports that alternate between rising and falling edges
+        self._alternating = (b'\0\1' * (buffer_size // 2 + 1), b'\1\0' * (buffer_size // 2 + 1))
+        # pigpio tick and monotonic time of the same moment
+        self._tick_ref = None
+        # watchdog timeouts reported by pigpiod. on_timeout is called for each
+        # report, from the pigpio thread if a callback is used
+        self.timeouts = 0
+        self.timeout_pending = False
+        self.on_timeout = None
+        self._loop = None
+        self._holdoff = 0
+        self._holdoff_handle = None
+
+    def start(self):
+        if self._cb!=None or self._pipe!=None:
+            return
+        self.pigpio.set_mode(self.gpio, INPUT)
+        self.pigpio.set_pull_up_down(self.gpio, PUD_OFF)
+        self._sample_time = clock.monotonic()
+        self._sample_count = self.count
+        self.last_active = self._sample_time
+        if self.notify!=None:
+            try:
+                self._pipe = self.notify(self.gpio)
+                self._pending = 0
+                return
+            except Exception as e:
+                verbose('notification pipe for gpio %u not available, using callback: %s' % (self.gpio, e))
+                self.notify = None
+        self._cb = self.pigpio.callback(self.gpio, FALLING_EDGE, self.cbf)
+
+    def stop(self):
+        if self._cb!=None:
+            self._cb.cancel()
+            self._cb = None
+        if self._pipe!=None:
+            if self._loop!=None:
+                self._loop.remove_reader(self._pipe.fd)
+            if self._holdoff_handle!=None:
+                self._holdoff_handle.cancel()
+                self._holdoff_handle = None
+            self._pipe.close()
+            self._pipe = None
+
+    # read the notification pipe when the event loop sees reports in it. a
+    # running fan sends edges all the time, after reading edges the pipe is
+    # not watched for holdoff seconds. a quiet pipe is watched, the watchdog
+    # report of a stopped fan wakes the loop right away
+    def watch(self, loop, holdoff):
+        self._loop = loop
+        self._holdoff = holdoff
+        if self._pipe!=None:
+            loop.add_reader(self._pipe.fd, self._read_pipe)
+
+    def _read_pipe(self):
+        if self.poll() and self._holdoff>0:
+            self._loop.remove_reader(self._pipe.fd)
+            self._holdoff_handle = self._loop.call_later(self._holdoff, self._end_holdoff)
+
+    def _end_holdoff(self):
+        self._holdoff_handle = None
+        if self._pipe==None:
+            return
+        if self.poll():
+            self._holdoff_handle = self._loop.call_later(self._holdoff, self._end_holdoff)
+        else:
+            self._loop.add_reader(self._pipe.fd, self._read_pipe)
+
+    # the rpm is only measured from edges that arrive after this call
+    def clear(self):
+        self.ticks_diff.clear()
+        self._sample_time = clock.monotonic()
+        self._sample_count = self.count
+        self.rpm = 0
+
+    def set_timeout(self):
+        self.timeouts += 1
+        self.timeout_pending = True
+        if self.on_timeout!=None:
+            self.on_timeout()
+
+    # called from the pigpio callback thread for each edge and watchdog
+    # timeout
+    def cbf(self, gpio, level, tick):
+        if level==TIMEOUT:
+            self.set_timeout()
+            return
+        self.timeout_pending = False
+        self.count += 1
+        self.ticks_diff.set_ticks(tick)
+
+    # read the reports from the notification pipe and decode the falling edges
+    # of each batch at once. returns the number of edges
+    def poll(self):
+        pipe = self._pipe
+        if pipe==None:
+            return 0
+        buffer = self._buffer
+        ticks = array.array('I')
+        timeout = False
+        while True:
+            with memoryview(buffer) as view:
+                n = pipe.readinto(view[self._pending:])
+            if not n:
+                break
+            n += self._pending
+            size = n - n % NOTIFY_REPORT_SIZE
+            if size:
+                timeout = self.decode(size, ticks, timeout)
+            self._pending = n - size
+            if self._pending:
+                buffer[:self._pending] = buffer[size:n]
+        if ticks:
+            self.ticks_diff.add_ticks(ticks, self.get_edge_time(ticks[-1]))
+            self.count += len(ticks)
+            self.timeout_pending = False
+        if timeout:
+            self.set_timeout()
+        return len(ticks)
+
+    # append the ticks of the falling edges in the first size bytes of the
+    # buffer. returns True if the last watchdog timeout has not been followed
+    # by an edge
+    def decode(self, size, ticks, timeout):
+        with memoryview(self._buffer) as view, view[:size].cast('I') as words, view[:size].cast('H') as halfwords:
+            levels = view[self._level_offset:size:NOTIFY_REPORT_SIZE].tobytes().translate(self._levels)
+            flags = halfwords[1::6].tobytes().strip(b'\0')
+            # the reports of a single gpio alternate between rising and falling
+            # edges. without flags the ticks of the falling edges are sliced
+            if not flags and levels==self._alternating[levels[0]][:len(levels)]:
+                ticks.frombytes(words[levels[0] * 3 + 1::6].tobytes())
+                return False
+            # reports with flags are keep alive or watchdog events
+            mask = 1 << self.gpio
+            ticks.extend([tick for flags, tick, level in zip(words[0::3], words[1::3], words[2::3]) if not level & mask and flags<0x10000])
+            wdog = NOTIFY_FLAGS_WDOG | self.gpio
+            # a watchdog timeout followed by an edge is outdated
+            for flags in words[0::3]:
+                if flags>>16==wdog:
+                    timeout = True
+                elif flags<0x10000:
+                    timeout = False
+        return timeout
+
+    # monotonic time of a pigpio tick. get_current_tick() is a round trip to
+    # pigpiod, the reference is only read every TICK_REFERENCE_INTERVAL seconds
+    def get_edge_time(self, tick):
+        now = clock.monotonic()
+        if self._tick_ref==None or now - self._tick_ref[1]>=TICK_REFERENCE_INTERVAL:
+            self._tick_ref = (self.pigpio.get_current_tick(), now)
+        ref_tick, ref_time = self._tick_ref
+        # signed difference, the edge can be older than the reference
+        diff = ((tick - ref_tick + 0x80000000) & 0xffffffff) - 0x80000000
+        return min(now, ref_time + diff / 1000000.0)
+
+    # seconds since the last edge
+    def get_idle_time(self):
+        self.poll()
+        return self.ticks_diff.get_idle_time()
+
+    def update(self):
+        self.poll()
+        if self.estimator=='count':
+            return self.update_count()
+        rpm = self.ticks_diff.get_rpm()
+        if rpm==None:
+            self.rpm = 0
+        else:
+            self.rpm = rpm
+            self.last_active = clock.monotonic()
+        return self.rpm
+
+    # calculate rpm from the edges counted since the last sample. returns the
+    # previous value if the window has not elapsed yet
+    def update_count(self):
+        now = clock.monotonic()
+        elapsed = now - self._sample_time
+        if elapsed < self.window:
+            return self.rpm
+        count = self.count
+        edges = count - self._sample_count
+        self._sample_time = now
+        self._sample_count = count
+        # less than 4 edges per second is noise or a stalled fan
+        f = edges / elapsed / 2.0
+        if f>2.0:
+            self.rpm = f * 60
+            self.last_active = now
+        else:
+            self.rpm = 0
+        return self.rpm
+
+    # seconds without rpm signal
+    def inactive_time(self):
+        if self.last_active==None:
+            return 0
+        return clock.monotonic() - self.last_active
+
+
+class NoMQTT:
+    def __init__(self):
+        self.signal_counter = 0
+
+    def server(self):
+        return 'none'
+
+    def client_begin(self):
+        pass
+
+    def client_end(self):
+        pass
+
+    def client_publish(self, temperature, speed):
+        return False
+
+    def publish_alert(self, fan, alert, msg):
+        return False
+
+    def available(self):
+        return False
+
+class HardwareBackend(object):
+
+    def __init__(self):
+        import pigpio
+        self.name = 'pigpio'
+        self.clock = time
+        self.pi = pigpio.pi()
+
+    def discover_sensors(self):
+        return discover_sensors()
+
+    def create_cpu_load(self, loadavg=False):
+        return CpuLoad(loadavg)
+
+    def open_notify(self, gpio):
+        return NotifyPipe(self.pi, gpio)
+
+    def close(self):
+        self.pi.stop()
+
+def create_sensors(args, available, curve):
+    names = [name.strip() for name in args.sensors.split(',') if name.strip()]
+    if 'all' in names:
+        sensors = available
+    else:
+        sensors = []
+        for name in names:
+            found = [sensor for sensor in available if sensor.name==name]
+            if found:
+                sensors.append(found[0])
+            elif '/' in name:
+                sensors.append(Sensor(name, name))
+            else:
+                error_and_exit('sensor %s not found. available: %s' % (name, ', '.join(sensor.name for sensor in available)))
+    if not sensors:
+        error_and_exit('no temperature sensors found')
+
+    weights = {}
+    for item in (args.sensor_weight or '').split(','):
+        if '=' in item:
+            name, weight = item.split('=', 1)
+            weights[name.strip()] = float(weight)
+
+    curves = {}
+    for item in args.sensor_curve or []:
+        if '=' not in item:
+            error_and_exit('invalid sensor curve %s, expected name=temp:duty,...' % item)
+        name, points = item.split('=', 1)
+        try:
+            curves[name.strip()] = FanCurve.from_points(parse_curve(points))
+        except argparse.ArgumentTypeError as e:
+            error_and_exit(str(e))
+    if args.sensor_mode=='curve':
+        for sensor in sensors:
+            if sensor.name not in curves:
+                curves[sensor.name] = curve
+
+    return SensorGroup(sensors, args.sensor_mode, weights, curves)
+
+# hardware PWM channel of the pins. pins of the same channel output the same signal
+PWM_CHANNELS = {12: 0, 18: 0, 13: 1, 19: 1}
+
+# fan with its own PWM and tach pin, curve, sensors and stall detection. all
+# channels share the pigpio connection
+class FanChannel(object):
+
+    def __init__(self, name, args, fsc, rpm_monitor, sensors):
+        self.name = name
+        self.args = args
+        self.pin = args.pin
+        self.fsc = fsc
+        self.rpm_monitor = rpm_monitor
+        self.sensors = sensors
+        # set if the fan has stalled
+        self.watchdog_event = None
+        # timeout of the pigpiod watchdog of the tach gpio, 0 if disabled
+        self.watchdog_ms = 0
+
+    def get_status(self):
+        data = {
+            'temperature': ('%.2f' % self.fsc.get_temp()),
+            'duty_cycle': ('%.2f' % self.fsc.get_speed()),
+            'rpm': ('%u' % self.fsc.get_rpm()),
+        }
+        if self.fsc.calibration:
+            data['expected_rpm'] = ('%u' % self.fsc.get_expected_rpm())
+        if self.fsc.stalled:
+            data['stalled'] = '1'
+        return data
+
+    # key of the fan in the calibration file. the fan is calibrated again if
+    # the pins have changed
+    def get_calibration_key(self):
+        return '%s/%u/%u' % (self.name, self.pin, self.args.rpm_pin)
+
+# arguments of an additional fan. options that are not set are inherited
+# from the command line
+def get_fan_args(args, fan):
+    fan_args = argparse.Namespace(**vars(args))
+    for key, value in fan.items():
+        if key!='name':
+            setattr(fan_args, key, value)
+    # --min, --max, --lin or --min-fan replace an inherited --curve
+    if 'curve' not in fan and [key for key in ('min', 'max', 'lin', 'min_fan') if key in fan]:
+        fan_args.curve = None
+    return fan_args
+
+def create_channel(name, args, backend):
+    fsc = RPiFanSpeedControl(backend.pi)
+    fsc.set_args(args)
+    rpm_monitor = RPMMonitor(backend.pi, args.rpm_pin, args.rpm_estimator, args.edge_source=='auto' and backend.open_notify or None)
+    channel = FanChannel(name, args, fsc, rpm_monitor, None)
+    if str_valid(args.calibration_file) and not args.calibrate:
+        try:
+            fsc.calibration = load_calibration(args.calibration_file, channel.get_calibration_key())
+        except (OSError, ValueError, KeyError) as e:
+            error('cannot read calibration %s: %s' % (args.calibration_file, e))
+    return channel
+
+def create_channels(args, backend):
+    fans = [dict(name=args.fan_name)] + (args.fan or [])
+    names = [fan['name'] for fan in fans]
+    pins = [fan.get('pin', args.pin) for fan in fans]
+    rpm_pins = [fan.get('rpm_pin', args.rpm_pin) for fan in fans]
+    if len(fans)>1:
+        for pin in pins:
+            if pin not in PWM_CHANNELS:
+                error_and_exit('pin %u does not support hardware PWM. valid pins: %s' % (pin, ', '.join(str(pin) for pin in sorted(PWM_CHANNELS))))
+        if len(set(names))!=len(names):
+            error_and_exit('fan names must be unique: %s' % ', '.join(names))
+        if len(set(PWM_CHANNELS[pin] for pin in pins))!=len(pins):
+            error_and_exit('each fan requires its own hardware PWM channel. pins 12 and 18 share channel 0, 13 and 19 channel 1: %s' % ', '.join(str(pin) for pin in pins))
+        if len(set(rpm_pins))!=len(rpm_pins):
+            error_and_exit('rpm pins must be unique: %s' % ', '.join(str(pin) for pin in rpm_pins))
+    channels = [create_channel(args.fan_name, args, backend)]
+    for fan in args.fan or []:
+        channels.append(create_channel(fan['name'], get_fan_args(args, fan), backend))
+    return channels
+
+# temperature sensors of the channels. --set, --measure and --calibrate only
+# use the pins and exit before the sensors are discovered
+def create_channel_sensors(channels, backend):
+    available = backend.discover_sensors()
+    for channel in channels:
+        channel.sensors = create_sensors(channel.args, available, channel.fsc.curve)
+
+# stages of the loop with their own timing histogram
+STAGES = ('sensors', 'pwm', 'rpm', 'history', 'status', 'shm', 'log', 'series', 'mqtt_publish', 'mqtt_callback')
+
+# upper bounds of the loop time histogram in seconds
+LOOP_TIME_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25)
+
+class Histogram(object):
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count', 'max')
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        # the last bucket counts values above the upper bound
+        self.counts = array.array('L', [0]) * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        if value>self.max:
+            self.max = value
+
+    # upper bound of the bucket that contains the quantile q. the max. value
+    # if it is above the last bucket
+    def quantile(self, q):
+        rank = q * self.count
+        total = 0
+        for le, count in zip(self.buckets, self.counts):
+            total += count
+            if total>=rank:
+                return min(le, self.max)
+        return self.max
+
+    def get_summary(self):
+        return {
+            'count': self.count,
+            'mean_ms': ('%.3f' % (self.count and self.sum / self.count * 1000.0 or 0.0)),
+            'p95_ms': ('%.3f' % (self.quantile(0.95) * 1000.0)),
+            'max_ms': ('%.3f' % (self.max * 1000.0)),
+        }
+
+    def to_openmetrics(self, name, lines, labels=''):
+        if not labels:
+            lines.append('# TYPE %s histogram' % name)
+        else:
+            labels += ','
+        total = 0
+        for le, count in zip(self.buckets, self.counts):
+            total += count
+            lines.append('%s_bucket{%sle="%s"} %u' % (name, labels, le, total))
+        lines.append('%s_bucket{%sle="+Inf"} %u' % (name, labels, self.count))
+        labels = labels and '{%s}' % labels[:-1] or ''
+        lines.append('%s_sum%s %.6f' % (name, labels, self.sum))
+        lines.append('%s_count%s %u' % (name, labels, self.count))
+
+# measures the time of a stage with the with statement
+class Span(object):
+
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+# counters and the OpenMetrics text exposition. the text is cached and only
+# created again after the next sample
+class Metrics(object):
+
+    def __init__(self):
+        self.stalls = 0
+        self.pigpio_errors = 0
+        self.mqtt_publish_errors = 0
+        # periodic tasks that took longer than their interval
+        self.overruns = 0
+        self.loop_time = Histogram(LOOP_TIME_BUCKETS)
+        # duration of each stage of the loop and the MQTT callbacks
+        self.stages = collections.OrderedDict((name, Histogram(LOOP_TIME_BUCKETS)) for name in STAGES)
+        self.version = 0
+        self._text = None
+        self._text_version = None
+
+    def sample(self, duration):
+        self.loop_time.observe(duration)
+        self.version += 1
+
+    def span(self, stage):
+        return Span(self.stages[stage])
+
+    # func with the time of each call added to stage
+    def timed(self, stage, func):
+        histogram = self.stages[stage]
+        def wrapper(*args, **kwargs):
+            with Span(histogram):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def get_timing(self):
+        return {
+            'loop': self.loop_time.get_summary(),
+            'stages': dict((name, histogram.get_summary()) for name, histogram in self.stages.items() if histogram.count),
+            'overruns': self.overruns,
+        }
+
+    # table of the loop and stage durations in milliseconds
+    def get_timing_table(self):
+        lines = ['%-14s %10s %10s %10s %10s' % ('stage', 'count', 'mean', 'p95', 'max')]
+        for name, histogram in [('loop', self.loop_time)] + list(self.stages.items()):
+            if histogram.count:
+                summary = histogram.get_summary()
+                lines.append('%-14s %10u %10s %10s %10s' % (name, summary['count'], summary['mean_ms'], summary['p95_ms'], summary['max_ms']))
+        lines.append('overruns %u' % self.overruns)
+        return '\n'.join(lines)
+
+    def get_text(self):
+        if self._text_version==self.version:
+            return self._text
+        lines = []
+        def gauge(name, help, value, labels=''):
+            lines.append('# TYPE %s gauge' % name)
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('%s%s %s' % (name, labels, value))
+        def counter(name, help, value):
+            lines.append('# TYPE %s counter' % name)
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('%s_total %u' % (name, value))
+        gauge('fanspeed_temperature_celsius', 'Temperature used by the fan curve', '%.2f' % fsc.get_temp())
+        gauge('fanspeed_duty_cycle_percent', 'PWM duty cycle', '%.2f' % fsc.get_speed())
+        gauge('fanspeed_rpm', 'Fan speed', '%u' % fsc.get_rpm())
+        gauge('fanspeed_interval_seconds', 'Sensor polling interval', '%.1f' % fsc.interval)
+        gauge('fanspeed_stalled', 'Fan stall detected', fsc.stalled and 1 or 0)
+        if fsc.calibration:
+            gauge('fanspeed_expected_rpm', 'Fan speed expected for the duty cycle from the calibration', '%u' % fsc.get_expected_rpm())
+        if sensors!=None and len(sensors.sensors)>1:
+            name = 'fanspeed_sensor_temperature_celsius'
+            lines.append('# TYPE %s gauge' % name)
+            lines.append('# HELP %s Temperature of each sensor' % name)
+            for sensor, temp in sensors.get_temps().items():
+                if temp!=None:
+                    lines.append('%s{sensor="%s"} %.2f' % (name, sensor, temp))
+        if len(channels)>1:
+            for name, help, func in (
+                ('fanspeed_fan_duty_cycle_percent', 'PWM duty cycle of each fan', lambda fsc: '%.2f' % fsc.get_speed()),
+                ('fanspeed_fan_rpm', 'Speed of each fan', lambda fsc: '%u' % fsc.get_rpm()),
+                ('fanspeed_fan_temperature_celsius', 'Temperature used by the fan curve of each fan', lambda fsc: '%.2f' % fsc.get_temp()),
+                ('fanspeed_fan_stalled', 'Stall detected for each fan', lambda fsc: fsc.stalled and 1 or 0),
+            ):
+                lines.append('# TYPE %s gauge' % name)
+                lines.append('# HELP %s %s' % (name, help))
+                for channel in channels:
+                    lines.append('%s{fan="%s"} %s' % (name, channel.name, func(channel.fsc)))
+        counter('fanspeed_tach_edges', 'Tachometer edges', sum(channel.rpm_monitor.count for channel in channels))
+        counter('fanspeed_stalls', 'Stall events', self.stalls)
+        counter('fanspeed_pigpio_errors', 'Failed pigpiod calls', self.pigpio_errors)
+        counter('fanspeed_mqtt_publish_errors', 'Failed MQTT publish calls', self.mqtt_publish_errors)
+        counter('fanspeed_overruns', 'Periodic tasks that took longer than their interval', self.overruns)
+        self.loop_time.to_openmetrics('fanspeed_loop_duration_seconds', lines)
+        name = 'fanspeed_stage_duration_seconds'
+        lines.append('# TYPE %s histogram' % name)
+        for stage, histogram in self.stages.items():
+            histogram.to_openmetrics(name, lines, 'stage="%s"' % stage)
+        lines.append('# EOF\n')
+        self._text = '\n'.join(lines).encode()
+        self._text_version = self.version
+        return self._text
+
+# fsc, rpm_monitor and sensors belong to the first fan channel
+fsc = None
+mqtt = NoMQTT()
+args = None
+rpm_monitor = None
+sensors = None
+channels = []
+cpu_load = None
+series = None
+history = None
+status_server = None
+profiler = None
+shm = None
+metrics = Metrics()
+exit_event = None
+
+def get_mac_addresses():
+    parts = []
+    for iface in glob.glob('/sys/class/net/*/address'):
+        try:
+            with open(iface, 'r') as f:
+                mac = f.readline().strip()
+                if mac.strip('0:')!='':
+                    parts.append(mac)
+        except:
+            pass
+    return parts
+
+
+
+def generate_client_id(hostname):
+    m = hashlib.md5()
+    m.update(hostname.encode())
+    m.update(b':')
+    for mac in get_mac_addresses():
+        m.update(b':')
+        m.update(mac.encode())
+    return '' + m.digest().hex()[0:11]
+
+def verbose(msg):
+    if fsc.args.verbose:
+        print(msg)
+
+def send_syslog(msg, level = syslog.LOG_ERR):
+    if syslog!=None:
+        syslog.syslog(level, msg)
+
+def error(msg):
+    print(msg)
+    send_syslog(msg)
+
+def error_and_exit(msg, code=-1):
+    error(msg)
+    sys.exit(code)
+
+class MQTT(NoMQTT):
+    def __init__(self, user, passwd, host, port, device_name, topic, client, update_rate = 60, hass_autoconfig_prefix='homeassistant', client_id='', qos=(0, 1, 1), deadband=(1.0, 2.0, 250), queue_size=32, hass_cache=None, fans=None):
+        NoMQTT.__init__(self)
+        self.next_update = clock.monotonic();
+        # qos of the state, status and homeassistant auto discovery topics
+        self.qos_json, self.qos_status, self.qos_hass = qos
+        # the state is published if temperature, duty cycle or rpm change more
+        # than the deadband or after update_rate seconds
+        self.deadband = deadband
+        self.last_values = None
+        # last status published since connecting
+        self.status = None
+        # messages published while disconnected. state messages for the same
+        # topic replace the queued one, events like alerts are kept in order
+        # in a separate queue. if a queue is full the oldest is dropped
+        self.queue = collections.OrderedDict()
+        self.events = collections.deque()
+        self.queue_size = queue_size
+        self.queue_dropped = 0
+        self.lock = threading.Lock()
+        # auto discovery messages are created once and stored in hass_cache
+        # with the hash of the configuration. they are only published again
+        # if the configuration changes or homeassistant comes online
+        self.hass_cache = hass_cache
+        self.hass_config = None
+        self.hass_config_hash = None
+        self.hass_published = None
+        # names of additional fans with their own homeassistant entities
+        self.fans = fans or []
+        self.user = user
+        self.passwd = passwd
+        self.host = host
+        self.port = port
+        self.update_rate = update_rate;
+        self.client_id = client_id
+        self.connected = False
+        # self.last_update = clock.monotonic()
+        self.topic = type('obj', (object,), {
+            'status': topic.format(device_name=device_name,entity='RPi.fanspeed/status'),
+            'json': topic.format(device_name=device_name,entity='RPi.fanspeed/json'),
+            'alert': topic.format(device_name=device_name,entity='RPi.fanspeed/alert'),
+        })()
+        self.device_name = device_name
+        self.auto_discovery = type('obj', (object,), {
+            'prefix': hass_autoconfig_prefix,
+            'thermal_zone0': '{auto_discovery_prefix}/sensor/{device_name}-thermal-zone0/config',
+            'duty_cycle': '{auto_discovery_prefix}/sensor/{device_name}-duty-cycle/config',
+            'rpm': '{auto_discovery_prefix}/sensor/{device_name}-rpm/config',
+        })()
+        self.client = client
+
+    def server(self):
+        account = (not self.user or not self.passwd) and 'anonymous' or self.user
+        return '%s@%s:%u' % (account, self.host, self.port)
+
+    def create_hass_auto_conf(self, entity, unit, value_json_name, device_class, mac_addresses=None):
+        m = hashlib.md5()
+        m.update((':'.join([self.device_name, MODEL, MANUFACTURER, entity, unit, value_json_name])).encode())
+        unique_id = m.digest().hex()[0:11]
+
+        m = hashlib.md5()
+        m.update((':'.join([self.device_name, MODEL, MANUFACTURER])).encode())
+        device_unique_id = m.digest().hex()[0:11]
+
+        connections = []
+        if mac_addresses==None:
+            mac_addresses = get_mac_addresses()
+        for mac_addr in mac_addresses:
+            connections.append(["mac", mac_addr])
+
+        return json.dumps({
+            "name": "%s-%s" % (self.device_name, entity.replace('_', '-')),
+            "platform": "mqtt",
+            "unique_id": unique_id,
+            "device": {
+                "name": "%s-%s-%s" % (self.device_name, MODEL, device_unique_id[0:4]),
+                "identifiers": [ device_unique_id, '72762b3e8dae07899742cf8a2a68216d39feb535' ],
+                "connections": connections,
+                "model": MODEL,
+                "sw_version": VERSION,
+                "manufacturer": MANUFACTURER,
+            },
+            "availability_topic": self.topic.status,
+            "payload_available": "1",
+            "payload_not_available": "0",
+            "state_topic": self.topic.json,
+            "unit_of_measurement": unit,
+            "value_template": "{{ value_json.%s }}" % value_json_name
+        }, ensure_ascii=False, indent=None, separators=(',', ':'))
+
+    def get_topic(self, topic, payload):
+        return topic.format(auto_discovery_prefix=self.auto_discovery.prefix, json=payload, device_name=self.device_name)
+
+    def publish(self, topic, payload, retain=True, qos=0, coalesce=True):
+        with self.lock:
+            # on_connect sets connected before flushing the queue
+            if not self.connected:
+                self.enqueue(topic, payload, retain, qos, coalesce)
+                return False
+        return self.send(topic, payload, retain, qos)
+
+    # requires the lock
+    def enqueue(self, topic, payload, retain, qos, coalesce=True):
+        if not coalesce:
+            if len(self.events)>=self.queue_size:
+                self.events.popleft()
+                self.queue_dropped += 1
+            self.events.append((topic, payload, retain, qos))
+            return
+        if topic in self.queue:
+            self.queue.move_to_end(topic)
+        elif len(self.queue)>=self.queue_size:
+            self.queue.popitem(last=False)
+            self.queue_dropped += 1
+        self.queue[topic] = (payload, retain, qos)
+
+    def flush_queue(self):
+        with self.lock:
+            queue = self.queue
+            events = self.events
+            self.queue = collections.OrderedDict()
+            self.events = collections.deque()
+        if queue or events:
+            verbose('publishing %u queued messages' % (len(queue) + len(events)))
+        for topic, (payload, retain, qos) in queue.items():
+            self.send(topic, payload, retain, qos)
+        for topic, payload, retain, qos in events:
+            self.send(topic, payload, retain, qos)
+
+    # publish the status if it has changed since connecting
+    def publish_status(self, status):
+        if self.status==status:
+            return False
+        self.status = status
+        return self.send(self.topic.status, payload=status, retain=True, qos=self.qos_status)
+
+    def send(self, topic, payload, retain, qos):
+        topic = self.get_topic(topic, payload)
+        verbose('publish mqtt %s: %s' % (topic, payload))
+        try:
+            with metrics.span('mqtt_publish'):
+                info = self.client.publish(topic, payload, retain=retain, qos=qos)
+            if getattr(info, 'rc', 0)!=0:
+                metrics.mqtt_publish_errors += 1
+                return False
+            return True
+        except Exception as e:
+            metrics.mqtt_publish_errors += 1
+            verbose("exception %s" % e)
+            send_syslog('MQTT error: %s' % e)
+            if fsc.args.verbose:
+                raise e
+        return False
+
+    # list of topic and payload
+    def get_hass_auto_config(self):
+        if self.hass_config!=None:
+            return self.hass_config
+        mac_addresses = get_mac_addresses()
+        m = hashlib.sha1()
+        m.update(json.dumps([VERSION, MODEL, MANUFACTURER, self.device_name, self.auto_discovery.prefix, self.topic.status, self.topic.json, self.fans, mac_addresses]).encode())
+        self.hass_config_hash = m.hexdigest()
+        cache = self.load_hass_cache()
+        if cache!=None and cache.get('hash')==self.hass_config_hash:
+            self.hass_config = cache['messages']
+            self.hass_published = cache.get('published')
+            return self.hass_config
+        self.hass_config = [
+            (self.auto_discovery.thermal_zone0, self.create_hass_auto_conf('thermal-zone0', "\u00b0C", 'temperature', 'temperature', mac_addresses)),
+            (self.auto_discovery.duty_cycle, self.create_hass_auto_conf('duty-cycle', '%', 'duty_cycle', 'None', mac_addresses)),
+            (self.auto_discovery.rpm, self.create_hass_auto_conf('rpm', "rpm", 'rpm', 'None', mac_addresses)),
+        ]
+        for name in self.fans:
+            entity = name.replace('_', '-')
+            self.hass_config.append(('{auto_discovery_prefix}/sensor/{device_name}-%s-duty-cycle/config' % entity, self.create_hass_auto_conf('%s-duty-cycle' % entity, '%', 'fans.%s.duty_cycle' % name, 'None', mac_addresses)))
+            self.hass_config.append(('{auto_discovery_prefix}/sensor/{device_name}-%s-rpm/config' % entity, self.create_hass_auto_conf('%s-rpm' % entity, "rpm", 'fans.%s.rpm' % name, 'None', mac_addresses)))
+        self.save_hass_cache()
+        return self.hass_config
+
+    def load_hass_cache(self):
+        if not str_valid(self.hass_cache) or not os.path.exists(self.hass_cache):
+            return None
+        try:
+            with open(self.hass_cache, 'r') as f:
+                return json.loads(f.read())
+        except Exception as e:
+            verbose('cannot read %s: %s' % (self.hass_cache, e))
+        return None
+
+    def save_hass_cache(self):
+        if not str_valid(self.hass_cache):
+            return
+        try:
+            tmp_file = self.hass_cache + '.tmp'
+            with open(tmp_file, 'w') as f:
+                f.write(json.dumps({'hash': self.hass_config_hash, 'published': self.hass_published, 'messages': self.hass_config}))
+            os.replace(tmp_file, self.hass_cache)
+        except Exception as e:
+            verbose('cannot write %s: %s' % (self.hass_cache, e))
+
+    # returns False if the current configuration has been published already
+    def send_homeassistant_auto_config(self, force=False):
+        messages = self.get_hass_auto_config()
+        if not force and self.hass_published==self.hass_config_hash:
+            verbose('homeassistant auto discovery unchanged')
+            return False
+        verbose('publishing homeassistant auto discovery')
+        for topic, payload in messages:
+            self.publish(topic, payload=payload, retain=True, qos=self.qos_hass)
+        if self.hass_published!=self.hass_config_hash:
+            self.hass_published = self.hass_config_hash
+            self.save_hass_cache()
+        return True
+
+    def rc_to_str(self, rc):
+        errors = {
+            0: 'Connection successful',
+            1: 'Connection refused - incorrect protocol version',
+            2: 'Connection refused - invalid client identifier',
+            3: 'Connection refused - server unavailable',
+            4: 'Connection refused - bad username or password',
+            5: 'Connection refused - not authorised'
+        }
+        if rc in errors:
+            return errors[rc]
+        return 'Unknown response #%u' % rc
+
+    def on_connect(self, client, userdata, flags, rc):
+        verbose("connected to mqtt server: %s (%s)" % (self.rc_to_str(rc), self.client_id))
+        if rc!=0:
+            send_syslog('Failed to connect to MQTT server %s: %s' % (mqtt.server(), self.rc_to_str(rc)))
+            self.connected = False
+            return
+        self.connected = True
+        try:
+            self.publish_status("1")
+            if self.auto_discovery.prefix:
+                # homeassistant publishes online after starting
+                self.client.subscribe(self.auto_discovery.prefix + '/status', qos=1)
+                self.send_homeassistant_auto_config()
+            self.flush_queue()
+        except Exception as e:
+            verbose("exception %s" % e)
+            send_syslog('MQTT error: %s' % e)
+            if fsc.args.verbose:
+                raise e
+
+    def on_disconnect(self, client, userdata, rc):
+        info = ''
+        if rc!=0:
+            info = ': %s' % self.rc_to_str(rc)
+        verbose("disconnected from mqtt server%s" % info)
+        send_syslog('Disconnected from MQTT server %s%s' % (mqtt.server(), info))
+        self.connected = False
+        # the broker publishes the last will
+        self.status = None
+
+    def on_message(self, client, userdata, msg):
+        if self.auto_discovery.prefix and msg.topic==self.auto_discovery.prefix + '/status':
+            if msg.payload==b'online':
+                verbose('homeassistant online')
+                self.send_homeassistant_auto_config(force=True)
+            return
+        print(msg.topic+" "+str(msg.payload))
+
+    def on_log(self, client, userdata, level, buf):
+        verbose('%s: %s' % (level, buf))
+
+    def client_begin(self):
+        verbose('connecting to mqtt server %s' % (mqtt.server()))
+        try:
+            self.client.on_connect = metrics.timed('mqtt_callback', self.on_connect)
+            self.client.on_disconnect = metrics.timed('mqtt_callback', self.on_disconnect)
+            self.client.on_message = metrics.timed('mqtt_callback', self.on_message)
+            self.client.on_log = self.on_log
+            self.client.reconnect_delay_set(min_delay=5, max_delay=60)
+            self.client.will_set(self.get_topic(self.topic.status, "0"), payload="0", qos=self.qos_status, retain=True)
+            self.client.connect(self.host, port=self.port, keepalive=15)
+            # self.client.connect_async(self.host, port=self.port, keepalive=15)
+            self.client.loop_start();
+        except Exception as e:
+            verbose("exception %s" % e)
+            send_syslog('MQTT error: %s' % e)
+            if fsc.args.verbose:
+                raise e
+
+    def client_end(self):
+        verbose('disconnecting from mqtt server')
+        try:
+            if self.connected:
+                self.publish_status("0")
+                self.client.disconnect();
+            self.client.loop_stop(force=False)
+            time.sleep(1.0)
+            self.client.loop_stop(force=True)
+            self.client = False
+        except Exception as e:
+            self.client = False
+            verbose("exception %s" % e)
+            send_syslog('MQTT error: %s' % e)
+            if fsc.args.verbose:
+                raise e
+
+    def is_changed(self, values):
+        if self.last_values==None:
+            return True
+        for i, (value, last) in enumerate(zip(values, self.last_values)):
+            # temperature, duty cycle and rpm of each fan
+            if abs(value - last)>=self.deadband[i % 3]:
+                return True
+        return False
+
+    # publish the state if a value has changed more than the deadband or if
+    # the last update is older than update_rate seconds. while disconnected
+    # only the latest state is kept
+    def client_publish(self, temperature, speed):
+        values = (temperature, speed, fsc.get_rpm())
+        for channel in channels[1:]:
+            values += (channel.fsc.get_temp(), channel.fsc.get_speed(), channel.fsc.get_rpm())
+        now = clock.monotonic()
+        if now<self.next_update and not self.is_changed(values):
+            return False
+        self.next_update = now + self.update_rate
+        self.last_values = values
+        self.publish(self.topic.json, payload=fsc.get_json(indent=0, ts=True), retain=True, qos=self.qos_json)
+        return True
+
+    # stall and recovery of a fan. alerts are not retained and not replaced by
+    # newer alerts while disconnected
+    def publish_alert(self, fan, alert, msg):
+        payload = json.dumps({'fan': fan, 'alert': alert, 'message': msg, 'ts': int(clock.time())}, separators=(',', ':'))
+        return self.publish(self.topic.alert, payload=payload, retain=False, qos=self.qos_status, coalesce=False)
+
+    def available(self):
+        return True
+
+def create_mqtt(args, hostname):
+    try:
+        if args.mqtthost==None:
+            raise RuntimeError()
+        import paho.mqtt.client
+        client_id = generate_client_id(hostname)
+        client = paho.mqtt.client.Client(client_id=client_id, clean_session=True)
+        return MQTT(args.mqttuser, args.mqttpass, args.mqtthost, args.mqttport, args.mqttdevicename, args.mqtttopic, client, update_rate=args.mqttupdateinterval, hass_autoconfig_prefix=args.mqtthass, client_id=client_id, qos=(args.mqttqos, args.mqttstatusqos, args.mqtthassqos), deadband=(args.mqttdeadband, args.mqttspeeddeadband, args.mqttrpmdeadband), queue_size=args.mqttqueue, hass_cache=args.mqtthasscache, fans=[channel.name for channel in channels[1:]])
+    except:
+        return NoMQTT()
+
+def create_backend(args):
+    if args.simulate:
+        from . import sim
+        fans = ((args.pin, args.rpm_pin),) + tuple((fan['pin'], fan['rpm_pin']) for fan in args.fan or [])
+        return sim.SimulatedBackend(fans=fans, ambient=args.sim_ambient, load=args.sim_load, stall_after=args.sim_stall)
+    return HardwareBackend()
+
+# append only time series in NDJSON format. samples are buffered and written
+# in batches. the file is rotated by size or age and rotated segments can be
+# compressed
+class SeriesWriter(object):
+
+    def __init__(self, filename, batch=100, max_size=16, rotate=24, keep=7, compress=False):
+        self.filename = filename
+        self.batch = batch
+        self.max_size = max_size * 1024 * 1024
+        self.rotate_interval = rotate * 3600
+        self.keep = keep
+        self.compress = compress
+        self.buffer = []
+        self.segment_start = None
+
+    def append(self, ts, temp, speed, rpm):
+        self.buffer.append('{"ts":%.3f,"temperature":%.2f,"duty_cycle":%.2f,"rpm":%u}\n' % (ts, temp, speed, rpm))
+        return len(self.buffer)>=self.batch
+
+    # returns the buffered lines for write()
+    def take(self):
+        lines = self.buffer
+        self.buffer = []
+        return lines
+
+    def get_segment_start(self, ts):
+        try:
+            with open(self.filename, 'r') as f:
+                return json.loads(f.readline())['ts']
+        except:
+            return ts
+
+    # blocking, called from the executor
+    def write(self, lines, ts):
+        if not lines:
+            return
+        if self.segment_start==None:
+            self.segment_start = self.get_segment_start(ts)
+        with open(self.filename, 'a') as f:
+            f.write(''.join(lines))
+            size = f.tell()
+        if size>=self.max_size or ts - self.segment_start>=self.rotate_interval:
+            self.rotate(ts)
+
+    # segments sorted oldest first. name-001.gz sorts before name.gz, the
+    # order is compared without the extension
+    def get_segments(self):
+        segments = glob.glob(glob.escape(self.filename) + '.*')
+        return sorted(segments, key=self.get_segment_key)
+
+    def get_segment_key(self, segment):
+        return segment.endswith('.gz') and segment[:-3] or segment
+
+    # name of the next segment. a second rotation within the same second gets
+    # the next sequence number, os.replace() would overwrite the first one.
+    # the sequence continues after the newest segment, older ones might have
+    # been removed already
+    def get_rotated_name(self, ts):
+        name = '%s.%s' % (self.filename, time.strftime('%Y%m%d-%H%M%S', time.localtime(ts)))
+        segments = self.get_segments()
+        last = segments and self.get_segment_key(segments[-1]) or ''
+        seq = 0
+        if last==name:
+            seq = 1
+        elif last.startswith(name + '-') and last[len(name) + 1:].isdigit():
+            seq = int(last[len(name) + 1:]) + 1
+        rotated = seq and ('%s-%03u' % (name, seq)) or name
+        while os.path.exists(rotated) or os.path.exists(rotated + '.gz'):
+            seq += 1
+            rotated = '%s-%03u' % (name, seq)
+        return rotated
+
+    def rotate(self, ts):
+        rotated = self.get_rotated_name(ts)
+        os.replace(self.filename, rotated)
+        self.segment_start = ts
+        verbose('rotated series %s' % rotated)
+        if self.compress:
+            with open(rotated, 'rb') as src, gzip.open(rotated + '.gz', 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.unlink(rotated)
+        segments = self.get_segments()
+        for segment in segments[0:max(0, len(segments) - self.keep)]:
+            os.unlink(segment)
+
+    def flush(self):
+        self.write(self.take(), clock.time())
+
+HTTP_STATUS = {
+    200: 'OK',
+    304: 'Not Modified',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+}
+
+# minimal HTTP/1.1 server on a unix socket and/or TCP port for local
+# consumers. the status is serialized once when a value changes and served
+# from memory. clients can send If-None-Match with the ETag and ?wait=n to
+# wait up to n seconds for the next change
+class StatusServer(object):
+
+    def __init__(self, socket_path=None, port=None, host='127.0.0.1', max_wait=60.0, timeout=30.0):
+        self.socket_path = socket_path
+        self.port = port
+        self.host = host
+        self.max_wait = max_wait
+        # idle timeout of keep-alive connections
+        self.timeout = timeout
+        self.servers = []
+        self.data = None
+        self.version = 0
+        self.started = int(clock.time())
+        self.etag = None
+        self.body = b''
+        self.waiters = []
+        self.routes = {
+            '/': self.get_status,
+            '/status': self.get_status,
+            '/history': self.get_history,
+            '/metrics': self.get_metrics,
+            '/timing': self.get_timing,
+        }
+
+    async def start(self):
+        if self.socket_path:
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+            self.servers.append(await asyncio.start_unix_server(self.handle, self.socket_path))
+        if self.port:
+            self.servers.append(await asyncio.start_server(self.handle, self.host, self.port))
+
+    def stop(self):
+        for server in self.servers:
+            server.close()
+        self.servers = []
+        if self.socket_path and os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+    # returns True if the status has changed since the last call
+    def update(self):
+        data = fsc.get_status()
+        ts = data.pop('ts')
+        if data==self.data:
+            return False
+        self.data = data
+        self.version += 1
+        self.etag = '"%x-%x"' % (self.started, self.version)
+        data = dict(data)
+        data['ts'] = ts
+        self.body = json.dumps(data).encode()
+        for waiter in self.waiters:
+            if not waiter.done():
+                waiter.set_result(True)
+        self.waiters = []
+        return True
+
+    # wait for the next change or timeout seconds
+    async def wait(self, timeout):
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            done, pending = await asyncio.wait((waiter,), timeout=timeout)
+        finally:
+            waiter.cancel()
+        return bool(done)
+
+    async def get_status(self, query, headers):
+        etag = headers.get('if-none-match')
+        if 'wait' in query and (etag==None or etag==self.etag):
+            await self.wait(max(0, min(self.max_wait, float(query['wait']))))
+        if etag==self.etag:
+            return 304, None, b'', (('ETag', self.etag),)
+        return 200, 'application/json', self.body, (('ETag', self.etag),)
+
+    async def get_history(self, query, headers):
+        if history==None:
+            return 404, None, b'', ()
+        start = query.get('start')
+        end = query.get('end')
+        resolution = query.get('resolution')
+        start = start!=None and float(start) or None
+        end = end!=None and float(end) or None
+        resolution = resolution!=None and int(resolution) or None
+        result = history.query(start, end, int(query.get('points', 1000)), resolution)
+        return 200, 'application/json', json.dumps(result).encode(), ()
+
+    async def get_metrics(self, query, headers):
+        return 200, 'application/openmetrics-text; version=1.0.0; charset=utf-8', metrics.get_text(), ()
+
+    async def get_timing(self, query, headers):
+        return 200, 'application/json', json.dumps(metrics.get_timing()).encode(), ()
+
+    def response(self, status, content_type=None, body=b'', headers=(), head=False):
+        lines = ['HTTP/1.1 %u %s' % (status, HTTP_STATUS[status]), 'Content-Length: %u' % len(body)]
+        if content_type:
+            lines.append('Content-Type: %s' % content_type)
+        lines.extend('%s: %s' % item for item in headers)
+        header = ('\r\n'.join(lines) + '\r\n\r\n').encode()
+        if head:
+            return header
+        return header + body
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.timeout)
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+                    break
+                lines = request.decode('latin-1').split('\r\n')
+                parts = lines[0].split(' ')
+                if len(parts)!=3:
+                    writer.write(self.response(400))
+                    break
+                method, target, version = parts
+                headers = {}
+                for line in lines[1:]:
+                    name, sep, value = line.partition(':')
+                    if sep:
+                        headers[name.strip().lower()] = value.strip()
+                path, sep, query = target.partition('?')
+                route = self.routes.get(path)
+                if method not in ('GET', 'HEAD'):
+                    response = self.response(405, headers=(('Allow', 'GET, HEAD'),))
+                elif route==None:
+                    response = self.response(404)
+                else:
+                    try:
+                        status, content_type, body, extra = await route(dict(parse_qsl(query)), headers)
+                        response = self.response(status, content_type, body, extra, method=='HEAD')
+                    except ValueError:
+                        response = self.response(400)
+                writer.write(response)
+                await writer.drain()
+                if version!='HTTP/1.1' or headers.get('connection', '').lower()=='close':
+                    break
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            writer.close()
+
+def str_valid(s):
+    if not isinstance(s, str):
+        return False
+    if not s.strip():
+        return False
+    return True
+
+def update_log(args):
+    if not str_valid(args.log):
+        return
+    if args.log=='-':
+        print(fsc.get_json())
+    else:
+        verbose('temperature %.2f speed %.2f%% rpm %d, time %u, log %s' % (fsc.get_temp(), fsc.get_speed(), fsc.get_rpm(), clock.time(), args.log))
+        with metrics.span('log'):
+            # readers never see a partially written file
+            tmp_file = args.log + '.tmp'
+            with open(tmp_file, 'w') as f:
+                f.write(fsc.get_json())
+            os.replace(tmp_file, args.log)
+
+# shared memory status record of all fans, written in place
+def create_shm(args):
+    global shm
+    if not str_valid(args.shm):
+        return
+    try:
+        shm = StatusWriter(args.shm, [channel.name for channel in channels])
+    except OSError as e:
+        error('shm: %s' % e)
+
+def update_shm():
+    with metrics.span('shm'):
+        shm.write(clock.time(), fsc.interval, [(channel.fsc.get_temp(), channel.fsc.get_speed(), channel.fsc.get_rpm(), channel.fsc.stalled and FLAG_STALLED or 0) for channel in channels])
+
+def measure_rpm(duration = 2.5):
+    rpm_monitor.start()
+    rpm_monitor.window = duration
+    clock.sleep(duration)
+    fsc.rpm = rpm_monitor.update()
+    rpm_monitor.stop()
+
+    verbose("rpm measurement: estimator=%s count=%u frequency=%.2fHz speed=%.0f/rpm" % (rpm_monitor.estimator, rpm_monitor.count, fsc.rpm / 60.0, fsc.rpm))
+
+# steady state rpm at the duty cycle. the rpm is measured every second until
+# it changes less than 3%
+def measure_steady_rpm(channel, duty, settle):
+    hardware_pwm(channel.pin, int(duty * 10000))
+    clock.sleep(settle)
+    rpm = channel.rpm_monitor.update()
+    for i in range(10):
+        clock.sleep(1.0)
+        last_rpm, rpm = rpm, channel.rpm_monitor.update()
+        if abs(rpm - last_rpm)<=last_rpm * 0.03:
+            break
+    verbose('%sduty cycle %.1f%% rpm %.0f' % (get_channel_prefix(channel), duty, rpm))
+    return rpm
+
+# sweep the duty cycle from 100% down to the point where the fan stops, and
+# from there up until a stopped fan starts again
+def calibrate(channel, step, settle):
+    points = []
+    duty = 100.0
+    measure_steady_rpm(channel, duty, settle)
+    while duty>0:
+        rpm = measure_steady_rpm(channel, duty, settle)
+        if rpm==0:
+            break
+        points.append((duty, rpm))
+        duty -= step
+    if not points:
+        raise RuntimeError('no rpm signal at 100%% duty cycle on pin %u' % channel.args.rpm_pin)
+    # the sweep ended with the fan stopped. a fan with hysteresis does not
+    # start again at the last point, it is spun up at 100% first. find the
+    # stop duty in 1% steps below the last point
+    stop_duty = points[-1][0]
+    measure_steady_rpm(channel, 100.0, settle)
+    measure_steady_rpm(channel, stop_duty, settle)
+    duty = stop_duty - 1
+    while duty>0:
+        rpm = measure_steady_rpm(channel, duty, settle)
+        if rpm==0:
+            break
+        points.append((duty, rpm))
+        stop_duty = duty
+        duty -= 1
+    # the fan has stopped. raise the duty cycle until it starts
+    start_duty = 100.0
+    duty = stop_duty
+    while duty<100:
+        if measure_steady_rpm(channel, duty, settle)>0:
+            start_duty = duty
+            break
+        duty += 1
+    hardware_pwm(channel.pin, 0)
+    return FanCalibration.from_points(points, start_duty, stop_duty)
+
+def calibrate_channels(args):
+    results = {}
+    for channel in channels:
+        channel.rpm_monitor.start()
+        try:
+            calibration = calibrate(channel, max(1.0, args.calibrate_step), max(1.0, args.calibrate_settle))
+        finally:
+            channel.rpm_monitor.stop()
+        verbose('%sstart duty %.1f%% stop duty %.1f%% max. rpm %.0f' % (get_channel_prefix(channel), calibration.start_duty, calibration.stop_duty, calibration.expected_rpm(100)))
+        if str_valid(args.calibration_file):
+            save_calibration(args.calibration_file, channel.get_calibration_key(), calibration)
+        results[channel.name] = calibration.to_dict()
+    return results
+
+# pin 12, 13, 18 and 19 supported
+# level 0.0-100.0
+# pigpio raises pigpio.error or returns a negative error code
+def hardware_pwm(pin, duty):
+    try:
+        with metrics.span('pwm'):
+            result = fsc.pigpio.hardware_PWM(pin, args.frequency, duty)
+    except:
+        metrics.pigpio_errors += 1
+        raise
+    if result!=None and result<0:
+        metrics.pigpio_errors += 1
+    return result
+
+def set_pwm(channel, level, measure = True) :
+    fsc = channel.fsc
+    rpm_monitor = channel.rpm_monitor
+    if fsc.stalled and level>0:
+        level = fsc.args.failover_speed
+    elif level>0 and fsc.calibration:
+        # a stopped fan is started with at least start_duty
+        level = fsc.calibration.clamp(level, fsc.rpm>0)
+    if level!=fsc.pwm_level:
+        hardware_pwm(channel.pin, int(level * 10000))
+        # give the fan some time to spin up
+        if not fsc.pwm_level:
+            fsc.pwm_changed = clock.monotonic()
+        fsc.pwm_level = level
+    fsc.set_speed(level)
+    if measure and level==0:
+        # update the rpm until the fan has stopped
+        if fsc.rpm>0:
+            with metrics.span('rpm'):
+                fsc.rpm = rpm_monitor.update()
+        fsc.stalled = False
+    elif measure:
+        # the rpm monitor is running in the background and the value is updated without blocking
+        with metrics.span('rpm'):
+            fsc.rpm = rpm_monitor.update()
+        # a watchdog timeout read with the edges
+        check_tach_timeout(channel)
+        if fsc.rpm>0:
+            if fsc.stalled:
+                msg = 'rpm signal detected, stall cleared'
+                verbose('%s%s' % (get_channel_prefix(channel), msg))
+                mqtt.publish_alert(channel.name, 'recovered', msg)
+                fsc.stalled = False
+        elif not fsc.stalled and fsc.stall_timeout>0 and clock.monotonic() - fsc.pwm_changed >= fsc.stall_timeout and rpm_monitor.inactive_time() >= fsc.stall_timeout:
+            set_stalled(channel, 'no rpm signal after %.1f seconds' % fsc.stall_timeout)
+    update_watchdog(channel)
+
+# set the fan to the failover speed. the watchdog tries to restart it
+def set_stalled(channel, reason):
+    fsc = channel.fsc
+    level = fsc.args.failover_speed
+    error('%sstall detected, %s. setting speed to %.0f%%' % (get_channel_prefix(channel), reason, level))
+    metrics.stalls += 1
+    fsc.stalled = True
+    hardware_pwm(channel.pin, int(level * 10000))
+    fsc.pwm_level = level
+    fsc.set_speed(level)
+    # the edges of the spinning down fan are not a recovery
+    channel.rpm_monitor.clear()
+    fsc.rpm = 0
+    mqtt.publish_alert(channel.name, 'stall', reason)
+    update_watchdog(channel)
+    if channel.watchdog_event!=None:
+        channel.watchdog_event.set()
+
+# pigpiod reported that the tach gpio did not change for the watchdog timeout.
+# a fan without edges since it was started is left to the stall timeout
+def check_tach_timeout(channel):
+    rpm_monitor = channel.rpm_monitor
+    if not rpm_monitor.timeout_pending:
+        return
+    rpm_monitor.timeout_pending = False
+    fsc = channel.fsc
+    if not channel.watchdog_ms or not fsc.pwm_level or fsc.stalled:
+        return
+    if rpm_monitor.ticks_diff.get_idle_time()>=clock.monotonic() - fsc.pwm_changed:
+        return
+    set_stalled(channel, 'no tach signal for %.2f seconds' % (channel.watchdog_ms / 1000.0))
+
+# set the pigpiod watchdog of the tach gpio to the edge timeout while the
+# watchdog task is running. pigpiod is only called if the timeout changes by
+# more than 10%
+def update_watchdog(channel):
+    if channel.watchdog_event==None:
+        return
+    timeout = get_edge_timeout(channel)
+    ms = 0
+    if timeout!=None:
+        ms = max(1, min(60000, int(timeout * 1000)))
+    last = channel.watchdog_ms
+    if ms==last or (ms and last and abs(ms - last)<last * 0.1):
+        return
+    set_watchdog(channel, ms)
+
+def set_watchdog(channel, ms):
+    channel.watchdog_ms = ms
+    try:
+        result = channel.fsc.pigpio.set_watchdog(channel.args.rpm_pin, ms)
+    except:
+        metrics.pigpio_errors += 1
+        raise
+    if result!=None and result<0:
+        metrics.pigpio_errors += 1
+    return result
+
+# seconds without tach edge until the watchdog considers a running fan
+# stalled. the edge period is calculated from the rpm expected for the duty
+# cycle or the last measured rpm. None if no edges are expected
+def get_edge_timeout(channel):
+    fsc = channel.fsc
+    if fsc.args.tach_timeout<=0 or not fsc.pwm_level or fsc.stalled:
+        return None
+    rpm = fsc.rpm
+    if fsc.calibration:
+        rpm = fsc.get_expected_rpm(fsc.pwm_level)
+    if not rpm:
+        return None
+    # 2 edges per revolution
+    return max(fsc.args.tach_min_timeout, fsc.args.tach_timeout * 30.0 / rpm)
+
+# fan name for messages if more than one fan is used
+def get_channel_prefix(channel):
+    if len(channels)>1:
+        return '%s: ' % channel.name
+    return ''
+
+# cProfile and tracemalloc snapshots for --profile. a snapshot is written on
+# SIGUSR1 and at exit
+class Profiler(object):
+
+    def __init__(self, directory):
+        import cProfile
+        import tracemalloc
+        self.directory = directory
+        self.tracemalloc = tracemalloc
+        self.profile = cProfile.Profile()
+        self.counter = 0
+
+    def start(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.tracemalloc.start()
+        self.profile.enable()
+
+    # returns the filename without extension
+    def snapshot(self):
+        self.counter += 1
+        filename = os.path.join(self.directory, 'raspi_fanspeed-%u-%u' % (os.getpid(), self.counter))
+        # dump_stats() stops the profiler. the stats keep accumulating after enable()
+        self.profile.dump_stats(filename + '.prof')
+        self.profile.enable()
+        self.tracemalloc.take_snapshot().dump(filename + '.tracemalloc')
+        return filename
+
+    def stop(self):
+        filename = self.snapshot()
+        self.profile.disable()
+        self.tracemalloc.stop()
+        return filename
+
+# print the timing of the stages and write a profile snapshot
+def dump_handler():
+    print(metrics.get_timing_table())
+    if profiler:
+        print('profile written to %s.prof' % profiler.snapshot())
+    sys.stdout.flush()
+
+def signal_handler(sig):
+    verbose(sig==signal.SIGINT and 'SIGINT' or 'SIGTERM')
+    mqtt.signal_counter += 1
+    if mqtt.signal_counter>1:
+        print('sending SIGKILL')
+        os.kill(os.getpid(), signal.SIGKILL)
+    fsc.exit_code = sig==signal.SIGINT and 2 or 15
+    exit_event.set()
+
+# read the temperature and calculate the fan speed
+def read_sensors(channel):
+    fsc = channel.fsc
+    with metrics.span('sensors'):
+        fsc.set_temp(channel.sensors.read())
+    if fsc.pid:
+        target = fsc.pid_to_target_speed(fsc.get_temp(), cpu_load.read(clock.monotonic()))
+    else:
+        target = fsc.temp_to_target_speed(fsc.get_temp(), channel.sensors.speed)
+    fsc.update_interval()
+    verbose('%stemp %.2f speed %.2f%% rpm %.0f interval %.1f' % (get_channel_prefix(channel), fsc.get_temp(), target, fsc.get_rpm(), fsc.interval))
+    return target
+
+# single iteration of the control loop
+def loop_iteration():
+    for channel in channels:
+        set_pwm(channel, read_sensors(channel))
+
+# run functions that might block in a thread. with a virtual clock they are
+# called directly to keep the simulation deterministic
+async def run_blocking(func, *args):
+    if clock is not time:
+        return func(*args)
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+# call func every interval seconds. interval can be a function that returns
+# the next interval. iterations that missed their deadline are skipped
+async def run_periodic(name, interval, func):
+    loop = asyncio.get_running_loop()
+    next_run = loop.time()
+    while True:
+        try:
+            result = func()
+            if asyncio.iscoroutine(result):
+                await result
+        except Exception as e:
+            error('%s: %s' % (name, e))
+            if fsc.args.verbose:
+                raise e
+        if callable(interval):
+            next_run += interval()
+        else:
+            next_run += interval
+        now = loop.time()
+        if now>next_run:
+            verbose('%s: deadline missed by %.3f seconds' % (name, now - next_run))
+            metrics.overruns += 1
+            next_run = now
+        await asyncio.sleep(next_run - now)
+
+# wait until the event is set or timeout seconds have elapsed and clear it.
+# wait_for() is not used, it swallows a cancel that arrives while the event is
+# being set and the task never exits
+async def wait_event(event, timeout=None):
+    waiter = asyncio.ensure_future(event.wait())
+    try:
+        await asyncio.wait((waiter,), timeout=timeout)
+    finally:
+        waiter.cancel()
+    event.clear()
+
+# the rpm is checked every interval. a changed target speed is applied by the
+# sensor task right away
+async def pwm_task(channel):
+    while True:
+        await asyncio.sleep(channel.fsc.interval)
+        try:
+            set_pwm(channel, channel.fsc.target or 0)
+        except Exception as e:
+            error('pwm: %s' % e)
+            if fsc.args.verbose:
+                raise e
+
+# turn a stalled fan off for a second and back to the failover speed until the
+# tach signal returns or --restart-pulses attempts failed
+async def restart_fan(channel):
+    fsc = channel.fsc
+    level = fsc.args.failover_speed
+    for i in range(fsc.args.restart_pulses):
+        await asyncio.sleep(fsc.args.restart_interval)
+        if not fsc.stalled or channel.rpm_monitor.get_idle_time()<fsc.args.restart_interval:
+            return
+        verbose('%srestart attempt %u' % (get_channel_prefix(channel), i + 1))
+        hardware_pwm(channel.pin, 0)
+        await asyncio.sleep(1.0)
+        if not fsc.stalled:
+            return
+        hardware_pwm(channel.pin, int(level * 10000))
+    await asyncio.sleep(fsc.args.restart_interval)
+    if fsc.stalled and channel.rpm_monitor.get_idle_time()>=fsc.args.restart_interval:
+        msg = 'no tach signal after %u restart attempts' % fsc.args.restart_pulses
+        error('%sfan failed, %s' % (get_channel_prefix(channel), msg))
+        mqtt.publish_alert(channel.name, 'failed', msg)
+
+# the stall of a running fan is detected by the pigpiod watchdog of the tach
+# gpio. the task sleeps until a fan has stalled and tries to restart it
+async def watchdog_task(channel):
+    while True:
+        await wait_event(channel.watchdog_event)
+        if channel.fsc.stalled:
+            await restart_fan(channel)
+
+# the state is checked after each sample and published when it has changed
+# or the update interval has elapsed
+async def mqtt_task(mqtt_event):
+    while True:
+        await wait_event(mqtt_event, max(0, mqtt.next_update - clock.monotonic()))
+        await run_blocking(mqtt.client_publish, fsc.get_temp(), fsc.get_speed())
+
+# buffered samples are written every --series-flush seconds or when the
+# batch is full
+async def series_task(series_event):
+    while True:
+        await wait_event(series_event, args.series_flush)
+        try:
+            await run_blocking(metrics.timed('series', series.write), series.take(), clock.time())
+        except Exception as e:
+            error('series: %s' % e)
+            if fsc.args.verbose:
+                raise e
+
+async def run_daemon(backend):
+    global exit_event
+
+    loop = asyncio.get_running_loop()
+    if hasattr(clock, 'patch_loop'):
+        clock.patch_loop(loop)
+    exit_event = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, signal_handler, sig)
+    loop.add_signal_handler(signal.SIGUSR1, dump_handler)
+
+    series_event = asyncio.Event()
+    mqtt_event = asyncio.Event()
+    def update_sensors(channel):
+        start = time.perf_counter()
+        target = read_sensors(channel)
+        # the pwm is applied before the sample is recorded, history, status
+        # and mqtt show the new duty cycle and rpm
+        if target!=channel.fsc.pwm_level:
+            set_pwm(channel, target)
+        # history and series are recorded for the first fan
+        if channel.fsc is fsc:
+            ts = clock.time()
+            if history:
+                with metrics.span('history'):
+                    history.add(ts, fsc.get_temp(), fsc.get_speed(), fsc.get_rpm())
+            if series and series.append(ts, fsc.get_temp(), fsc.get_speed(), fsc.get_rpm()):
+                series_event.set()
+        mqtt_event.set()
+        metrics.sample(time.perf_counter() - start)
+        if status_server:
+            with metrics.span('status'):
+                status_server.update()
+        if shm:
+            update_shm()
+
+    if status_server:
+        try:
+            await status_server.start()
+        except OSError as e:
+            error('status server: %s' % e)
+
+    tasks = []
+    for channel in channels:
+        name = len(channels)>1 and 'sensors %s' % channel.name or 'sensors'
+        tasks.append(loop.create_task(run_periodic(name, lambda channel=channel: channel.fsc.interval, lambda channel=channel: update_sensors(channel))))
+        tasks.append(loop.create_task(pwm_task(channel)))
+        if args.tach_timeout>0:
+            channel.watchdog_event = asyncio.Event()
+            channel.rpm_monitor.on_timeout = lambda channel=channel: loop.call_soon_threadsafe(check_tach_timeout, channel)
+            channel.rpm_monitor.watch(loop, args.tach_holdoff)
+            update_watchdog(channel)
+            tasks.append(loop.create_task(watchdog_task(channel)))
+    if mqtt.available():
+        tasks.append(loop.create_task(mqtt_task(mqtt_event)))
+    if str_valid(args.log):
+        tasks.append(loop.create_task(run_periodic('log', args.log_interval or args.interval, lambda: run_blocking(update_log, args))))
+    if series:
+        tasks.append(loop.create_task(series_task(series_event)))
+    if args.simulate and args.sim_duration:
+        tasks.append(loop.create_task(asyncio.sleep(args.sim_duration)))
+
+    for task in tasks:
+        task.add_done_callback(lambda task: exit_event.set())
+    await exit_event.wait()
+
+    if status_server:
+        status_server.stop()
+    for task in tasks:
+        task.cancel()
+    for result in await asyncio.gather(*tasks, return_exceptions=True):
+        if isinstance(result, Exception) and not isinstance(result, asyncio.CancelledError):
+            raise result
+    for channel in channels:
+        channel.watchdog_event = None
+        if channel.watchdog_ms:
+            set_watchdog(channel, 0)
+
+# set up the global state for the given arguments and backend
+def init(_args, backend):
+    global fsc, mqtt, args, rpm_monitor, clock, sensors, channels, cpu_load, series, history, status_server, metrics, profiler
+
+    args = _args
+    clock = backend.clock
+    channels = create_channels(args, backend)
+    fsc = channels[0].fsc
+    rpm_monitor = channels[0].rpm_monitor
+    sensors = None
+    cpu_load = None
+    if [channel for channel in channels if channel.fsc.pid]:
+        cpu_load = backend.create_cpu_load(args.loadavg)
+    metrics = Metrics()
+    history = args.history>0 and History(args.history, clock) or None
+    series = None
+    if str_valid(args.series):
+        series = SeriesWriter(args.series, args.series_batch, args.series_max_size, args.series_rotate, args.series_keep, args.series_compress)
+    status_server = None
+    if str_valid(args.status_socket) or args.status_port:
+        status_server = StatusServer(args.status_socket, args.status_port, args.status_bind)
+    profiler = str_valid(args.profile) and Profiler(args.profile) or None
+    mqtt = NoMQTT()
+
+# discover the sensors of the channels
+def init_sensors(backend):
+    global sensors
+
+    create_channel_sensors(channels, backend)
+    sensors = channels[0].sensors
+
+# run the daemon or the commands that require pigpiod
+def main(args, hostname):
+    global mqtt
+
+    backend = create_backend(args)
+    init(args, backend)
+
+    if args.set:
+        level = max(0 ,min(100, args.set))
+        print("set level to %f" % level)
+        args.speed = level
+        args.onexit_speed = level
+        for channel in channels:
+            channel.fsc.pigpio.hardware_PWM(channel.pin, args.frequency, int(level * 10000))
+            channel.fsc.set_speed(level)
+
+        # mqtt
+        sys.exit(0)
+
+    # print table
+    if args.verbose:
+        print_speed_table(args)
+
+    if args.measure:
+        verbose('measing for %f seconds' % args.measure)
+        measure_rpm(args.measure)
+        print(int(fsc.rpm))
+        sys.exit(0)
+
+    if args.calibrate:
+        print(json.dumps(calibrate_channels(args), indent=2))
+        for channel in channels:
+            set_pwm(channel, channel.args.onexit_speed, measure=False)
+        backend.close()
+        sys.exit(0)
+
+    init_sensors(backend)
+    mqtt = create_mqtt(args, hostname)
+
+    for channel in channels:
+        channel.rpm_monitor.start()
+
+    # set speed once and exit
+    if args.interval<1:
+        loop_iteration()
+        update_log(args)
+        verbose('interval < 1 second, exiting...')
+        for channel in channels:
+            channel.rpm_monitor.stop()
+            channel.sensors.close()
+        backend.close()
+        sys.exit(0)
+
+    # check if mqtt is enabled
+    if mqtt.available():
+        mqtt.client_begin()
+        args.mqttupdateinterval = max(30, min(900, args.mqttupdateinterval))
+        mqtt.update_rate = args.mqttupdateinterval
+
+    fsc.create_pid()
+    create_shm(args)
+
+    if args.verbose:
+        verbose('min. fan speed %d%%' % args.min_fan)
+        verbose('sensors %s (%s)' % (', '.join(sensor.name for sensor in sensors.sensors), args.sensor_mode))
+        verbose('min. temperature %.2f°C' % args.min)
+        verbose('max. temperature %.2f°C' % args.max)
+        verbose('check interval %d seconds' % args.interval)
+        if fsc.pid:
+            verbose('pid target %.2f°C kp %.2f ki %.3f kd %.2f feed-forward %.1f%%' % (args.pid_target, args.pid_kp, args.pid_ki, args.pid_kd, args.feed_forward))
+        for channel in channels[1:]:
+            verbose('fan %s pin %u rpm pin %u sensors %s' % (channel.name, channel.pin, channel.args.rpm_pin, ', '.join(sensor.name for sensor in channel.sensors.sensors)))
+        if args.adaptive:
+            verbose('adaptive interval %.1f-%.1f seconds' % (args.min_interval, args.max_interval))
+        verbose('mqtt server %s' % mqtt.server())
+        if mqtt.available():
+            verbose('mqtt update interval %d seconds' % args.mqttupdateinterval)
+            verbose('mqtt device name %s' % args.mqttdevicename)
+            verbose('homeassistant prefix %s' % args.mqtthass)
+        if args.simulate:
+            verbose('simulated backend, duration %s' % (args.sim_duration and ('%.0f seconds' % args.sim_duration) or 'unlimited'))
+
+    if profiler:
+        profiler.start()
+    try:
+        asyncio.run(run_daemon(backend))
+    finally:
+        if profiler:
+            verbose('profile written to %s.prof' % profiler.stop())
+        if args.verbose:
+            print(metrics.get_timing_table())
+        for channel in channels:
+            channel.rpm_monitor.stop()
+            set_pwm(channel, channel.args.onexit_speed, measure=False)
+        update_log(args)
+        if shm:
+            update_shm()
+            shm.close()
+        if series:
+            series.flush()
+        mqtt.client_end()
+        fsc.remove_pid()
+        if args.simulate:
+            print(json.dumps(backend.get_stats()))
+        for channel in channels:
+            channel.sensors.close()
+        backend.close()
+    sys.exit(fsc.exit_code)
@@ -0,0 +1,116 @@
+# in memory history of the samples
+
+import time
+import array
+
+HISTORY_SERIES = ('temperature', 'duty_cycle', 'rpm')
+
+# ring buffer of buckets with a fixed resolution in seconds. each bucket
+# stores count, min, max and sum of all series. the values of the series
+# are interleaved, series j of bucket i is stored at i * len(HISTORY_SERIES) + j
+class HistoryLevel(object):
+
+    __slots__ = ('resolution', 'size', 'keys', 'count', 'min', 'max', 'sum')
+
+    def __init__(self, resolution, size):
+        self.resolution = resolution
+        self.size = size
+        n = len(HISTORY_SERIES)
+        # ts // resolution of the bucket, 0 is empty
+        self.keys = array.array('I', [0]) * size
+        self.count = array.array('H', [0]) * size
+        self.min = array.array('f', [0.0]) * (size * n)
+        self.max = array.array('f', [0.0]) * (size * n)
+        self.sum = array.array('f', [0.0]) * (size * n)
+
+    def get_retention(self):
+        return self.resolution * self.size
+
+    def add(self, ts, values):
+        key = int(ts // self.resolution)
+        slot = key % self.size
+        j = slot * len(values)
+        if self.keys[slot]!=key:
+            self.keys[slot] = key
+            self.count[slot] = 1
+            for i, value in enumerate(values):
+                self.min[j + i] = value
+                self.max[j + i] = value
+                self.sum[j + i] = value
+            return
+        if self.count[slot]<65535:
+            self.count[slot] += 1
+        for i, value in enumerate(values):
+            if value<self.min[j + i]:
+                self.min[j + i] = value
+            if value>self.max[j + i]:
+                self.max[j + i] = value
+            self.sum[j + i] += value
+
+    # buckets between start and end
+    def get(self, start, end):
+        n = len(HISTORY_SERIES)
+        last = int(end // self.resolution)
+        first = max(int(start // self.resolution), last - self.size + 1)
+        result = {'resolution': self.resolution, 'ts': []}
+        for name in HISTORY_SERIES:
+            result[name] = {'min': [], 'max': [], 'avg': []}
+        for key in range(first, last + 1):
+            slot = key % self.size
+            if self.keys[slot]!=key:
+                continue
+            result['ts'].append(key * self.resolution)
+            count = self.count[slot]
+            for i, name in enumerate(HISTORY_SERIES):
+                j = slot * n + i
+                series = result[name]
+                # the values are stored as float32
+                series['min'].append(round(self.min[j], 2))
+                series['max'].append(round(self.max[j], 2))
+                series['avg'].append(round(self.sum[j] / count, 2))
+        return result
+
+# in memory history with 1 second, 1 minute and 1 hour resolution
+class History(object):
+
+    def __init__(self, hours=24, clock=time):
+        self.clock = clock
+        self.levels = [
+            HistoryLevel(1, int(hours * 3600)),
+            HistoryLevel(60, 7 * 24 * 60),
+            HistoryLevel(3600, 365 * 24),
+        ]
+        self.last_ts = None
+
+    def add(self, ts, temp, speed, rpm):
+        values = (temp, speed, rpm)
+        for level in self.levels:
+            level.add(ts, values)
+        self.last_ts = ts
+
+    # returns min, max and avg of all series between start and end. the
+    # finest resolution that covers start and returns at most max_points
+    # buckets is used unless a resolution is requested. a requested
+    # resolution returns the last max_points buckets before end, an unknown
+    # one raises ValueError
+    def query(self, start=None, end=None, max_points=1000, resolution=None):
+        if end==None:
+            end = self.last_ts or self.clock.time()
+        if start==None:
+            start = end - 3600
+        if resolution!=None:
+            levels = [item for item in self.levels if item.resolution==resolution]
+            if not levels:
+                raise ValueError('invalid resolution %s, expected %s' % (resolution, ', '.join(str(item.resolution) for item in self.levels)))
+            level = levels[0]
+            start = max(start, end - (max_points - 1) * resolution)
+        else:
+            level = self.levels[-1]
+            for item in self.levels:
+                if (self.last_ts or end) - start<=item.get_retention() and (end - start) / item.resolution<=max_points:
+                    level = item
+                    break
+        result = level.get(start, end)
+        result['start'] = start
+        result['end'] = end
+        return result
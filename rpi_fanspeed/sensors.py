@@ -0,0 +1,87 @@
+# sysfs temperature sensors
+
+import os
+import os.path
+import glob
+
+# sysfs temperature input in m°C. the file stays open and is read with pread()
+class Sensor(object):
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.fd = None
+        self.temp = None
+
+    def open(self):
+        if self.fd==None:
+            self.fd = os.open(self.path, os.O_RDONLY)
+
+    def close(self):
+        if self.fd!=None:
+            os.close(self.fd)
+            self.fd = None
+
+    def read(self):
+        self.open()
+        try:
+            self.temp = int(os.pread(self.fd, 16, 0)) / 1000.0
+        except:
+            # reopen the file on the next read
+            self.close()
+            raise
+        return self.temp
+
+# find thermal zones and hwmon temperature inputs
+def discover_sensors(sysfs='/sys/class'):
+    sensors = []
+    for path in sorted(glob.glob(os.path.join(sysfs, 'thermal/thermal_zone*/temp'))):
+        sensors.append(Sensor(os.path.basename(os.path.dirname(path)), path))
+    for path in sorted(glob.glob(os.path.join(sysfs, 'hwmon/hwmon*/temp*_input'))):
+        hwmon = os.path.dirname(path)
+        try:
+            with open(os.path.join(hwmon, 'name'), 'r') as f:
+                name = f.readline().strip()
+        except:
+            name = os.path.basename(hwmon)
+        sensors.append(Sensor('%s_%s' % (name, os.path.basename(path)[0:-6]), path))
+    return sensors
+
+# reads a list of sensors and combines the temperatures
+#
+# max       highest temperature
+# mean      weighted mean of all temperatures
+# curve     each sensor has its own fan curve and the highest duty cycle is used
+class SensorGroup(object):
+
+    def __init__(self, sensors, mode='max', weights=None, curves=None):
+        self.sensors = sensors
+        self.mode = mode
+        self.weights = [(weights or {}).get(sensor.name, 1.0) for sensor in sensors]
+        self.curves = [(curves or {}).get(sensor.name) for sensor in sensors]
+        self.temp = None
+        self.speed = None
+
+    # returns the temperature. in curve mode the temperature of the sensor
+    # that requires the highest duty cycle
+    def read(self):
+        temps = [sensor.read() for sensor in self.sensors]
+        if self.mode=='mean':
+            self.temp = sum(temp * weight for temp, weight in zip(temps, self.weights)) / sum(self.weights)
+        elif self.mode=='curve':
+            self.speed = None
+            for temp, curve in zip(temps, self.curves):
+                speed = curve.get_speed(temp)
+                if self.speed==None or speed>self.speed:
+                    self.speed = speed
+                    self.temp = temp
+        else:
+            self.temp = max(temps)
+        return self.temp
+
+    def get_temps(self):
+        return dict((sensor.name, sensor.temp) for sensor in self.sensors)
+
+    def close(self):
+        for sensor in self.sensors:
+            sensor.close()
@@ -0,0 +1,156 @@
+# fixed layout status record in a memory mapped file, i.e. under /dev/shm.
+# the daemon updates it in place with each sensor update, readers in other
+# processes map the file once and read it without syscalls or JSON parsing
+#
+# layout, little endian:
+#
+#   0   magic 'RPFS', layout version (uint16), number of fans (uint16),
+#       size of a fan record (uint32), pid of the writer (uint32). the pid is
+#       set to 0 when the daemon exits
+#   16  sequence counter (uint64). odd while the writer updates the values
+#   24  crc32 of the values (uint32), 4 bytes padding
+#   32  time of the update (double, unix time), update interval in seconds
+#       (double)
+#   48  one record per fan: name (16 bytes, utf-8, zero padded), temperature,
+#       duty cycle and rpm (float), flags (uint32)
+#
+# python cannot issue memory barriers. on cpus that reorder stores the
+# sequence counter alone does not guarantee a consistent read, the reader
+# also checks the crc32 of the values
+
+import os
+import mmap
+import struct
+import zlib
+
+MAGIC = b'RPFS'
+LAYOUT_VERSION = 1
+HEADER = struct.Struct('<4sHHII')
+PID = struct.Struct('<I')
+PID_OFFSET = 12
+SEQ = struct.Struct('<Q')
+SEQ_OFFSET = 16
+CRC = struct.Struct('<I')
+CRC_OFFSET = 24
+VALUES = struct.Struct('<dd')
+VALUES_OFFSET = 32
+NAME_SIZE = 16
+FAN = struct.Struct('<%usfffI' % NAME_SIZE)
+FANS_OFFSET = VALUES_OFFSET + VALUES.size
+
+# flags of a fan
+FLAG_STALLED = 0x01
+
+def get_size(fans):
+    return FANS_OFFSET + FAN.size * fans
+
+class StatusWriter(object):
+
+    def __init__(self, filename, names):
+        self.filename = filename
+        self.names = [name.encode('utf-8')[0:NAME_SIZE] for name in names]
+        self.size = get_size(len(names))
+        self.seq = 0
+        # the values are packed into a buffer first to calculate the crc
+        self.buffer = bytearray(self.size - VALUES_OFFSET)
+        # readers never see a partially initialized file
+        tmp_file = filename + '.tmp'
+        fd = os.open(tmp_file, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, self.size)
+            self.mmap = mmap.mmap(fd, self.size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        finally:
+            os.close(fd)
+        HEADER.pack_into(self.mmap, 0, MAGIC, LAYOUT_VERSION, len(names), FAN.size, os.getpid())
+        os.replace(tmp_file, filename)
+
+    # fans is a list of temperature, duty cycle, rpm and flags in the order of
+    # the names
+    def write(self, ts, interval, fans):
+        buffer = self.buffer
+        VALUES.pack_into(buffer, 0, ts, interval)
+        offset = FANS_OFFSET - VALUES_OFFSET
+        for name, (temp, duty_cycle, rpm, flags) in zip(self.names, fans):
+            FAN.pack_into(buffer, offset, name, temp, duty_cycle, rpm, flags)
+            offset += FAN.size
+        m = self.mmap
+        self.seq += 1
+        SEQ.pack_into(m, SEQ_OFFSET, self.seq)
+        m[VALUES_OFFSET:self.size] = buffer
+        CRC.pack_into(m, CRC_OFFSET, zlib.crc32(buffer))
+        self.seq += 1
+        SEQ.pack_into(m, SEQ_OFFSET, self.seq)
+
+    # the pid is cleared to tell readers that the daemon has stopped
+    def close(self, remove=True):
+        PID.pack_into(self.mmap, PID_OFFSET, 0)
+        self.mmap.close()
+        if remove:
+            try:
+                os.unlink(self.filename)
+            except OSError:
+                pass
+
+class StatusReader(object):
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, mmap.MAP_SHARED, mmap.PROT_READ)
+        magic, version, fans, fan_size, pid = HEADER.unpack_from(self.mmap, 0)
+        if magic!=MAGIC or version!=LAYOUT_VERSION or fan_size!=FAN.size or len(self.mmap)<get_size(fans):
+            self.mmap.close()
+            raise ValueError('%s: invalid status record' % filename)
+        self.fans = fans
+        self.size = get_size(fans)
+
+    def get_pid(self):
+        return PID.unpack_from(self.mmap, PID_OFFSET)[0]
+
+    def get_seq(self):
+        return SEQ.unpack_from(self.mmap, SEQ_OFFSET)[0]
+
+    # returns seq, time of the update, interval and a list of name,
+    # temperature, duty cycle, rpm and flags of each fan. None if no
+    # consistent copy could be read
+    def read_values(self, retries=1000):
+        m = self.mmap
+        for i in range(retries):
+            seq = SEQ.unpack_from(m, SEQ_OFFSET)[0]
+            if seq & 1 or seq==0:
+                continue
+            crc = CRC.unpack_from(m, CRC_OFFSET)[0]
+            data = m[VALUES_OFFSET:self.size]
+            if SEQ.unpack_from(m, SEQ_OFFSET)[0]!=seq or zlib.crc32(data)!=crc:
+                continue
+            ts, interval = VALUES.unpack_from(data, 0)
+            fans = []
+            for offset in range(FANS_OFFSET - VALUES_OFFSET, len(data), FAN.size):
+                name, temp, duty_cycle, rpm, flags = FAN.unpack_from(data, offset)
+                fans.append((name.rstrip(b'\0').decode('utf-8', 'replace'), temp, duty_cycle, rpm, flags))
+            return seq, ts, interval, fans
+        return None
+
+    # the values of the first fan in the format of the JSON status, as numbers
+    def read(self, retries=1000):
+        values = self.read_values(retries)
+        if values==None:
+            return None
+        seq, ts, interval, fans = values
+        name, temp, duty_cycle, rpm, flags = fans[0]
+        data = {
+            'temperature': round(temp, 2),
+            'duty_cycle': round(duty_cycle, 2),
+            'rpm': int(rpm),
+            'ts': ts,
+            'interval': interval,
+            'seq': seq,
+        }
+        if flags & FLAG_STALLED:
+            data['stalled'] = True
+        if len(fans)>1:
+            data['fans'] = dict((name, {'temperature': round(temp, 2), 'duty_cycle': round(duty_cycle, 2), 'rpm': int(rpm), 'stalled': bool(flags & FLAG_STALLED)}) for name, temp, duty_cycle, rpm, flags in fans)
+        return data
+
+    def close(self):
+        self.mmap.close()
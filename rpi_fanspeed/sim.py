@@ -0,0 +1,533 @@
+# simulated pigpio and thermal backend for the daemon, and a stand-in for
+# paho-mqtt
+#
+# the simulation runs on a virtual clock. sleeping advances the clock without
+# waiting and steps the fan and heat model, which allows to run a day of the
+# control loop in a few seconds
+
+import os
+import time
+import types
+import array
+import math
+import random
+
+# pigpio constants
+RISING_EDGE = 0
+FALLING_EDGE = 1
+EITHER_EDGE = 2
+TIMEOUT = 2
+NTFY_FLAGS_WDOG = 1 << 5
+
+class VirtualClock(object):
+
+    def __init__(self, start_time=None, resolution=0.25):
+        self.now = 0.0
+        self.start_time = start_time==None and time.time() or start_time
+        # max. step size of the models in seconds
+        self.resolution = resolution
+        self.listeners = []
+        # set if a simulated notification pipe became readable or a callback
+        # reported a watchdog timeout
+        self.wakeup = False
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.start_time + self.now
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    # advance the clock in steps and call listener(dt, end) for each step.
+    # stop() is called after steps that set wakeup, the clock stops early if it
+    # returns True
+    def advance(self, duration, stop=None):
+        end = self.now + duration
+        while self.now<end:
+            dt = min(self.resolution, end - self.now)
+            self.now += dt
+            for listener in self.listeners:
+                listener(dt, end)
+            if self.wakeup and stop!=None:
+                self.wakeup = False
+                if stop():
+                    return
+        self.now = end
+
+    def sleep(self, duration):
+        if duration>0:
+            self.advance(duration)
+
+    # run an asyncio event loop on the virtual clock. instead of waiting for
+    # the next timer, the selector advances the clock. it stops early if a
+    # watched pipe becomes readable
+    def patch_loop(self, loop):
+        selector = loop._selector
+        select = selector.select
+        def virtual_select(timeout=None):
+            events = select(0)
+            if not events and timeout:
+                def stop():
+                    events.extend(select(0))
+                    return events
+                self.advance(timeout, stop)
+            return events
+        selector.select = virtual_select
+        loop.time = self.monotonic
+
+
+class FanModel(object):
+
+    def __init__(self, pwm_gpio, tach_gpio, max_rpm=5000, start_duty=25.0, stop_duty=15.0, tau=1.0):
+        self.pwm_gpio = pwm_gpio
+        self.tach_gpio = tach_gpio
+        self.max_rpm = max_rpm
+        # a stopped fan needs more than start_duty to spin up and stops below stop_duty
+        self.start_duty = start_duty
+        self.stop_duty = stop_duty
+        self.tau = tau
+        self.duty = 0.0
+        self.rpm = 0.0
+        self.stalled = False
+        self.edge_phase = 0.0
+
+    def get_target_rpm(self):
+        if self.stalled or self.duty<self.stop_duty:
+            return 0.0
+        if self.rpm<1.0 and self.duty<self.start_duty:
+            return 0.0
+        return self.max_rpm * pow(self.duty / 100.0, 0.85)
+
+    def get_airflow(self):
+        return self.rpm / self.max_rpm
+
+    def step(self, dt):
+        target = self.get_target_rpm()
+        self.rpm += (target - self.rpm) * (1.0 - math.exp(-dt / self.tau))
+        if target==0 and self.rpm<50:
+            self.rpm = 0.0
+
+    # number of tach edges during the last step. the tachometer creates 2 pulses per revolution
+    def edges(self, dt):
+        self.edge_phase += self.rpm / 60.0 * 2.0 * dt
+        n = int(self.edge_phase)
+        self.edge_phase -= n
+        return n
+
+
+class ThermalModel(object):
+
+    def __init__(self, ambient=25.0, idle_power=3.0, load_power=6.0, capacity=20.0, passive=0.1, active=0.25, throttle_temp=80.0):
+        self.ambient = ambient
+        self.temp = ambient + 10.0
+        # power in W, heat capacity in J/K and thermal conductance in W/K
+        self.idle_power = idle_power
+        self.load_power = load_power
+        self.capacity = capacity
+        self.passive = passive
+        self.active = active
+        self.throttle_temp = throttle_temp
+        self.throttled = False
+
+    def step(self, dt, load, airflow):
+        self.throttled = self.temp>=self.throttle_temp
+        if self.throttled:
+            load *= 0.5
+        power = self.idle_power + self.load_power * load
+        conductance = self.passive + self.active * airflow
+        # exact solution for a constant power and conductance during the step
+        steady = self.ambient + power / conductance
+        self.temp = steady + (self.temp - steady) * math.exp(-dt * conductance / self.capacity)
+
+
+class DailyLoad(object):
+
+    def __init__(self, seed=0, base=0.1, daily=0.35, burst_interval=900.0, burst_duration=120.0):
+        self.random = random.Random(seed)
+        self.base = base
+        self.daily = daily
+        self.burst_interval = burst_interval
+        self.burst_duration = burst_duration
+        self.burst_start = self.random.uniform(0, burst_interval)
+
+    def __call__(self, t):
+        load = self.base + self.daily * (0.5 - 0.5 * math.cos(2.0 * math.pi * t / 86400.0))
+        if t>=self.burst_start + self.burst_duration:
+            self.burst_start += self.random.expovariate(1.0 / self.burst_interval) + self.burst_duration
+        if t>=self.burst_start:
+            load = 1.0
+        return min(1.0, load)
+
+
+class SimulatedCallback(object):
+
+    def __init__(self, pi, gpio, edge, func):
+        self.pi = pi
+        self.gpio = gpio
+        self.edge = edge
+        self.func = func
+        self.count = 0
+
+    def cancel(self):
+        if self in self.pi.callbacks:
+            self.pi.callbacks.remove(self)
+
+    def tally(self):
+        return self.count
+
+    def reset_tally(self):
+        self.count = 0
+
+
+# n ticks with a constant period. pigpio ticks are 32 bit and wrap around
+def ticks_range(start, n, step):
+    ticks = array.array('I')
+    start &= 0xffffffff
+    while n>0:
+        count = min(n, (0x100000000 - start + step - 1) // step)
+        ticks.extend(range(start, start + count * step, step))
+        start = (start + count * step) & 0xffffffff
+        n -= count
+    return ticks
+
+# notification pipe of a gpio. the edges are stored as pigpio reports, a
+# rising edge half a period before each falling edge. fd is readable while
+# reports are stored
+class SimulatedNotify(object):
+
+    def __init__(self, pi, gpio):
+        self.pi = pi
+        self.gpio = gpio
+        self.data = bytearray()
+        self.fd, self._write_fd = os.pipe()
+        self._readable = False
+
+    def append(self, data):
+        self.data += data
+        if not self._readable:
+            self._readable = True
+            os.write(self._write_fd, b'\0')
+            self.pi.clock.wakeup = True
+
+    def add_edges(self, n, end, period):
+        step = max(2, int(period * 1000000))
+        first = int(end * 1000000) - (n - 1) * step
+        falling = ticks_range(first, n, step)
+        rising = ticks_range(first - step // 2, n, step)
+        # sequence number and flags, tick, level
+        words = array.array('I', [0]) * (6 * n)
+        words[1::6] = rising
+        words[2::6] = array.array('I', [1 << self.gpio]) * n
+        words[4::6] = falling
+        self.append(words.tobytes())
+
+    def add_watchdog(self, tick):
+        self.append(array.array('I', [(NTFY_FLAGS_WDOG | self.gpio) << 16, tick, 0]).tobytes())
+
+    def readinto(self, buf):
+        n = min(len(buf), len(self.data))
+        buf[:n] = self.data[:n]
+        del self.data[:n]
+        if not self.data and self._readable:
+            self._readable = False
+            os.read(self.fd, 1)
+        return n
+
+    def close(self):
+        if self in self.pi.notifications:
+            self.pi.notifications.remove(self)
+            os.close(self.fd)
+            os.close(self._write_fd)
+
+
+# subset of pigpio.pi used by the daemon
+class SimulatedPi(object):
+
+    def __init__(self, clock, fans):
+        self.clock = clock
+        self.fans = fans
+        self.connected = True
+        self.callbacks = []
+        self.notifications = []
+        self.modes = {}
+        self.pwm = {}
+        self.pwm_writes = 0
+        # timeout and seconds without edge of each gpio with a watchdog
+        self.watchdogs = {}
+
+    def get_current_tick(self):
+        return int(self.clock.monotonic() * 1000000) & 0xffffffff
+
+    def set_mode(self, gpio, mode):
+        self.modes[gpio] = mode
+        return 0
+
+    def set_pull_up_down(self, gpio, pud):
+        return 0
+
+    def hardware_PWM(self, gpio, PWMfreq, PWMduty):
+        self.pwm_writes += 1
+        self.pwm[gpio] = (PWMfreq, PWMduty)
+        for fan in self.fans:
+            if fan.pwm_gpio==gpio:
+                fan.duty = PWMduty / 10000.0
+        return 0
+
+    def callback(self, user_gpio, edge=RISING_EDGE, func=None):
+        cb = SimulatedCallback(self, user_gpio, edge, func)
+        self.callbacks.append(cb)
+        return cb
+
+    def set_watchdog(self, user_gpio, wdog_timeout):
+        if wdog_timeout:
+            self.watchdogs[user_gpio] = [wdog_timeout / 1000.0, 0.0]
+        else:
+            self.watchdogs.pop(user_gpio, None)
+        return 0
+
+    # pigpiod reports a timeout if the gpio did not change for the watchdog
+    # timeout, and again after each timeout
+    def step_watchdog(self, gpio, n, dt):
+        watchdog = self.watchdogs.get(gpio)
+        if watchdog==None:
+            return
+        if n:
+            watchdog[1] = 0.0
+            return
+        watchdog[1] += dt
+        if watchdog[1]<watchdog[0]:
+            return
+        watchdog[1] = 0.0
+        tick = self.get_current_tick()
+        for cb in self.callbacks:
+            if cb.gpio==gpio and cb.func!=None:
+                cb.func(gpio, TIMEOUT, tick)
+                # the callback may have scheduled a call in the event loop
+                self.clock.wakeup = True
+        for notify in self.notifications:
+            if notify.gpio==gpio:
+                notify.add_watchdog(tick)
+
+    # the tally of the callbacks includes the edges that are not emitted
+    def count_edges(self, gpio, n):
+        for cb in self.callbacks:
+            if cb.gpio==gpio and cb.edge!=RISING_EDGE:
+                cb.count += n
+
+    def emit_edges(self, gpio, n, end, period):
+        for cb in self.callbacks:
+            if cb.gpio!=gpio or cb.edge==RISING_EDGE or cb.func==None:
+                continue
+            for i in range(n):
+                tick = int((end - (n - 1 - i) * period) * 1000000) & 0xffffffff
+                cb.func(gpio, 0, tick)
+        for notify in self.notifications:
+            if notify.gpio==gpio:
+                notify.add_edges(n, end, period)
+
+    def stop(self):
+        self.connected = False
+
+
+class SimulatedSensor(object):
+
+    def __init__(self, name, read):
+        self.name = name
+        self.path = 'sim:%s' % name
+        self._read = read
+        self.temp = None
+
+    def read(self):
+        self.temp = self._read()
+        return self.temp
+
+    def close(self):
+        pass
+
+
+# cpu load of the load model, replaces /proc/stat
+class SimulatedCpuLoad(object):
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.load = 0.0
+
+    def read(self, now):
+        self.load = self.backend.load(self.backend.clock.now)
+        return self.load
+
+
+class SimulatedBackend(object):
+
+    def __init__(self, fans=((19, 16),), ambient=25.0, load='daily', stall_after=None, seed=0, noise=0.1, edge_window=1.0, window_edges=32):
+        self.name = 'simulated'
+        self.clock = VirtualClock()
+        self.fans = [FanModel(pwm_gpio, tach_gpio) for pwm_gpio, tach_gpio in fans]
+        self.pi = SimulatedPi(self.clock, self.fans)
+        self.thermal = ThermalModel(ambient=ambient)
+        if load=='daily':
+            self.load = DailyLoad(seed)
+        else:
+            load = min(1.0, max(0.0, float(load)))
+            self.load = lambda t: load
+        self.stall_after = stall_after
+        self.random = random.Random(seed)
+        self.noise = noise
+        # only the last window_edges edges before the clock stops are sent to
+        # the callbacks, at most the edges of the last edge_window seconds. the
+        # period estimator of the daemon keeps 32 edges. the tally of the
+        # callbacks and stats['edges'] count all edges, the edge count of the
+        # daemon and the tach_edges metric only the emitted ones
+        self.edge_window = edge_window
+        self.window_edges = window_edges
+        self.stats = {
+            'time': 0.0,
+            'max_temperature': self.thermal.temp,
+            'throttled_time': 0.0,
+            'duty_cycle_time': 0.0,
+            'edges': 0,
+        }
+        self.clock.add_listener(self.step)
+
+    def step(self, dt, end):
+        now = self.clock.now
+        if self.stall_after!=None and now>=self.stall_after:
+            for fan in self.fans:
+                fan.stalled = True
+        airflow = 0.0
+        for fan in self.fans:
+            fan.step(dt)
+            airflow += fan.get_airflow()
+            n = fan.edges(dt)
+            if n:
+                self.stats['edges'] += n
+                self.pi.count_edges(fan.tach_gpio, n)
+                period = 30.0 / fan.rpm
+                if end - now<min(self.edge_window, self.window_edges * period):
+                    self.pi.emit_edges(fan.tach_gpio, n, now - fan.edge_phase * period, period)
+            if self.pi.watchdogs:
+                self.pi.step_watchdog(fan.tach_gpio, n, dt)
+            self.stats['duty_cycle_time'] += fan.duty * dt
+        self.thermal.step(dt, self.load(now), airflow)
+        stats = self.stats
+        stats['time'] += dt
+        stats['max_temperature'] = max(stats['max_temperature'], self.thermal.temp)
+        if self.thermal.throttled:
+            stats['throttled_time'] += dt
+
+    def read_temp(self):
+        return round(self.thermal.temp + self.random.uniform(-self.noise, self.noise), 3)
+
+    def discover_sensors(self):
+        ambient = self.thermal.ambient
+        return [
+            SimulatedSensor('thermal_zone0', self.read_temp),
+            # the PMIC follows the SoC temperature
+            SimulatedSensor('pmic', lambda: round(ambient + (self.thermal.temp - ambient) * 0.6, 3)),
+        ]
+
+    def create_cpu_load(self, loadavg=False):
+        return SimulatedCpuLoad(self)
+
+    def open_notify(self, gpio):
+        notify = SimulatedNotify(self.pi, gpio)
+        self.pi.notifications.append(notify)
+        return notify
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['pwm_writes'] = self.pi.pwm_writes
+        stats['avg_duty_cycle'] = stats['time'] and stats['duty_cycle_time'] / stats['time'] / len(self.fans) or 0.0
+        del stats['duty_cycle_time']
+        return stats
+
+    def close(self):
+        self.pi.stop()
+
+
+# paho.mqtt.client.MQTTMessage stand-in
+class StandInMessage(object):
+
+    def __init__(self, topic, payload, qos=0, retain=False):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+
+# delivers the messages synchronously to the clients with a matching
+# subscription
+class StandInBroker(object):
+
+    def __init__(self):
+        self.subscriptions = []
+        self.retained = {}
+
+    @staticmethod
+    def topic_matches(sub, topic):
+        sub = sub.split('/')
+        topic = topic.split('/')
+        for i, level in enumerate(sub):
+            if level=='#':
+                return True
+            if i>=len(topic) or (level!='+' and level!=topic[i]):
+                return False
+        return len(sub)==len(topic)
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        if retain:
+            self.retained[topic] = payload
+        msg = StandInMessage(topic, payload, qos, retain)
+        for sub, client in self.subscriptions:
+            if self.topic_matches(sub, topic):
+                client.on_message(client, None, msg)
+
+# paho.mqtt.client.Client stand-in. connects immediately and counts the
+# published messages. without a broker the messages are dropped
+class StandInClient(object):
+
+    def __init__(self, client_id=None, clean_session=True, broker=None):
+        self.client_id = client_id
+        self.broker = broker
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_message = None
+        self.messages = 0
+
+    def reconnect_delay_set(self, min_delay=1, max_delay=120):
+        pass
+
+    def will_set(self, topic, payload=None, qos=0, retain=False):
+        pass
+
+    def connect(self, host=None, port=1883, keepalive=60):
+        self.on_connect(self, None, {}, 0)
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self, force=False):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def subscribe(self, topic, qos=0):
+        if self.broker!=None:
+            self.broker.subscriptions.append((topic, self))
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.messages += 1
+        if self.broker!=None:
+            self.broker.publish(topic, payload, qos, retain)
+
+# modules for sys.modules that import client_class as paho.mqtt.client.Client
+def create_paho(client_class=StandInClient):
+    paho = types.ModuleType('paho')
+    paho.mqtt = types.ModuleType('paho.mqtt')
+    paho.mqtt.client = types.ModuleType('paho.mqtt.client')
+    paho.mqtt.client.Client = client_class
+    return {'paho': paho, 'paho.mqtt': paho.mqtt, 'paho.mqtt.client': paho.mqtt.client}
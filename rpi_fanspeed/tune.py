@@ -0,0 +1,350 @@
+# offline curve tuner. replays recorded --series files against a grid of
+# --min, --max, --lin and --min-fan settings and reports the pareto-optimal
+# curves
+#
+#   raspi_fanspeed tune /var/log/raspi_fanspeed/series.json --threshold=65
+#
+# the series is reduced to histograms over 0.1°C temperature bins once, each
+# candidate is then evaluated with array operations over the bins:
+#
+# - the temperature of each bin is corrected for the airflow of the candidate
+#   with the steady state of a first order thermal model. the conductance
+#   with the fan at 100% is 1 + --fan-effect times the passive conductance
+# - the time above --threshold and the mean duty cycle are weighted by the
+#   time spent in each bin
+# - switches are counted by replaying the path of the temperature bins
+#   through the --deadband and --hysteresis rules of the daemon for all
+#   candidates at once. each candidate changes the duty cycle when the bin
+#   leaves the window around the bin of its last change
+
+import os
+import re
+import sys
+import glob
+import gzip
+import json
+import time
+import argparse
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from . import VERSION
+from .calibration import fit_polynomial
+
+# lines written by SeriesWriter.append(). other lines are parsed as JSON
+SERIES_LINE = re.compile(rb'^\{"ts":(-?[0-9.]+),"temperature":(-?[0-9.]+),"duty_cycle":(-?[0-9.]+),"rpm":([0-9]+)\}\r?$', re.M)
+SERIES_KEYS = ('ts', 'temperature', 'duty_cycle', 'rpm')
+
+# min:max:step range of values, max included
+def parse_range(value):
+    try:
+        parts = [float(part) for part in value.split(':')]
+        if len(parts)==1:
+            return [parts[0]]
+        start, end = parts[0:2]
+        step = len(parts)>2 and parts[2] or 1.0
+        if step<=0 or end<start:
+            raise ValueError()
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid range %s, expected min:max:step' % value)
+    return [start + i * step for i in range(int((end - start) / step + 1e-9) + 1)]
+
+def create_parser():
+    parser = argparse.ArgumentParser(prog='raspi_fanspeed tune', description='evaluate fan curves against recorded --series files and report the pareto-optimal settings')
+    parser.add_argument('series', nargs='+', help='series files. rotated segments of the files are included')
+    parser.add_argument('--threshold', type=float, help='temperature limit in °C', default=65.0)
+    parser.add_argument('--ambient', type=float, help='ambient temperature in °C', default=25.0)
+    parser.add_argument('--fan-effect', type=float, help='cooling of the fan at 100%% relative to the passive cooling', default=2.5)
+    parser.add_argument('--deadband', type=float, help='minimum change of the duty cycle in %%', default=1.0)
+    parser.add_argument('--hysteresis', type=float, help='temperature drop in °C required to lower the fan speed', default=1.0)
+    parser.add_argument('--min', type=float, help='current --min', default=45)
+    parser.add_argument('--max', type=float, help='current --max', default=70)
+    parser.add_argument('--lin', type=float, help='current --lin', default=1.0)
+    parser.add_argument('--min-fan', type=float, help='current --min-fan', default=40)
+    parser.add_argument('--min-range', type=parse_range, help='--min candidates', default=parse_range('35:60:2.5'))
+    parser.add_argument('--max-range', type=parse_range, help='--max candidates', default=parse_range('50:80:2.5'))
+    parser.add_argument('--lin-range', type=parse_range, help='--lin candidates', default=parse_range('0.5:2:0.25'))
+    parser.add_argument('--min-fan-range', type=parse_range, help='--min-fan candidates', default=parse_range('20:60:5'))
+    parser.add_argument('--top', type=int, help='number of pareto-optimal curves to print', default=20)
+    parser.add_argument('--json', action='store_true', help='print the results as JSON', default=False)
+    return parser
+
+def get_segments(filename):
+    files = sorted(glob.glob(glob.escape(filename) + '.*'))
+    if os.path.exists(filename):
+        files.append(filename)
+    return files
+
+# values of a series line in the order of SERIES_KEYS. None if the line is
+# torn or a value is missing
+def parse_series_line(line):
+    try:
+        data = json.loads(line)
+        return [float(data[key]) for key in SERIES_KEYS]
+    except (ValueError, KeyError, TypeError):
+        return None
+
+# samples of a series file and the number of lines that were skipped. a crash
+# while writing leaves a torn line, which is skipped
+def parse_series(data):
+    lines = data.count(b'\n') + (len(data)>0 and not data.endswith(b'\n'))
+    rows = SERIES_LINE.findall(data)
+    if len(rows)<lines:
+        rows = []
+        for line in data.splitlines():
+            if not line.strip():
+                lines -= 1
+                continue
+            match = SERIES_LINE.match(line)
+            values = match and match.groups() or parse_series_line(line)
+            if values!=None:
+                rows.append(values)
+    samples = numpy.array(rows, dtype=numpy.float64).reshape(-1, len(SERIES_KEYS))
+    return samples, lines - len(samples)
+
+# timestamp, temperature, duty cycle and rpm of each sample and the number of
+# skipped lines
+def load_series(filenames):
+    parts = []
+    skipped = 0
+    for filename in filenames:
+        for segment in get_segments(filename):
+            with (segment.endswith('.gz') and gzip.open or open)(segment, 'rb') as f:
+                samples, count = parse_series(f.read())
+            parts.append(samples)
+            skipped += count
+    samples = numpy.concatenate(parts or [numpy.empty((0, len(SERIES_KEYS)))])
+    if not len(samples):
+        raise ValueError('no samples in %s' % ', '.join(filenames))
+    samples = samples[numpy.argsort(samples[:, 0], kind='stable')]
+    return samples[:, 0], samples[:, 1], samples[:, 2], samples[:, 3], skipped
+
+# airflow 0.0-1.0 for the duty cycle from a fit of the recorded rpm. without
+# rpm the airflow is proportional to the duty cycle
+def create_airflow(duty, rpm):
+    running = (rpm>0) & (duty>0)
+    levels = numpy.round(duty[running])
+    if len(numpy.unique(levels))<3:
+        return lambda speed: speed / 100.0
+    unique, index = numpy.unique(levels, return_inverse=True)
+    means = numpy.bincount(index, rpm[running]) / numpy.bincount(index)
+    coefficients = fit_polynomial(list(zip(unique.tolist(), means.tolist())), 2)
+    def rpm_at(speed):
+        return sum(value * numpy.power(speed, i) for i, value in enumerate(coefficients))
+    max_rpm = float(rpm_at(100.0))
+    if max_rpm<=0:
+        return lambda speed: speed / 100.0
+    return lambda speed: numpy.where(speed>0, numpy.clip(rpm_at(speed) / max_rpm, 0.0, 1.0), 0.0)
+
+# FanCurve.from_linear() for arrays of temperatures and settings
+def get_speed(temp, min_temp, max_temp, lin, min_fan):
+    speed = numpy.power(numpy.maximum(temp - min_temp, 0.0), lin) / (max_temp - min_temp) * 100.0
+    speed = speed * (1.0 - min_fan / 100.0) + min_fan
+    return numpy.where(temp<min_temp, 0.0, numpy.clip(speed, 0.0, 100.0))
+
+# grid of settings, one column per candidate
+def create_candidates(args):
+    grid = numpy.array(numpy.meshgrid(args.min_range, args.max_range, args.lin_range, args.min_fan_range, indexing='ij')).reshape(4, -1)
+    return grid[:, grid[1]>grid[0] + 1.0]
+
+# temperature bins the fan speed follows. the speed is lowered if the
+# temperature dropped by hysteresis bins since the last change
+def hysteresis_filter(path, hysteresis):
+    result = []
+    current = path[0]
+    for value in path:
+        if value>current or value<=current - hysteresis:
+            current = value
+        result.append(current)
+    return numpy.array(result, dtype=numpy.int64)
+
+# histograms of the series over the temperature bins
+class SeriesHistograms(object):
+
+    def __init__(self, ts, temp, duty, airflow, hysteresis, resolution=0.1):
+        self.resolution = resolution
+        self.t0 = numpy.floor(temp.min() / resolution) * resolution
+        bins = ((temp - self.t0) / resolution + 0.5).astype(numpy.int64)
+        self.size = int(bins.max()) + 2
+        self.temps = self.t0 + numpy.arange(self.size) * resolution
+        # time of each sample until the next one. gaps in the recording are ignored
+        dt = numpy.diff(ts)
+        median = len(dt) and float(numpy.median(dt)) or 1.0
+        weights = numpy.append(numpy.where(dt<=median * 3, dt, median), median)
+        self.duration = float(weights.sum())
+        self.time = numpy.bincount(bins, weights, self.size)
+        recorded = numpy.bincount(bins, weights * airflow(duty), self.size)
+        self.airflow = numpy.where(self.time>0, recorded / numpy.maximum(self.time, 1e-9), 0.0)
+
+        # the path of the temperature bins without repeated values
+        changes = numpy.flatnonzero(numpy.diff(bins)) + 1
+        starts = numpy.concatenate(([0], changes))
+        path = hysteresis_filter(bins[starts].tolist(), int(round(hysteresis / resolution)))
+        run_time = numpy.add.reduceat(weights, starts)
+        # time in each bin of the filtered path
+        self.held_time = numpy.bincount(path, run_time, self.size)
+        # the bins of the samples without repeated values. the switches are
+        # counted by replaying it
+        self.path = bins[starts]
+
+# numpy.searchsorted() of the values in each row of the sorted rows
+def search_rows(rows, values, side='left'):
+    low = min(rows.min(), values.min())
+    span = max(rows.max(), values.max()) - low + 1.0
+    offset = numpy.arange(rows.shape[0])[:, None] * span
+    index = numpy.searchsorted((rows - low + offset).ravel(), (values - low + offset).ravel(), side)
+    return index.reshape(values.shape) - numpy.arange(rows.shape[0])[:, None] * rows.shape[1]
+
+# temp_to_target_speed() of the daemon as bins. a candidate that changed the
+# duty cycle in bin a changes it again if the temperature reaches up[a] or
+# falls to down[a]. temps and speed have one row per candidate
+def get_switch_bins(temps, speed, deadband, hysteresis):
+    # the rows are sorted for the search. they only decrease by rounding
+    temps = numpy.maximum.accumulate(temps, axis=1)
+    speed = numpy.maximum.accumulate(speed, axis=1)
+    step = max(deadband, 1e-6)
+    # rising temperatures change the duty cycle by at least deadband, turn
+    # the fan on or reach 100%
+    up = search_rows(speed, numpy.where(speed==0, 1e-6, numpy.minimum(speed + step, 100.0)))
+    up = numpy.where(speed>=100.0, speed.shape[1], up)
+    # falling temperatures after the hysteresis, if the duty cycle drops by
+    # at least deadband or the fan is turned off
+    lower = search_rows(speed, speed - step, 'right') - 1
+    off = search_rows(speed, numpy.zeros((speed.shape[0], 1)), 'right') - 1
+    down = numpy.minimum(search_rows(temps, temps - hysteresis, 'right') - 1, numpy.maximum(lower, off))
+    down = numpy.where(speed==0, -1, down)
+    return up, down
+
+# number of duty cycle changes of each candidate along the path of bins
+def count_switches(path, up, down):
+    n = up.shape[0]
+    # a candidate switches if the bin is outside first..first+width-1 of the
+    # bin of its last change. the difference wraps around below first
+    first = list(numpy.ascontiguousarray((down + 1).T.astype(numpy.uint16)))
+    width = list(numpy.ascontiguousarray(numpy.maximum(up - down - 1, 0).T.astype(numpy.uint16)))
+    current_first = first[path[0]].copy()
+    current_width = width[path[0]].copy()
+    switches = numpy.zeros(n, dtype=numpy.int32)
+    diff = numpy.empty(n, dtype=numpy.uint16)
+    switched = numpy.empty(n, dtype=bool)
+    for value in path[1:].tolist():
+        numpy.subtract(value, current_first, out=diff)
+        numpy.greater_equal(diff, current_width, out=switched)
+        numpy.copyto(current_first, first[value], where=switched)
+        numpy.copyto(current_width, width[value], where=switched)
+        numpy.add(switches, switched, out=switches)
+    return switches
+
+# scores of the settings. settings has one column per candidate
+def evaluate(histograms, settings, airflow, args, iterations=12):
+    min_temp, max_temp, lin, min_fan = [row[:, None] for row in settings]
+    temps = histograms.temps[None, :]
+    ambient = args.ambient
+    # steady state temperature with the airflow of the candidate
+    base = (temps - ambient) * (1.0 + args.fan_effect * histograms.airflow[None, :])
+    corrected = numpy.repeat(temps, settings.shape[1], axis=0)
+    for i in range(iterations):
+        flow = airflow(get_speed(corrected, min_temp, max_temp, lin, min_fan))
+        corrected = (corrected + ambient + base / (1.0 + args.fan_effect * flow)) / 2.0
+    speed = get_speed(corrected, min_temp, max_temp, lin, min_fan)
+    days = histograms.duration / 86400.0
+    above = (corrected>args.threshold) @ histograms.time
+    mean_duty = speed @ histograms.held_time / histograms.duration
+    up, down = get_switch_bins(corrected, speed, args.deadband, args.hysteresis)
+    switches = count_switches(histograms.path, up, down)
+    recorded = histograms.time>0
+    return {
+        'above': above / 60.0 / days,
+        'max_temp': numpy.where(recorded[None, :], corrected, -numpy.inf).max(axis=1),
+        'mean_duty': mean_duty,
+        'switches': switches / days,
+    }
+
+# candidates that are not dominated by another one in all scores. each
+# remaining candidate removes the ones it dominates, of equal scores only the
+# first is kept
+def get_pareto(scores):
+    index = numpy.arange(len(scores))
+    i = 0
+    while i<len(scores):
+        keep = (scores<scores[i]).any(axis=1)
+        keep[i] = True
+        index = index[keep]
+        scores = scores[keep]
+        i = int(numpy.count_nonzero(keep[0:i])) + 1
+    return index
+
+def get_recorded_scores(ts, temp, duty, args, duration):
+    dt = numpy.diff(ts, append=ts[-1])
+    days = duration / 86400.0
+    return {
+        'above': float(dt[temp>args.threshold].sum()) / 60.0 / days,
+        'max_temp': float(temp.max()),
+        'mean_duty': float((duty * dt).sum() / max(dt.sum(), 1e-9)),
+        'switches': float(numpy.count_nonzero(numpy.diff(duty))) / days,
+    }
+
+def format_row(name, settings, scores):
+    if settings==None:
+        settings = ('', '', '', '')
+    else:
+        settings = tuple('%.2f' % value for value in settings)
+    return '%-10s %7s %7s %7s %7s %12.1f %9.1f %10.1f %13.1f' % ((name,) + settings + (scores['above'], scores['max_temp'], scores['mean_duty'], scores['switches']))
+
+def main(argv=None):
+    args = create_parser().parse_args(argv)
+    if numpy==None:
+        print('tune requires numpy')
+        sys.exit(1)
+
+    start = time.perf_counter()
+    try:
+        ts, temp, duty, rpm, skipped = load_series(args.series)
+    except (OSError, ValueError) as e:
+        print('cannot read series: %s' % e)
+        sys.exit(1)
+    airflow = create_airflow(duty, rpm)
+    histograms = SeriesHistograms(ts, temp, duty, airflow, args.hysteresis)
+    candidates = create_candidates(args)
+    scores = evaluate(histograms, candidates, airflow, args)
+    matrix = numpy.stack((scores['above'], scores['mean_duty'], scores['switches']), axis=1)
+    pareto = get_pareto(matrix)
+    pareto = pareto[numpy.lexsort((matrix[pareto, 1], matrix[pareto, 0]))]
+    current = numpy.array([[args.min], [args.max], [args.lin], [args.min_fan]])
+    current_scores = dict((key, float(value[0])) for key, value in evaluate(histograms, current, airflow, args).items())
+    recorded_scores = get_recorded_scores(ts, temp, duty, args, histograms.duration)
+    elapsed = time.perf_counter() - start
+
+    results = []
+    for i in pareto[0:max(0, args.top)]:
+        result = dict(zip(('min', 'max', 'lin', 'min_fan'), candidates[:, i].tolist()))
+        result.update((key, float(value[i])) for key, value in scores.items())
+        results.append(result)
+
+    if args.json:
+        print(json.dumps({
+            'version': VERSION,
+            'samples': len(ts),
+            'skipped': skipped,
+            'days': histograms.duration / 86400.0,
+            'candidates': candidates.shape[1],
+            'pareto': len(pareto),
+            'seconds': elapsed,
+            'recorded': recorded_scores,
+            'current': current_scores,
+            'results': results,
+        }, indent=2))
+        return
+
+    print('%u samples, %.1f days, %u candidates, %u pareto-optimal, %.2f seconds' % (len(ts), histograms.duration / 86400.0, candidates.shape[1], len(pareto), elapsed))
+    if skipped:
+        print('%u invalid lines skipped' % skipped)
+    print('threshold %.1f°C ambient %.1f°C fan effect %.1f deadband %.1f%% hysteresis %.1f°C' % (args.threshold, args.ambient, args.fan_effect, args.deadband, args.hysteresis))
+    print()
+    print('%-10s %7s %7s %7s %7s %12s %9s %10s %13s' % ('', 'min', 'max', 'lin', 'min_fan', 'above min/d', 'max temp', 'mean duty', 'switches/day'))
+    print(format_row('recorded', None, recorded_scores))
+    print(format_row('current', (args.min, args.max, args.lin, args.min_fan), current_scores))
+    for result in results:
+        print(format_row('', (result['min'], result['max'], result['lin'], result['min_fan']), result))
@@ -15,6 +15,10 @@ PIP_LIBS="pigpio"
 SYSTEMD_DIR=/etc/systemd/system
 RPI_FANSPEED_SRC="$INST_DIR/raspi_fanspeed.py"
 RPI_FANSPEED_BIN="/usr/bin/raspi_fanspeed"
+RPI_FANSPEED_PACKAGE_SRC="$INST_DIR/rpi_fanspeed"
+RPI_FANSPEED_LIB_DIR="/usr/lib/raspi_fanspeed"
+RPI_FANSPEED_SHM_SRC="$INST_DIR/raspi_fanspeed_shm.py"
+RPI_FANSPEED_SHM_BIN="/usr/bin/raspi_fanspeed_shm"
 SERVICE_NAME=raspi_fanspeed
 SYSTEMCTL_BIN=$(which systemctl)
 
@@ -141,11 +145,23 @@ echo "Installing python3 libraries: $PIP_LIBS"
 
 $PIP_INSTALL
 
+echo "Installing rpi_fanspeed package to $RPI_FANSPEED_LIB_DIR"
+
+rm -rf "$RPI_FANSPEED_LIB_DIR/rpi_fanspeed" && \
+mkdir -p "$RPI_FANSPEED_LIB_DIR" && \
+cp -r "$RPI_FANSPEED_PACKAGE_SRC" "$RPI_FANSPEED_LIB_DIR/" && \
+rm -rf "$RPI_FANSPEED_LIB_DIR/rpi_fanspeed/__pycache__" || \
+echo "Failed to copy $RPI_FANSPEED_PACKAGE_SRC to $RPI_FANSPEED_LIB_DIR"
+
 escape_sed "#!$PYTHON_BIN"
 cat "$RPI_FANSPEED_SRC" | sed "1 s/^.*$/$ESCAPED_SED/" > "$RPI_FANSPEED_BIN" && \
 chmod o+x "$RPI_FANSPEED_BIN" || \
 echo "Failed to copy $RPI_FANSPEED_SRC to $RPI_FANSPEED_BIN"
 
+cat "$RPI_FANSPEED_SHM_SRC" | sed "1 s/^.*$/$ESCAPED_SED/" > "$RPI_FANSPEED_SHM_BIN" && \
+chmod o+x "$RPI_FANSPEED_SHM_BIN" || \
+echo "Failed to copy $RPI_FANSPEED_SHM_SRC to $RPI_FANSPEED_SHM_BIN"
+
 if [ -x "$SYSTEMD_DIR" ] ; then
 	echo Installing RPI_FANSPEED_COMMAND_LINE service
 	escape_sed "$RPI_FANSPEED_COMMAND_LINE"
@@ -0,0 +1,51 @@
+# fan curve table against the formula of raspi_fanspeed.py
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rpi_fanspeed import cli, daemon
+from rpi_fanspeed.curve import FanCurve
+
+# temp_to_speed() before the table was added
+def original_speed(temp, min_temp, max_temp, lin, min_fan):
+    if temp<min_temp:
+        return 0
+    speed = (temp - min_temp)
+    speed = pow(speed, lin)
+    speed = speed / (max_temp - min_temp) * 100
+    speed = (speed * (1.0 - min_fan / 100.0)) + min_fan
+    return float(min(100.0, speed))
+
+class FanCurveTest(unittest.TestCase):
+
+    SETTINGS = (
+        (40.0, 55.0, 1.0, 30.0),
+        (50.0, 60.0, 1.2, 60.0),
+        (45.0, 70.0, 0.8, 40.0),
+        (30.0, 80.0, 2.0, 0.0),
+    )
+
+    # the table has 0.01°C steps and the duty cycle is rounded to 0.01%
+    def test_from_linear(self):
+        for min_temp, max_temp, lin, min_fan in self.SETTINGS:
+            curve = FanCurve.from_linear(min_temp, max_temp, lin, min_fan)
+            for i in range(2000, 13000):
+                temp = i / 100.0
+                self.assertAlmostEqual(curve.get_speed(temp), original_speed(temp, min_temp, max_temp, lin, min_fan), delta=0.0051, msg='%s at %.2f°C' % ((min_temp, max_temp, lin, min_fan), temp))
+
+    # temperatures between the steps use the nearest one
+    def test_temp_to_speed(self):
+        for min_temp, max_temp, lin, min_fan in self.SETTINGS:
+            args = cli.create_parser('test').parse_args(['--min=%s' % min_temp, '--max=%s' % max_temp, '--lin=%s' % lin, '--min-fan=%s' % min_fan])
+            fsc = daemon.RPiFanSpeedControl(None)
+            fsc.set_args(args)
+            for i in range(2000, 9000):
+                temp = i / 100.0 + 0.003
+                self.assertAlmostEqual(fsc.temp_to_speed(temp), original_speed(round(temp, 2), min_temp, max_temp, lin, min_fan), delta=0.0051)
+
+
+if __name__ == '__main__':
+    unittest.main()
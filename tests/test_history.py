@@ -0,0 +1,48 @@
+# in memory history and its command line option
+
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rpi_fanspeed import cli
+from rpi_fanspeed.history import History
+
+class HistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.history = History(hours=1)
+        for i in range(7200):
+            self.history.add(1792267000 + i, 45.1 + i % 3 * 0.1, 40.0, 1234)
+
+    def test_query(self):
+        result = self.history.query(1792267000 + 7000, 1792267000 + 7199, max_points=1000)
+        self.assertEqual(result['resolution'], 1)
+        self.assertEqual(len(result['ts']), 200)
+        # more than 1000 buckets with 1 second resolution
+        result = self.history.query(1792267000 + 5000, 1792267000 + 7199, max_points=1000)
+        self.assertEqual(result['resolution'], 60)
+        # values are rounded
+        self.assertEqual(result['temperature']['min'][-1], 45.1)
+        self.assertEqual(result['temperature']['avg'][-1], 45.2)
+
+    # a requested resolution returns at most max_points buckets before end
+    def test_resolution(self):
+        result = self.history.query(max_points=10, resolution=1)
+        self.assertEqual(result['ts'], list(range(1792267000 + 7190, 1792267000 + 7200)))
+        result = self.history.query(1792267000, max_points=5, resolution=60)
+        self.assertEqual(len(result['ts']), 5)
+        self.assertRaises(ValueError, self.history.query, resolution=5)
+
+    def test_option(self):
+        parser = cli.create_parser('test')
+        self.assertEqual(parser.parse_args(['--history=0']).history, 0)
+        self.assertEqual(parser.parse_args(['--history=0.5']).history, 0.5)
+        with open(os.devnull, 'w') as devnull, mock.patch('sys.stderr', devnull):
+            self.assertRaises(SystemExit, parser.parse_args, ['--history=0.0001'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+# period estimator and notification decoder of the rpm monitor
+
+import os
+import sys
+import array
+import struct
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rpi_fanspeed import daemon, sim
+
+# 3000 rpm, 2 edges per revolution
+PERIOD = 10000
+# flag of the keep alive report of pigpiod
+NTFY_FLAGS_ALIVE = 1 << 6
+
+class TicksDiffTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = sim.VirtualClock()
+        patcher = mock.patch.object(daemon, 'clock', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_wrap(self):
+        ticks_diff = daemon.TicksDiff()
+        first = 2**32 - 10 * PERIOD
+        for i in range(20):
+            ticks_diff.set_ticks((first + i * PERIOD) & 0xffffffff)
+        self.assertEqual(ticks_diff.get_diffs(), [PERIOD] * 19)
+        self.assertAlmostEqual(ticks_diff.get_rpm(), 3000.0)
+        ticks = array.array('I', [(first + i * PERIOD) & 0xffffffff for i in range(20, 40)])
+        ticks_diff.add_ticks(ticks, self.clock.monotonic())
+        self.assertEqual(ticks_diff.get_diffs(), [PERIOD] * 31)
+        self.assertAlmostEqual(ticks_diff.get_rpm(), 3000.0)
+
+    # a glitch splits one period into 2 short ones, both are ignored
+    def test_glitch(self):
+        ticks_diff = daemon.TicksDiff()
+        for i in range(10):
+            ticks_diff.set_ticks(i * PERIOD)
+            if i==5:
+                ticks_diff.set_ticks(i * PERIOD + PERIOD // 3)
+        self.assertEqual(sorted(ticks_diff.get_diffs()), [PERIOD // 3, PERIOD - PERIOD // 3] + [PERIOD] * 8)
+        self.assertAlmostEqual(ticks_diff.get_rpm(), 3000.0)
+
+    def test_timeout(self):
+        ticks_diff = daemon.TicksDiff(timeout=1.0)
+        for i in range(10):
+            ticks_diff.set_ticks(i * PERIOD)
+        self.assertFalse(ticks_diff.is_timeout())
+        self.clock.now = 0.999
+        self.assertFalse(ticks_diff.is_timeout())
+        self.assertIsNotNone(ticks_diff.get_rpm())
+        self.clock.now = 1.0
+        self.assertTrue(ticks_diff.is_timeout())
+        self.assertIsNone(ticks_diff.get_rpm())
+        self.assertAlmostEqual(ticks_diff.get_idle_time(), 1.0)
+        # the next edge starts a new measurement
+        ticks_diff.set_ticks(100 * PERIOD)
+        self.assertEqual(ticks_diff.count, 1)
+        self.assertIsNone(ticks_diff.get_rpm())
+
+
+class DecodeTest(unittest.TestCase):
+
+    GPIO = 16
+
+    def setUp(self):
+        self.monitor = daemon.RPMMonitor(None, self.GPIO, buffer_size=64)
+
+    # reports of (flags, tick, level of the gpio). the level of gpio 17 is
+    # always set
+    def decode(self, reports, timeout=False):
+        data = b''.join(struct.pack('<HHII', seq, flags, tick, (level << self.GPIO) | (1 << 17)) for seq, (flags, tick, level) in enumerate(reports))
+        self.monitor._buffer[:len(data)] = data
+        ticks = array.array('I')
+        timeout = self.monitor.decode(len(data), ticks, timeout)
+        return ticks.tolist(), timeout
+
+    def edges(self, first, n, level=1):
+        reports = []
+        for i in range(n):
+            reports.append((0, first + i * PERIOD // 2, level))
+            level ^= 1
+        return reports
+
+    def test_alternating(self):
+        # rising edge first
+        reports = self.edges(1000, 20)
+        falling = [tick for flags, tick, level in reports if not level]
+        self.assertEqual(self.decode(reports), (falling, False))
+        # falling edge first
+        reports = self.edges(1000, 21, level=0)
+        falling = [tick for flags, tick, level in reports if not level]
+        self.assertEqual(self.decode(reports), (falling, False))
+        # an odd number of reports ending with a rising edge
+        self.assertEqual(self.decode(reports[:-1]), (falling[:-1], False))
+
+    # the slow path returns the same ticks as the fast path
+    def test_slow_path(self):
+        reports = self.edges(1000, 20)
+        falling = [tick for flags, tick, level in reports if not level]
+        # keep alive report in the middle
+        keepalive = reports[:10] + [(NTFY_FLAGS_ALIVE, 50000, 1)] + reports[10:]
+        self.assertEqual(self.decode(keepalive), (falling, False))
+        # a missed rising edge
+        missed = reports[:4] + reports[5:]
+        self.assertEqual(self.decode(missed), (falling, False))
+
+    def test_watchdog(self):
+        reports = self.edges(1000, 10)
+        falling = [tick for flags, tick, level in reports if not level]
+        wdog = (daemon.NOTIFY_FLAGS_WDOG | self.GPIO, 200000, 0)
+        # the ticks of watchdog reports are not edges
+        self.assertEqual(self.decode(reports + [wdog]), (falling, True))
+        # an edge after the timeout
+        self.assertEqual(self.decode(reports + [wdog] + self.edges(300000, 2)), (falling + [300000 + PERIOD // 2], False))
+        # a watchdog report of another gpio
+        self.assertEqual(self.decode(reports + [(daemon.NOTIFY_FLAGS_WDOG | 17, 200000, 0)]), (falling, False))
+        # a pending timeout is kept without edges
+        self.assertEqual(self.decode([(NTFY_FLAGS_ALIVE, 200000, 0)], timeout=True), ([], True))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+# rotation of the --series file
+
+import os
+import sys
+import gzip
+import json
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rpi_fanspeed import daemon
+
+class SeriesWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, 'series.json')
+        patcher = mock.patch.object(daemon, 'verbose')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def read(self, segment):
+        with (segment.endswith('.gz') and gzip.open or open)(segment, 'rt') as f:
+            return f.read()
+
+    # each segment has one sample, all segments are rotated within the same
+    # second
+    def check_rotate(self, compress):
+        writer = daemon.SeriesWriter(self.filename, max_size=0, keep=3, compress=compress)
+        for i in range(5):
+            writer.append(1792267000.0 + i, 45.0, 40.0, 1200)
+            writer.write(writer.take(), 1792267000.5)
+        segments = writer.get_segments()
+        self.assertFalse(os.path.exists(self.filename))
+        self.assertEqual(len(segments), 3)
+        # the last 3 samples are kept in order
+        self.assertEqual([json.loads(self.read(segment))['ts'] for segment in segments], [1792267002.0, 1792267003.0, 1792267004.0])
+
+    def test_rotate(self):
+        self.check_rotate(False)
+
+    def test_rotate_compress(self):
+        self.check_rotate(True)
+
+
+if __name__ == '__main__':
+    unittest.main()
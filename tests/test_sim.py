@@ -0,0 +1,161 @@
+# runs the daemon against the simulated backend. no GPIO, pigpiod or broker
+# is required
+#
+#   python3 -m pytest tests
+#   python3 -m unittest discover tests
+
+import io
+import os
+import sys
+import json
+import signal
+import tempfile
+import unittest
+import contextlib
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rpi_fanspeed import main, daemon, sim
+
+# wall time limit of a simulation. a daemon that does not exit at the end of
+# --sim-duration fails the test instead of hanging
+TIME_LIMIT = 60
+
+# records the published messages with the duty cycle of the first fan at
+# that time. the broker is unreachable between the simulated times of offline
+class StandInClient(sim.StandInClient):
+
+    clients = []
+    offline = None
+
+    def __init__(self, client_id=None, clean_session=True):
+        sim.StandInClient.__init__(self, client_id, clean_session)
+        self.disconnected = False
+        self.messages = []
+        StandInClient.clients.append(self)
+
+    def connect(self, host=None, port=1883, keepalive=60):
+        sim.StandInClient.connect(self, host, port, keepalive)
+        if StandInClient.offline:
+            daemon.clock.add_listener(self.step)
+
+    def step(self, dt, end):
+        now = daemon.clock.monotonic()
+        start, stop = StandInClient.offline
+        if not self.disconnected and start<=now<stop:
+            self.disconnected = True
+            self.on_disconnect(self, None, 1)
+        elif self.disconnected and now>=stop:
+            self.disconnected = False
+            self.on_connect(self, None, {}, 0)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        if self.disconnected:
+            raise AssertionError('publish while disconnected')
+        channel = daemon.channels[0]
+        duty = channel.fsc.pigpio.pwm[channel.pin][1] / 10000.0
+        self.messages.append((topic, payload, daemon.clock.monotonic(), duty))
+
+    def get_messages(self, entity):
+        return [(json.loads(payload), ts, duty) for topic, payload, ts, duty in self.messages if topic.endswith(entity)]
+
+class SimulationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        StandInClient.clients = []
+        StandInClient.offline = None
+        def timeout(sig, frame):
+            raise self.failureException('simulation did not exit after %u seconds' % TIME_LIMIT)
+        self.old_handler = signal.signal(signal.SIGALRM, timeout)
+
+    def tearDown(self):
+        signal.alarm(0)
+        signal.signal(signal.SIGALRM, self.old_handler)
+        self.tmpdir.cleanup()
+
+    # runs the daemon until the end of the simulation. returns the statistics
+    # of the simulation
+    def simulate(self, argv):
+        argv = ['--simulate', '--history=0', '--pid=%s' % os.path.join(self.tmpdir.name, 'raspi_fanspeed.pid'), '--calibration-file=%s' % os.path.join(self.tmpdir.name, 'calibration.json')] + argv
+        output = io.StringIO()
+        signal.alarm(TIME_LIMIT)
+        with mock.patch.dict(sys.modules, sim.create_paho(StandInClient)), mock.patch('time.sleep'), contextlib.redirect_stdout(output):
+            with self.assertRaises(SystemExit):
+                main(argv)
+        signal.alarm(0)
+        return json.loads(output.getvalue().splitlines()[-1])
+
+    def test_duration(self):
+        stats = self.simulate(['--sim-duration=600', '--sim-load=0.5'])
+        self.assertEqual(stats['time'], 600.0)
+        self.assertGreater(stats['edges'], 0)
+        self.assertEqual(daemon.metrics.stalls, 0)
+
+    # the log file has the same JSON as the status
+    def test_log(self):
+        log = os.path.join(self.tmpdir.name, 'fanspeed.json')
+        self.simulate(['--sim-duration=60', '--log=%s' % log])
+        with open(log) as f:
+            data = json.loads(f.read())
+        self.assertEqual(set(data), set(('temperature', 'duty_cycle', 'rpm', 'ts', 'interval')))
+        self.assertEqual(data, daemon.fsc.get_status())
+
+    def check_stall(self, argv, offline=None):
+        # time when the stalled fan has stopped sending edges
+        stopped = []
+        step = sim.FanModel.step
+        def fan_step(fan, dt):
+            step(fan, dt)
+            if fan.stalled and not fan.rpm and not stopped:
+                stopped.append(daemon.clock.monotonic())
+        StandInClient.offline = offline
+        with mock.patch.object(sim.FanModel, 'step', fan_step):
+            stats = self.simulate(['--sim-duration=700', '--sim-load=0.5', '--sim-stall=600', '--mqtthost=localhost'] + argv)
+        self.assertEqual(stats['time'], 700.0)
+        self.assertEqual(daemon.metrics.stalls, 1)
+        alerts = StandInClient.clients[0].get_messages('/alert')
+        self.assertEqual([alert['alert'] for alert, ts, duty in alerts], ['stall', 'failed'])
+        if offline:
+            # both alerts are sent after reconnecting
+            for alert, ts, duty in alerts:
+                self.assertGreaterEqual(ts, offline[1])
+        # time of the alert, the payload has whole seconds
+        times = [alert['ts'] - daemon.clock.start_time for alert, ts, duty in alerts]
+        # the fan spins down for a few seconds. the watchdog timeout of the
+        # running fan is below 1 second, the stall is detected within the
+        # timeout and the hold-off after the last edge
+        self.assertGreaterEqual(times[0], 600.0 - 1.0)
+        self.assertLess(times[0], stopped[0] + 1.0 + daemon.args.tach_holdoff)
+        self.assertEqual(alerts[0][2], daemon.args.failover_speed)
+        # the fan is restarted with --restart-pulses and fails
+        self.assertAlmostEqual(times[1], times[0] + (daemon.args.restart_interval + 1.0) * daemon.args.restart_pulses + daemon.args.restart_interval, delta=2.0)
+        self.assertEqual(alerts[1][2], daemon.args.failover_speed)
+
+    def test_stall_notify(self):
+        self.check_stall([])
+
+    def test_stall_callback(self):
+        self.check_stall(['--edge-source=callback'])
+
+    # the broker is unreachable during the stall and the restart
+    def test_stall_disconnect(self):
+        self.check_stall([], offline=(590.0, 690.0))
+
+    def test_mqtt_publish(self):
+        stats = self.simulate(['--sim-duration=3600', '--mqtthost=localhost', '--mqttupdateinterval=60'])
+        self.assertEqual(stats['time'], 3600.0)
+        self.assertEqual(len(StandInClient.clients), 1)
+        states = StandInClient.clients[0].get_messages('/json')
+        # the state is published at least once per update interval
+        self.assertGreaterEqual(len(states), 3600 // 60)
+        times = [ts for state, ts, duty in states]
+        self.assertLessEqual(max(b - a for a, b in zip(times, times[1:])), 60.0 + daemon.args.interval)
+        for state, ts, duty in states:
+            self.assertEqual(set(state), set(('temperature', 'duty_cycle', 'rpm', 'ts', 'interval')))
+            self.assertAlmostEqual(float(state['duty_cycle']), duty, delta=0.01)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+# offline curve tuner against generated series
+
+import os
+import sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rpi_fanspeed import cli, daemon, tune
+
+# series of a day with 10 second samples. the temperature is a random walk
+# between 35 and 65°C with sensor noise, the duty cycle is set by the
+# deadband and hysteresis rules of the daemon
+def generate_series(argv, seed=1, samples=8640, interval=10.0):
+    args = cli.create_parser('test').parse_args(argv)
+    fsc = daemon.RPiFanSpeedControl(None)
+    fsc.set_args(args)
+    writer = daemon.SeriesWriter('series.json')
+    rnd = random.Random(seed)
+    temp = 45.0
+    for i in range(samples):
+        temp = min(65.0, max(35.0, temp + rnd.gauss(0.0, 0.3)))
+        value = round(temp + rnd.uniform(-0.1, 0.1), 2)
+        speed = fsc.temp_to_target_speed(value)
+        writer.append(1792267000.0 + i * interval, value, speed, int(speed * 50))
+    return args, ''.join(writer.take()).encode()
+
+@unittest.skipIf(tune.numpy==None, 'tune requires numpy')
+class TuneTest(unittest.TestCase):
+
+    def test_parse_series(self):
+        args, data = generate_series([], samples=10)
+        lines = data.splitlines(True)
+        # a crash while writing leaves a partial line in front of the next one
+        # and a truncated last line
+        torn = lines[0:3] + [lines[3][0:30] + lines[4]] + lines[5:] + [lines[5][0:40]]
+        samples, skipped = tune.parse_series(b''.join(torn))
+        self.assertEqual(skipped, 2)
+        self.assertEqual(len(samples), 8)
+        expected, skipped = tune.parse_series(b''.join(lines[0:3] + lines[5:]))
+        self.assertEqual(skipped, 0)
+        self.assertEqual(samples.tolist(), expected.tolist())
+        self.assertTrue((samples[:, 1]<100).all())
+
+    def test_parse_series_keys(self):
+        data = b'{"rpm":1200,"duty_cycle":40.00,"ts":1792267000.000,"temperature":45.10}\n' \
+            b'{"ts":1792267010.000,"temperature":45.20,"duty_cycle":41.00,"rpm":1250,"fan":"cpu"}\n' \
+            b'{"ts":1792267020.000,"temperature":45.30,"duty_cycle":42.00}\n' \
+            b'\n'
+        samples, skipped = tune.parse_series(data)
+        self.assertEqual(skipped, 1)
+        self.assertEqual(samples.tolist(), [[1792267000.0, 45.1, 40.0, 1200.0], [1792267010.0, 45.2, 41.0, 1250.0]])
+
+    # the current settings reproduce the recorded number of duty cycle changes
+    def test_current_switches(self):
+        argv = ['--min=45', '--max=70', '--lin=1.0', '--min-fan=40']
+        args, data = generate_series(argv)
+        samples, skipped = tune.parse_series(data)
+        ts, temp, duty, rpm = samples.T
+        tune_args = tune.create_parser().parse_args(['series.json'])
+        airflow = tune.create_airflow(duty, rpm)
+        histograms = tune.SeriesHistograms(ts, temp, duty, airflow, tune_args.hysteresis)
+        current = tune.numpy.array([[args.min], [args.max], [args.lin], [args.min_fan]])
+        scores = tune.evaluate(histograms, current, airflow, tune_args)
+        recorded = tune.get_recorded_scores(ts, temp, duty, tune_args, histograms.duration)
+        self.assertGreater(recorded['switches'], 100)
+        # within 5%
+        self.assertAlmostEqual(scores['switches'][0] / recorded['switches'], 1.0, delta=0.05)
+        self.assertAlmostEqual(scores['mean_duty'][0], recorded['mean_duty'], delta=recorded['mean_duty'] * 0.05)
+
+
+if __name__ == '__main__':
+    unittest.main()